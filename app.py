@@ -1,54 +1,342 @@
 """Email Pitch Tool - 轻量级邮件营销工具 MVP"""
 import os
 import io
+import sys
+import re
 import csv
 import json
 import sqlite3
 import base64
-from datetime import datetime, timedelta
+import hashlib
+import hmac
+import html
+import secrets
+import time
+import threading
+import queue
+import uuid
+import zlib
+import bisect
+import atexit
+import logging
+import logging.handlers
+import socket
+import asyncio
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
 from typing import Optional
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
-from jinja2 import Template
+import httpx
+from jinja2 import Environment
 from openpyxl import load_workbook
 from email_validator import validate_email, EmailNotValidError
+from email_validator.deliverability import validate_email_deliverability
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
-
-app = FastAPI(title="Email Pitch Tool")
+from googleapiclient.http import HttpRequest, BatchHttpRequest
+from googleapiclient.errors import HttpError
+from google.auth.transport.requests import Request as GoogleAuthRequest
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
+
+@asynccontextmanager
+async def lifespan(app):
+    # web 模式只处理 HTTP 请求，发送和定时任务由单独的 `python app.py worker` 进程执行
+    if APP_ROLE != "web":
+        start_background_jobs()
+        await send_engine.start()
+    yield
+    if APP_ROLE != "web":
+        await send_engine.stop()
+        scheduler.shutdown(wait=False)
+    # 退出前把队列中尚未写入的追踪事件落盘
+    tracking_events.stop()
+
+app = FastAPI(title="Email Pitch Tool", lifespan=lifespan)
 scheduler = BackgroundScheduler()
-scheduler.start()
 
 # 配置
 DB_PATH = "data.db"
+# 连接池：只读连接数量、每个连接的页缓存和内存映射大小（MB）
+DB_READERS = int(os.environ.get("DB_READERS", 8))
+DB_CACHE_MB = int(os.environ.get("DB_CACHE_MB", 32))
+DB_MMAP_MB = int(os.environ.get("DB_MMAP_MB", 256))
 CREDENTIALS_FILE = "credentials.json"  # 从Google Cloud Console下载
 SCOPES = ['https://www.googleapis.com/auth/gmail.send', 'https://www.googleapis.com/auth/gmail.readonly']
 # 支持环境变量配置REDIRECT_URI（部署时使用）
 BASE_URL = os.environ.get("BASE_URL", "http://localhost:8000")
 REDIRECT_URI = f"{BASE_URL}/oauth/callback"
 TEST_MODE = os.environ.get("TEST_MODE", "false").lower() == "true"  # 测试模式不发真邮件
+# 批量发送：每个调度周期最多发送的数量（campaign未单独设置时使用），按令牌桶匀速补充
+SEND_BATCH_SIZE = int(os.environ.get("SEND_BATCH_SIZE", 1))
+# 发送引擎：全局和每个账号同时进行的 Gmail 发送请求数
+SEND_CONCURRENCY = int(os.environ.get("SEND_CONCURRENCY", 32))
+SEND_ACCOUNT_CONCURRENCY = int(os.environ.get("SEND_ACCOUNT_CONCURRENCY", 2))
+# 每个发件账号的默认限制（所有campaign合计），可在账号设置中单独修改
+ACCOUNT_RATE_PER_MINUTE = float(os.environ.get("ACCOUNT_RATE_PER_MINUTE", 10))
+ACCOUNT_DAILY_CAP = int(os.environ.get("ACCOUNT_DAILY_CAP", 500))  # 0 为不限
+ACCOUNT_PLAN_SECONDS = 30  # 账号发送计划（限制、运行中的campaign）的重新加载间隔
+# 发送队列：领取后的租约时长、失败重试（指数退避）和已发送记录的保留天数
+SEND_LEASE_SECONDS = int(os.environ.get("SEND_LEASE_SECONDS", 300))
+SEND_MAX_ATTEMPTS = int(os.environ.get("SEND_MAX_ATTEMPTS", 5))
+SEND_RETRY_SECONDS = 60
+SEND_QUEUE_KEEP_DAYS = 30
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"  # 发送队列和 worker 租约的持有者
+# 运行模式：all（默认，HTTP + 后台任务）/ web（只提供 HTTP）/ worker（只运行后台任务）；命令行 python app.py web|worker 会覆盖
+APP_ROLE = os.environ.get("APP_ROLE", "all")
+# 多个 worker 通过 worker_leases 表分配发件账号和定时任务：租约时长、续租/重新分配的间隔（秒）
+WORKER_LEASE_SECONDS = int(os.environ.get("WORKER_LEASE_SECONDS", 60))
+WORKER_POLL_SECONDS = int(os.environ.get("WORKER_POLL_SECONDS", 10))
+REPLY_CHECK_MINUTES = int(os.environ.get("REPLY_CHECK_MINUTES", 10))  # 回复检查独立调度周期
+# Gmail service缓存：过期时间（秒）和最多缓存的账号数
+GMAIL_CACHE_TTL = int(os.environ.get("GMAIL_CACHE_TTL", 3600))
+GMAIL_CACHE_SIZE = int(os.environ.get("GMAIL_CACHE_SIZE", 64))
+# 回复检查：每次最多扫描的收件邮件数，以及每个 batch 请求包含的子请求数（Gmail 建议不超过50）
+REPLY_SCAN_LIMIT = int(os.environ.get("REPLY_SCAN_LIMIT", 100))
+GMAIL_BATCH_SIZE = int(os.environ.get("GMAIL_BATCH_SIZE", 50))
+GMAIL_API_ENDPOINT = os.environ.get("GMAIL_API_ENDPOINT", "")  # 仅用于测试/压测时指向本地模拟服务
+TEMPLATE_CACHE_SIZE = int(os.environ.get("TEMPLATE_CACHE_SIZE", 512))  # 编译后模板缓存数量
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", 1000))  # 导入时每批验证/写入的行数
+IMPORT_WORKERS = int(os.environ.get("IMPORT_WORKERS", 2))  # 后台导入任务的并发数
+LEADS_PAGE_MAX = int(os.environ.get("LEADS_PAGE_MAX", 1000))  # 收件人列表每页最多返回的行数
+EXPORT_CHUNK_SIZE = 1000  # 导出时每次从数据库读取的行数
+# 追踪事件写入：攒够 TRACK_FLUSH_EVENTS 条或距上次写入 TRACK_FLUSH_MS 毫秒后批量提交；队列满时丢弃新事件
+TRACK_FLUSH_EVENTS = int(os.environ.get("TRACK_FLUSH_EVENTS", 500))
+TRACK_FLUSH_MS = int(os.environ.get("TRACK_FLUSH_MS", 500))
+TRACK_QUEUE_SIZE = int(os.environ.get("TRACK_QUEUE_SIZE", 100000))
+# 点击追踪：发送前把正文中的链接改写为 {BASE_URL}/l/<签名短链>；LINK_SECRET 未设置时使用数据库中生成的随机密钥
+CLICK_TRACKING = os.environ.get("CLICK_TRACKING", "true").lower() == "true"
+LINK_SECRET = os.environ.get("LINK_SECRET", "")
+LINK_CACHE_SIZE = int(os.environ.get("LINK_CACHE_SIZE", 100000))  # 内存中缓存的短链数量
+# 追踪服务同步：每页拉取的记录数、每次最多拉取的页数、每次标记已同步的记录数
+TRACKER_SYNC_PAGE_SIZE = int(os.environ.get("TRACKER_SYNC_PAGE_SIZE", 500))
+TRACKER_SYNC_MAX_PAGES = int(os.environ.get("TRACKER_SYNC_MAX_PAGES", 100))
+TRACKER_ACK_CHUNK = 500
+# 追踪服务推送：签名密钥；轮询作为兜底，连续没有新记录时间隔翻倍直到上限（分钟）
+TRACKER_SECRET = os.environ.get("TRACKER_SECRET", "")
+TRACKER_POLL_MINUTES = int(os.environ.get("TRACKER_POLL_MINUTES", 10))
+TRACKER_POLL_MAX_MINUTES = int(os.environ.get("TRACKER_POLL_MAX_MINUTES", 60))
+TRACKER_SIGNATURE_TOLERANCE = 300  # 推送请求时间戳允许的误差（秒）
+TRACKER_SEEN_DAYS = 30  # 已处理事件ID的保留天数
+# 邮箱验证结果缓存：有效期（天）、DNS检查线程数、内存中最多缓存的地址数
+VALIDATION_CACHE_DAYS = float(os.environ.get("VALIDATION_CACHE_DAYS", 7))
+VALIDATION_WORKERS = int(os.environ.get("VALIDATION_WORKERS", 16))
+VALIDATION_MEMORY_SIZE = int(os.environ.get("VALIDATION_MEMORY_SIZE", 200000))
+SUPPRESSION_REFRESH_SECONDS = 5  # 从数据库同步其他进程对禁发名单的修改的最短间隔
+# 删除/归档 campaign：后台每批处理的行数和批次之间的间隔（让出写连接给发送和追踪写入）；归档数据写入单独的数据库文件
+MAINTENANCE_CHUNK_SIZE = int(os.environ.get("MAINTENANCE_CHUNK_SIZE", 1000))
+MAINTENANCE_PAUSE_MS = int(os.environ.get("MAINTENANCE_PAUSE_MS", 20))
+ARCHIVE_DB_PATH = os.environ.get("ARCHIVE_DB_PATH", "archive.db")
+# 日志：级别和格式（text 为一行文本，json 为一行一个JSON对象，附带 extra 传入的字段）
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))  # worker 模式提供 /metrics 的端口，0 为不提供
 
-# 数据库初始化
-def init_db():
-    conn = sqlite3.connect(DB_PATH, timeout=30.0)
-    # 启用WAL模式以提高并发性能
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA busy_timeout=30000")  # 30秒超时
-    conn.executescript("""
+# ============================================
+# 日志和监控指标
+# 日志经 QueueHandler 放入队列，由 QueueListener 线程写到 stdout，写日志的线程和事件循环不等待 I/O；
+# 指标在内存中累计，GET /metrics 输出 Prometheus 文本格式
+# ============================================
+
+class JsonLogFormatter(logging.Formatter):
+    """一行一个JSON对象：时间、级别、模块、消息，以及 extra 传入的字段"""
+    RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+    def format(self, record):
+        entry = {"ts": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                 "msg": record.getMessage()}
+        entry.update((k, v) for k, v in vars(record).items() if k not in self.RESERVED)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def count_log_record(record) -> bool:
+    """QueueHandler 的过滤器：按模块统计警告和错误（pitch_log_messages_total），不过滤任何记录"""
+    if record.levelno >= logging.WARNING:
+        log_messages.inc(logger=record.name, level=record.levelname.lower())
+    return True
+
+def setup_logging() -> logging.handlers.QueueListener:
+    root = logging.getLogger("pitch")
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json"
+                        else logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    log_queue = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(count_log_record)
+    root.handlers[:] = [handler]
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    atexit.register(listener.stop)  # 退出前写完队列中的日志
+    return listener
+
+def label_key(names: tuple, labels: dict) -> tuple:
+    return tuple(str(labels[name]) for name in names)
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Counter:
+    """只增不减的计数，按标签值组合分别累计"""
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = label_key(self.labels, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in values]
+
+class Histogram:
+    """耗时分布：每个标签值组合记录各区间的次数、总和和总次数（输出时累加为 Prometheus 的 le 区间）"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (),
+                 buckets: tuple = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self._values = {}  # key -> [各区间次数..., +Inf区间次数, 总和]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = label_key(self.labels, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list:
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        lines = []
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{float(bound)!r}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, le)} {total}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {counts[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {total}")
+        return lines
+
+class Gauge:
+    """输出时调用 collect() 取当前值：返回数字，或者 {标签值元组: 数字}；
+    已有计数的对象（如追踪写入的丢弃数）用 kind="counter" 直接输出"""
+
+    def __init__(self, name: str, help: str, collect, labels: tuple = (), kind: str = "gauge"):
+        self.name, self.help, self.collect, self.labels, self.kind = name, help, collect, labels, kind
+
+    def render(self) -> list:
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in values.items()]
+
+class MetricsRegistry:
+    """进程内的指标注册表，不依赖 prometheus_client；多个 worker 进程各自输出自己的指标"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.render()
+            except Exception as e:
+                log.warning("Metric %s failed: %s", metric.name, e)
+                continue
+            lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.kind}", *samples]
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+JOB_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+gmail_api_seconds = metrics.register(Histogram(
+    "pitch_gmail_api_seconds", "Gmail API request duration", ("api", "status"),
+    (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)))
+render_seconds = metrics.register(Histogram("pitch_render_seconds", "Template render time per email", (), FAST_BUCKETS))
+db_wait_seconds = metrics.register(Histogram(
+    "pitch_db_wait_seconds", "Time waiting for a pooled connection (writer = write lock)", ("kind",), FAST_BUCKETS))
+# 借出连接到归还的时间，包含两次查询之间的 Python 处理，不是单条查询的耗时
+db_checkout_seconds = metrics.register(Histogram(
+    "pitch_db_connection_checkout_seconds", "Time a pooled connection stayed checked out (not per-query latency)",
+    ("kind",), FAST_BUCKETS))
+job_lag_seconds = metrics.register(Histogram(
+    "pitch_scheduler_lag_seconds", "Delay between a job's scheduled and actual start", ("job",), JOB_BUCKETS))
+job_seconds = metrics.register(Histogram("pitch_scheduler_job_seconds", "Scheduled job duration", ("job",), JOB_BUCKETS))
+job_errors = metrics.register(Counter("pitch_scheduler_job_errors_total", "Scheduled job runs that raised or were missed",
+                                      ("job", "reason")))
+sends_total = metrics.register(Counter("pitch_sends_total", "Send attempts by result (sent/failed/suppressed)",
+                                       ("campaign", "account", "result")))
+events_total = metrics.register(Counter("pitch_events_total", "Recorded lead events (sent/open/click/reply)",
+                                        ("campaign", "account", "type")))
+log_messages = metrics.register(Counter("pitch_log_messages_total", "Warnings and errors logged", ("logger", "level")))
+
+log = logging.getLogger("pitch")
+log_listener = setup_logging()
+db_log = log.getChild("db")
+send_log = log.getChild("send")
+replies_log = log.getChild("replies")
+tracking_log = log.getChild("tracking")
+jobs_log = log.getChild("jobs")
+
+# ============================================
+# 数据库迁移：按顺序执行，已执行到的版本记录在 PRAGMA user_version 中
+# 表结构变更只在末尾追加新的迁移，不修改已发布的迁移
+# ============================================
+
+def migrate_base_schema(conn):
+    execute_script(conn, """
         CREATE TABLE IF NOT EXISTS accounts (
             id INTEGER PRIMARY KEY, email TEXT UNIQUE, token TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
         CREATE TABLE IF NOT EXISTS campaigns (
             id INTEGER PRIMARY KEY, name TEXT, status TEXT DEFAULT 'draft',
             account_email TEXT, interval_minutes INTEGER DEFAULT 5,
+            batch_size INTEGER DEFAULT 1, daily_limit INTEGER DEFAULT 0,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
         CREATE TABLE IF NOT EXISTS templates (
@@ -62,54 +350,536 @@ def init_db():
             FOREIGN KEY(campaign_id) REFERENCES campaigns(id)
         );
         CREATE TABLE IF NOT EXISTS blacklist (email TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS email_validation_cache (
+            kind TEXT, value TEXT, error TEXT, checked_at REAL, PRIMARY KEY(kind, value)
+        );
+        CREATE TABLE IF NOT EXISTS gmail_sync_state (
+            account_email TEXT PRIMARY KEY, history_id TEXT, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    # 迁移机制之前创建的数据库可能缺少这些列
+    add_column_if_missing(conn, "campaigns", "batch_size", "INTEGER DEFAULT 1")
+    add_column_if_missing(conn, "campaigns", "daily_limit", "INTEGER DEFAULT 0")
+
+def migrate_lead_indexes(conn):
+    # 唯一约束前先清理重复的 (campaign_id, email)，保留最早导入的一条
+    removed = conn.execute(
+        "DELETE FROM leads WHERE id NOT IN (SELECT MIN(id) FROM leads GROUP BY campaign_id, email)").rowcount
+    if removed:
+        db_log.info("Removed %d duplicate lead(s)", removed)
+    execute_script(conn, """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_leads_campaign_email ON leads(campaign_id, email);
+        CREATE INDEX IF NOT EXISTS idx_leads_campaign ON leads(campaign_id);
+        CREATE INDEX IF NOT EXISTS idx_leads_pending ON leads(campaign_id, id) WHERE status='pending' AND replied=0;
+        CREATE INDEX IF NOT EXISTS idx_leads_campaign_sent ON leads(campaign_id, last_sent_at);
+        CREATE INDEX IF NOT EXISTS idx_leads_email ON leads(email);
+        CREATE INDEX IF NOT EXISTS idx_templates_campaign_step ON templates(campaign_id, step);
+        CREATE INDEX IF NOT EXISTS idx_campaigns_account ON campaigns(account_email);
     """)
-    conn.commit()
+
+def migrate_lead_status_index(conn):
+    # 收件人列表按状态筛选并按id分页
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_leads_campaign_status ON leads(campaign_id, status)")
+
+def migrate_events(conn):
+    # 追加写的事件日志 + 按小时/天的 campaign×step×type 汇总（events 为事件次数，leads 为首次发生该事件的lead数）
+    execute_script(conn, """
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY, lead_id INTEGER, campaign_id INTEGER, type TEXT, step INTEGER, created_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_events_lead ON events(lead_id);
+        CREATE INDEX IF NOT EXISTS idx_events_campaign_time ON events(campaign_id, created_at);
+        CREATE TABLE IF NOT EXISTS event_counts_hourly (
+            campaign_id INTEGER, bucket TEXT, step INTEGER, type TEXT, events INTEGER DEFAULT 0, leads INTEGER DEFAULT 0,
+            PRIMARY KEY(campaign_id, bucket, step, type)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS event_counts_daily (
+            campaign_id INTEGER, bucket TEXT, step INTEGER, type TEXT, events INTEGER DEFAULT 0, leads INTEGER DEFAULT 0,
+            PRIMARY KEY(campaign_id, bucket, step, type)
+        ) WITHOUT ROWID;
+    """)
+    # 已有数据没有事件时间，按最后发送时间回填汇总，保证统计数字与迁移前一致
+    for table, width, suffix in (("event_counts_hourly", 13, ":00"), ("event_counts_daily", 10, "")):
+        for event_type, condition, step in (("sent", "1", "1"), ("open", "opened=1", "MAX(current_step-1, 1)"),
+                                             ("click", "clicked=1", "MAX(current_step-1, 1)"),
+                                             ("reply", "replied=1", "MAX(current_step-1, 1)")):
+            conn.execute(f"""
+                INSERT INTO {table}(campaign_id, bucket, step, type, events, leads)
+                SELECT campaign_id, substr(last_sent_at, 1, {width}) || '{suffix}', {step}, '{event_type}', COUNT(*), COUNT(*)
+                FROM leads WHERE last_sent_at IS NOT NULL AND {condition} GROUP BY 1, 2, 3
+                ON CONFLICT DO UPDATE SET events=events+excluded.events, leads=leads+excluded.leads
+            """)
+
+# leads 每一列对计数器的贡献，触发器中 NEW./OLD. 前缀替换 {row}
+CAMPAIGN_COUNTER_TERMS = {
+    "total": "1",
+    "sent": "({row}.last_sent_at IS NOT NULL)",
+    "opens": "({row}.opened > 0)",
+    "clicks": "({row}.clicked > 0)",
+    "replies": "({row}.replied > 0)",
+    "pending": "({row}.status = 'pending' AND {row}.replied = 0)",
+    "completed": "({row}.status = 'completed')",
+}
+
+def migrate_campaign_counters(conn):
+    # 每个campaign一行计数器，由 leads 上的触发器在同一事务内增减，任何写入路径都不会漏更新
+    columns = ", ".join(f"{name} INTEGER DEFAULT 0" for name in CAMPAIGN_COUNTER_TERMS)
+    names = ", ".join(CAMPAIGN_COUNTER_TERMS)
+    def terms(row, sign=""):
+        return ", ".join(f"{sign}{term.format(row=row)}" for term in CAMPAIGN_COUNTER_TERMS.values())
+    def deltas(sign):
+        return ", ".join(f"{name}={name}{sign}excluded.{name}" for name in CAMPAIGN_COUNTER_TERMS)
+    # 只有影响计数的值变化时才更新计数器
+    changed = " OR ".join(["OLD.campaign_id IS NOT NEW.campaign_id"] + [
+        f"{term.format(row='OLD')} IS NOT {term.format(row='NEW')}" for term in CAMPAIGN_COUNTER_TERMS.values()])
+    execute_script(conn, f"""
+        CREATE TABLE IF NOT EXISTS campaign_counters (campaign_id INTEGER PRIMARY KEY, {columns});
+        CREATE TRIGGER IF NOT EXISTS trg_leads_counters_insert AFTER INSERT ON leads BEGIN
+            INSERT INTO campaign_counters(campaign_id, {names}) VALUES(NEW.campaign_id, {terms("NEW")})
+            ON CONFLICT(campaign_id) DO UPDATE SET {deltas("+")};
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_leads_counters_delete AFTER DELETE ON leads BEGIN
+            INSERT INTO campaign_counters(campaign_id, {names}) VALUES(OLD.campaign_id, {terms("OLD", "-")})
+            ON CONFLICT(campaign_id) DO UPDATE SET {deltas("+")};
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_leads_counters_update
+        AFTER UPDATE OF campaign_id, last_sent_at, opened, clicked, replied, status ON leads
+        WHEN {changed} BEGIN
+            INSERT INTO campaign_counters(campaign_id, {names}) VALUES(OLD.campaign_id, {terms("OLD", "-")})
+            ON CONFLICT(campaign_id) DO UPDATE SET {deltas("+")};
+            INSERT INTO campaign_counters(campaign_id, {names}) VALUES(NEW.campaign_id, {terms("NEW")})
+            ON CONFLICT(campaign_id) DO UPDATE SET {deltas("+")};
+        END;
+    """)
+    # 用现有数据初始化
+    conn.execute("DELETE FROM campaign_counters")
+    sums = ", ".join(f"SUM({term.format(row='leads')})" for term in CAMPAIGN_COUNTER_TERMS.values())
+    conn.execute(f"INSERT INTO campaign_counters(campaign_id, {names}) SELECT campaign_id, {sums} FROM leads GROUP BY campaign_id")
+
+def migrate_tracker_seen(conn):
+    # 追踪服务记录ID（"open:123" / "click:45"），推送和轮询共用，同一记录只处理一次
+    execute_script(conn, """
+        CREATE TABLE IF NOT EXISTS tracker_events_seen (event_id TEXT PRIMARY KEY, received_at REAL) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_tracker_events_seen_time ON tracker_events_seen(received_at);
+    """)
+
+def migrate_account_limits(conn):
+    # 账号发送限制，NULL 表示使用 ACCOUNT_RATE_PER_MINUTE / ACCOUNT_DAILY_CAP 默认值；工作时间为本地小时 [start, end)
+    for column in ("rate_per_minute REAL", "daily_cap INTEGER", "work_start INTEGER", "work_end INTEGER"):
+        name, ddl = column.split()
+        add_column_if_missing(conn, "accounts", name, ddl)
+
+def migrate_send_queue(conn):
+    # 发送队列（outbox）：queued -> in_flight（领取时设置租约）-> sent / failed
+    # idempotency_key = campaign:lead:step，同一封邮件只会入队一次；
+    # due_at 对排队中的任务是可以领取的时间，对发送中的任务是租约到期时间
+    execute_script(conn, """
+        CREATE TABLE IF NOT EXISTS send_queue (
+            id INTEGER PRIMARY KEY, campaign_id INTEGER NOT NULL, lead_id INTEGER NOT NULL, step INTEGER NOT NULL,
+            idempotency_key TEXT NOT NULL UNIQUE, status TEXT NOT NULL DEFAULT 'queued', due_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0, lease_owner TEXT, sent_at TEXT, gmail_id TEXT, error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_send_queue_due ON send_queue(campaign_id, due_at) WHERE status IN ('queued', 'in_flight');
+        CREATE INDEX IF NOT EXISTS idx_send_queue_campaign ON send_queue(campaign_id, status);
+        CREATE INDEX IF NOT EXISTS idx_send_queue_sent ON send_queue(sent_at) WHERE status='sent';
+    """)
+
+def migrate_worker_leases(conn):
+    # 进程间协调：name 为 "worker:<id>"（心跳）、"send:<账号>"（发送）、"replies:<账号>" / "job:<任务>"（定时任务）
+    conn.execute("CREATE TABLE IF NOT EXISTS worker_leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, "
+                 "expires_at REAL NOT NULL) WITHOUT ROWID")
+
+def migrate_links(conn):
+    # 点击追踪短链：同一campaign中相同的目标地址只存一行；app_secrets 保存所有进程共用的签名密钥
+    execute_script(conn, """
+        CREATE TABLE IF NOT EXISTS links (
+            id INTEGER PRIMARY KEY, campaign_id INTEGER NOT NULL, url TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_links_campaign_url ON links(campaign_id, url);
+        CREATE TABLE IF NOT EXISTS app_secrets (name TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID;
+    """)
+    conn.execute("INSERT OR IGNORE INTO app_secrets(name, value) VALUES('link_signing', ?)", (secrets.token_hex(32),))
+
+def migrate_suppression(conn):
+    # 全局禁发名单，取代 blacklist 表：value 为完整地址或 "@域名"（同时匹配子域名）；
+    # 移除时只标记 removed，每次修改递增 version，各进程按 version 增量同步到内存
+    execute_script(conn, """
+        CREATE TABLE IF NOT EXISTS suppression (
+            value TEXT PRIMARY KEY, kind TEXT NOT NULL, reason TEXT, removed INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL, updated_at REAL NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_suppression_version ON suppression(version);
+    """)
+    conn.execute("INSERT OR IGNORE INTO suppression(value, kind, reason, version, updated_at) "
+                 "SELECT lower(trim(email)), 'email', 'blacklist', 1, ? FROM blacklist WHERE email LIKE '%_@_%'",
+                 (time.time(),))
+    conn.execute("DROP TABLE blacklist")
+
+def migrate_counter_freeze(conn):
+    # 归档/删除中的campaign分批删除leads时不再逐行扣减计数器：归档后统计保持不变，删除时最后整行删除
+    names = ", ".join(CAMPAIGN_COUNTER_TERMS)
+    terms = ", ".join(f"-{term.format(row='OLD')}" for term in CAMPAIGN_COUNTER_TERMS.values())
+    deltas = ", ".join(f"{name}={name}+excluded.{name}" for name in CAMPAIGN_COUNTER_TERMS)
+    execute_script(conn, f"""
+        DROP TRIGGER IF EXISTS trg_leads_counters_delete;
+        CREATE TRIGGER trg_leads_counters_delete AFTER DELETE ON leads
+        WHEN IFNULL((SELECT status FROM campaigns WHERE id=OLD.campaign_id), '') NOT IN ('archiving', 'deleting') BEGIN
+            INSERT INTO campaign_counters(campaign_id, {names}) VALUES(OLD.campaign_id, {terms})
+            ON CONFLICT(campaign_id) DO UPDATE SET {deltas};
+        END;
+    """)
+
+def migrate_events_campaign_index(conn):
+    # 归档按 id 顺序分批读取 events（first_id 需要单调），(campaign_id) 索引按 rowid 有序，不需要额外排序
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_campaign ON events(campaign_id)")
+
+MIGRATIONS = [migrate_base_schema, migrate_lead_indexes, migrate_lead_status_index, migrate_events,
+              migrate_campaign_counters, migrate_tracker_seen, migrate_account_limits, migrate_send_queue,
+              migrate_worker_leases, migrate_links, migrate_suppression, migrate_counter_freeze,
+              migrate_events_campaign_index]
+
+def execute_script(conn, script: str):
+    """在当前事务中逐条执行SQL脚本（executescript 会先提交事务）"""
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            conn.execute(statement)
+            statement = ""
+
+def add_column_if_missing(conn, table: str, column: str, ddl: str):
+    cols = {r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    if column not in cols:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+# 数据库初始化
+def init_db():
+    conn = sqlite3.connect(DB_PATH, timeout=30.0)
+    # 启用WAL模式以提高并发性能
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA busy_timeout=30000")  # 30秒超时
+    # 每个迁移一个事务；BEGIN IMMEDIATE 后重新读取版本，多个进程同时启动也只会执行一次
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(MIGRATIONS):
+            conn.commit()
+            break
+        try:
+            MIGRATIONS[version](conn)
+            conn.execute(f"PRAGMA user_version={version + 1}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        db_log.info("Applied migration %d: %s", version + 1, MIGRATIONS[version].__name__)
     conn.close()
+
 init_db()
 
+REPLY_ACCOUNTS_SQL = """
+    SELECT DISTINCT c.account_email FROM campaigns c WHERE c.account_email IS NOT NULL AND EXISTS (
+        SELECT 1 FROM leads l WHERE l.campaign_id = c.id AND l.last_sent_at IS NOT NULL AND l.replied = 0)
+"""
+
 def check_all_replies():
-    """定期检查所有campaign的回复"""
+    """定期检查所有发件账号的回复（每个账号只扫描一次收件箱）
+
+    每个账号检查前先取得本周期的租约，多个 worker 同时运行时各自检查一部分账号，同一账号一个周期只检查一次。
+    """
     try:
-        with get_db() as conn:
-            campaigns = conn.execute(
-                "SELECT DISTINCT c.id, c.account_email FROM campaigns c "
-                "JOIN leads l ON c.id = l.campaign_id "
-                "WHERE c.account_email IS NOT NULL AND l.replied = 0"
-            ).fetchall()
+        with get_db(readonly=True) as conn:
+            accounts = conn.execute(REPLY_ACCOUNTS_SQL).fetchall()
 
         # 释放数据库连接后再逐个检查
-        for campaign in campaigns:
+        for account in accounts:
+            if not acquire_lease(f"replies:{account['account_email']}", REPLY_CHECK_MINUTES * 60 * 0.9):
+                continue
             try:
-                check_replies(campaign['id'], campaign['account_email'])
+                check_replies(account['account_email'])
             except Exception as e:
-                print(f"[Check replies error for campaign {campaign['id']}] {e}")
+                replies_log.error("Check failed for %s: %s", account['account_email'], e, extra={"account": account['account_email']})
     except Exception as e:
-        print(f"[Check all replies error] {e}")
+        replies_log.error("Check all replies failed: %s", e)
+
+def timed_job(job_id: str, func):
+    """定时任务的包装：记录每次执行的耗时（pitch_scheduler_job_seconds）"""
+    def run():
+        with job_seconds.time(job=job_id):
+            return func()
+    return run
+
+def on_scheduler_event(event):
+    """APScheduler 事件：提交执行时记录计划时间到实际开始的延迟；
+    出错、错过执行时间、上一次还没结束而跳过时按原因计数"""
+    if event.code == EVENT_JOB_SUBMITTED:
+        lag = (datetime.now(timezone.utc) - event.scheduled_run_times[0]).total_seconds()
+        job_lag_seconds.observe(max(lag, 0), job=event.job_id)
+    elif event.code == EVENT_JOB_ERROR:
+        job_errors.inc(job=event.job_id, reason="error")
+        jobs_log.error("Job %s failed: %s", event.job_id, event.exception, extra={"job": event.job_id})
+    elif event.code == EVENT_JOB_MISSED:
+        job_errors.inc(job=event.job_id, reason="missed")
+    elif event.code == EVENT_JOB_MAX_INSTANCES:
+        job_errors.inc(job=event.job_id, reason="max_instances")
+
+def start_background_jobs():
+    """启动定时任务（all / worker 模式）：回复检查、追踪同步和清理；campaign发送由 send_engine 负责"""
+    scheduler.add_job(timed_job('check_all_replies', check_all_replies), 'interval', minutes=REPLY_CHECK_MINUTES,
+                      id='check_all_replies', replace_existing=True)
+    jobs_log.info("Reply checker every %d minutes", REPLY_CHECK_MINUTES)
+    scheduler.add_job(timed_job('purge_send_queue', purge_send_queue), 'interval', hours=24, id='purge_send_queue',
+                      replace_existing=True)
+    # 继续执行进程退出时没有完成的删除/归档
+    scheduler.add_job(timed_job('resume_campaign_jobs', resume_campaign_jobs), 'interval', minutes=5,
+                      id='resume_campaign_jobs', replace_existing=True, next_run_time=datetime.now())
+    if os.environ.get("TRACKER_URL"):
+        scheduler.add_job(timed_job('sync_tracker', sync_tracker_data), 'interval', minutes=TRACKER_POLL_MINUTES,
+                          id='sync_tracker', replace_existing=True)
+        jobs_log.info("Tracker sync enabled (every %d minutes)", TRACKER_POLL_MINUTES)
+    scheduler.add_listener(on_scheduler_event, EVENT_JOB_SUBMITTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED |
+                           EVENT_JOB_MAX_INSTANCES)
+    scheduler.start()
+
+# ============================================
+# 数据库连接池：一个写连接（同一时间只给一个线程）+ 多个只读连接
+# ============================================
+
+class SQLitePool:
+    """线程安全的 SQLite 连接池
+
+    连接只在创建时设置一次 PRAGMA 并保持打开（同时复用预编译语句缓存）。写操作串行使用唯一的写连接，
+    同一线程嵌套获取时复用同一连接；只读连接设置 query_only，同一线程嵌套申请时复用，
+    持有写连接的线程申请只读连接时直接复用写连接。
+    """
+
+    def __init__(self, path: str, readers: int):
+        self.path, self.max_readers = path, readers
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._local = threading.local()
+        self._readers = queue.Queue()
+        self._reader_count = 0
+        self._stats_lock = threading.Lock()
+        self._stats = {kind: {"checkouts": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+                       for kind in ("writer", "reader")}
+
+    def _connect(self, readonly: bool):
+        conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA busy_timeout=30000")  # 30秒超时
+        conn.execute("PRAGMA synchronous=NORMAL")  # WAL模式下足够安全，提交不再每次fsync
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_MB * 1024}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_MB * 1024 * 1024}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if readonly:
+            conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def _record(self, kind: str, waited: float):
+        db_wait_seconds.observe(waited, kind=kind)
+        with self._stats_lock:
+            stats = self._stats[kind]
+            stats["checkouts"] += 1
+            stats["wait_seconds"] += waited
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+
+    def _checkout_reader(self):
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._stats_lock:
+            create = self._reader_count < self.max_readers
+            if create:
+                self._reader_count += 1
+        if create:
+            return self._connect(readonly=True)
+        try:
+            return self._readers.get(timeout=30)
+        except queue.Empty:
+            raise RuntimeError("database reader pool exhausted")
+
+    @contextmanager
+    def connection(self, readonly: bool = False):
+        if getattr(self._local, 'depth', 0):
+            # 当前线程已持有写连接
+            self._local.depth += 1
+            try:
+                yield self._writer
+            finally:
+                self._local.depth -= 1
+            return
+
+        if readonly and getattr(self._local, 'reader', None) is not None:
+            # 当前线程已持有只读连接，嵌套使用同一个，避免连接池耗尽时自己等自己
+            yield self._local.reader
+            return
+
+        started = time.monotonic()
+        if readonly:
+            conn = self._checkout_reader()
+            self._record("reader", time.monotonic() - started)
+            self._local.reader = conn
+            checked_out = time.monotonic()
+            try:
+                yield conn
+            finally:
+                self._local.reader = None
+                if conn.in_transaction:
+                    conn.rollback()
+                self._readers.put(conn)
+                db_checkout_seconds.observe(time.monotonic() - checked_out, kind="reader")
+            return
+
+        if not self._writer_lock.acquire(timeout=60):
+            raise RuntimeError("timed out waiting for the database writer")
+        checked_out = time.monotonic()
+        self._record("writer", checked_out - started)
+        try:
+            if self._writer is None:
+                self._writer = self._connect(readonly=False)
+            self._local.depth = 1
+            yield self._writer
+        finally:
+            self._local.depth = 0
+            # 未提交的修改不带给下一个使用者
+            if self._writer is not None and self._writer.in_transaction:
+                self._writer.rollback()
+            self._writer_lock.release()
+            db_checkout_seconds.observe(time.monotonic() - checked_out, kind="writer")
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            result = {kind: dict(v) for kind, v in self._stats.items()}
+            result["reader"]["open"] = self._reader_count
+        result["reader"]["idle"] = self._readers.qsize()
+        return result
+
+db_pool = SQLitePool(DB_PATH, DB_READERS)
+
+def get_db(readonly: bool = False):
+    """获取数据库连接（with 语句）；只读查询传 readonly=True，不占用写连接"""
+    return db_pool.connection(readonly)
+
+# ============================================
+# 进程间协调：worker_leases 表中的租约（多个 worker 共用一个数据库）
+# ============================================
+
+# 没有租约、租约已过期或本来就是自己的租约时写入成功（rowcount=1），否则 rowcount=0
+LEASE_UPSERT_SQL = """
+    INSERT INTO worker_leases(name, owner, expires_at) VALUES(?, ?, ?)
+    ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at
+    WHERE worker_leases.owner=excluded.owner OR worker_leases.expires_at < ?
+"""
 
-def restore_running_campaigns():
-    """启动时恢复所有运行中的campaigns"""
+def try_lease(conn, name: str, owner: str, seconds: float, now: float) -> bool:
+    return conn.execute(LEASE_UPSERT_SQL, (name, owner, now + seconds, now)).rowcount > 0
+
+def acquire_lease(name: str, seconds: float, owner: str = WORKER_ID) -> bool:
+    """取得或续租一个租约"""
     with get_db() as conn:
-        rows = conn.execute("SELECT id, account_email, interval_minutes FROM campaigns WHERE status='running'").fetchall()
+        ok = try_lease(conn, name, owner, seconds, time.time())
+        conn.commit()
+    return ok
 
-    for row in rows:
-        if row['account_email']:
-            scheduler.add_job(process_campaign, 'interval', minutes=row['interval_minutes'] or 5,
-                              args=[row['id'], row['account_email']], id=f"campaign_{row['id']}", replace_existing=True)
-            print(f"[Restored] Campaign {row['id']} with interval {row['interval_minutes']}min")
+def release_lease(name: str, owner: str = WORKER_ID):
+    with get_db() as conn:
+        conn.execute("DELETE FROM worker_leases WHERE name=? AND owner=?", (name, owner))
+        conn.commit()
 
-    # 添加定期回复检查任务（每10分钟检查一次所有campaign）
-    scheduler.add_job(check_all_replies, 'interval', minutes=10, id='check_all_replies', replace_existing=True)
-    print("[Scheduled] Reply checker every 10 minutes")
+RUNNING_ACCOUNTS_SQL = "SELECT DISTINCT account_email FROM campaigns WHERE status='running' AND account_email IS NOT NULL"
 
-@contextmanager
-def get_db():
-    conn = sqlite3.connect(DB_PATH, timeout=30.0)
-    conn.execute("PRAGMA busy_timeout=30000")  # 30秒超时
-    conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-    finally:
-        conn.close()
+def assign_accounts(owner: str, owned: set, busy: set):
+    """续租 owned 中的发件账号，并领取没有 worker 负责的账号，返回 (要启动的账号, 要停止的账号)
+
+    运行中campaign的发件账号按在线 worker 数平分：持有超过一份的 worker 放掉多出的账号，
+    由新加入的 worker 领取；worker 退出或崩溃后，它的账号在租约过期后被其他 worker 接手。
+    busy 是正在停止、还没有放掉租约的账号，本轮不再领取。
+    """
+    now = time.time()
+    with get_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try_lease(conn, f"worker:{owner}", owner, WORKER_LEASE_SECONDS, now)
+        workers = conn.execute("SELECT COUNT(*) FROM worker_leases WHERE name LIKE 'worker:%' AND expires_at >= ?",
+                               (now,)).fetchone()[0]
+        accounts = sorted(r[0] for r in conn.execute(RUNNING_ACCOUNTS_SQL).fetchall())
+        share = -(-len(accounts) // max(workers, 1))
+        keep = [email for email in sorted(owned) if email in accounts]
+        keep = [email for email in keep[:share] if try_lease(conn, f"send:{email}", owner, WORKER_LEASE_SECONDS, now)]
+        take = []
+        for email in accounts:
+            if len(keep) + len(take) >= share:
+                break
+            if email not in owned and email not in busy and \
+                    try_lease(conn, f"send:{email}", owner, WORKER_LEASE_SECONDS, now):
+                take.append(email)
+        conn.commit()
+    return take, owned - set(keep)
+
+def worker_status() -> dict:
+    """在线的 worker 以及每个发件账号由哪个 worker 发送"""
+    with get_db(readonly=True) as conn:
+        rows = conn.execute("SELECT name, owner FROM worker_leases WHERE expires_at >= ?", (time.time(),)).fetchall()
+    return {"workers": sorted(owner for name, owner in rows if name.startswith("worker:")),
+            "senders": {name[len("send:"):]: owner for name, owner in rows if name.startswith("send:")}}
+
+# ============================================
+# 模板编译缓存
+# ============================================
+
+class TemplateCache:
+    """缓存编译后的 (subject, body) 模板，key 为模板ID + 内容哈希，所有模板共享一个 Environment"""
+
+    def __init__(self, maxsize: int):
+        self.env = Environment()
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, tpl):
+        """tpl 需要包含 id / subject / body"""
+        digest = hashlib.sha1(f"{tpl['subject']}\0{tpl['body']}".encode()).hexdigest()
+        key = (tpl['id'], digest)
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+        compiled = (self.env.from_string(tpl['subject']), self.env.from_string(tpl['body']))
+        with self._lock:
+            self._entries[key] = compiled
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return compiled
+
+    def invalidate(self, tid: int):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == tid]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+templates_cache = TemplateCache(TEMPLATE_CACHE_SIZE)
+
+def lead_context(lead) -> dict:
+    data = json.loads(lead['data'])
+    data['email'] = lead['email']
+    return data
+
+def render_bulk(tpl, leads):
+    """用同一个模板批量渲染多个lead，生成 (lead, subject, body)"""
+    subject_tpl, body_tpl = templates_cache.get(tpl)
+    for lead in leads:
+        data = lead_context(lead)
+        yield lead, subject_tpl.render(data), body_tpl.render(data)
 
 # Gmail OAuth
 @app.get("/oauth/start")
@@ -163,6 +933,8 @@ def oauth_callback(code: str):
         conn.execute("INSERT OR REPLACE INTO accounts(email, token) VALUES(?, ?)",
                     (email, creds.to_json()))
         conn.commit()
+    # 重新授权后丢弃旧的缓存
+    gmail_services.invalidate(email)
     return RedirectResponse("/?msg=账号绑定成功: " + email)
 
 # API 路由
@@ -175,7 +947,7 @@ def create_campaign(name: str = Form(...)):
 
 @app.get("/api/campaigns")
 def list_campaigns():
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         rows = conn.execute("SELECT * FROM campaigns ORDER BY id DESC").fetchall()
         return [dict(r) for r in rows]
 
@@ -189,7 +961,7 @@ def add_template(cid: int, step: int = Form(...), subject: str = Form(...), body
 
 @app.get("/api/campaigns/{cid}/templates")
 def get_templates(cid: int):
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         rows = conn.execute("SELECT * FROM templates WHERE campaign_id=? ORDER BY step", (cid,)).fetchall()
         return [dict(r) for r in rows]
 
@@ -199,6 +971,7 @@ def update_template(tid: int, step: int = Form(...), subject: str = Form(...), b
         conn.execute("UPDATE templates SET step=?, subject=?, body=?, delay_days=? WHERE id=?",
                     (step, subject, body, delay_days, tid))
         conn.commit()
+    templates_cache.invalidate(tid)
     return {"ok": True}
 
 @app.delete("/api/templates/{tid}")
@@ -206,14 +979,14 @@ def delete_template(tid: int):
     with get_db() as conn:
         conn.execute("DELETE FROM templates WHERE id=?", (tid,))
         conn.commit()
+    templates_cache.invalidate(tid)
     return {"ok": True}
 
 @app.get("/api/campaigns/{cid}/variables")
 def get_campaign_variables(cid: int):
     """提取campaign所有模板中使用的变量"""
-    import re
     variables = set()
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         rows = conn.execute("SELECT subject, body FROM templates WHERE campaign_id=?", (cid,)).fetchall()
         for row in rows:
             # 匹配 {{var}} 或 {{var|default}}
@@ -225,383 +998,2505 @@ def get_campaign_variables(cid: int):
     variables.discard('email')
     return {"variables": sorted(variables)}
 
-@app.post("/api/campaigns/{cid}/leads")
-async def upload_leads(cid: int, file: UploadFile = File(...), defaults: str = Form("{}")):
-    content = await file.read()
-    default_values = json.loads(defaults)
-    rows = []
-
-    if file.filename.endswith('.csv'):
-        text = content.decode('utf-8-sig')
-        reader = csv.DictReader(io.StringIO(text))
-        rows = list(reader)
-    else:
-        wb = load_workbook(io.BytesIO(content), read_only=True)
-        ws = wb.active
-        headers = [cell.value for cell in next(ws.iter_rows(max_row=1))]
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            rows.append(dict(zip(headers, row)))
+# ============================================
+# Leads 导入（流式解析，分批验证和写入）
+# ============================================
 
-    if not rows or 'email' not in rows[0]:
-        raise HTTPException(400, "文件必须包含email列")
+def iter_upload_rows(fileobj, filename: str):
+    """流式读取上传文件，返回 (表头, 行迭代器)，不把整个文件读入内存"""
+    if filename.endswith('.csv'):
+        text = io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+        reader = csv.DictReader(text)
+        return reader.fieldnames or [], reader
+
+    wb = load_workbook(fileobj, read_only=True)
+    ws = wb.active
+    rows = ws.iter_rows(values_only=True)
+    headers = list(next(rows, None) or [])
+
+    def iter_rows():
+        try:
+            for row in rows:
+                yield dict(zip(headers, row))
+        finally:
+            wb.close()
+    return headers, iter_rows()
+
+def chunked(iterable, size: int):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class EmailValidationCache:
+    """导入时的邮箱验证：地址去重后只做一次语法检查，DNS 可投递性按域名检查并在线程池中并行执行
+
+    结果按地址（kind='address'）和域名（kind='domain'）缓存在内存和 email_validation_cache 表中，
+    超过 VALIDATION_CACHE_DAYS 后重新验证。error 为 None 表示有效。
+    """
 
-    added, skipped = 0, 0
-    with get_db() as conn:
-        blacklist = {r[0] for r in conn.execute("SELECT email FROM blacklist").fetchall()}
-        existing = {r[0] for r in conn.execute("SELECT email FROM leads WHERE campaign_id=?", (cid,)).fetchall()}
+    def __init__(self, ttl_seconds: float, workers: int, memory_size: int):
+        self.ttl, self.memory_size = ttl_seconds, memory_size
+        self._memory = OrderedDict()  # (kind, value) -> (error, checked_at)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dns")
+        self._last_purge = 0.0
+        self.hits = 0
+        self.checks = {"address": 0, "domain": 0}
+
+    def validate_many(self, emails, check_deliverability: bool = False) -> dict:
+        """返回 {email: 错误信息或None}"""
+        unique = list(dict.fromkeys(emails))
+        results = self._lookup('address', unique)
+        fresh = []
+        for email in unique:
+            if email not in results:
+                try:
+                    validate_email(email, check_deliverability=False)
+                    results[email] = None
+                except EmailNotValidError as e:
+                    results[email] = str(e)
+                fresh.append(('address', email, results[email]))
+        self.checks['address'] += len(fresh)
+
+        if check_deliverability:
+            domains = {}
+            for email, error in results.items():
+                if error is None:
+                    domains.setdefault(email.rsplit('@', 1)[1], []).append(email)
+            domain_results = self._lookup('domain', list(domains))
+            missing = [d for d in domains if d not in domain_results]
+            for domain, error in zip(missing, self._executor.map(self._check_domain, missing)):
+                domain_results[domain] = error
+                fresh.append(('domain', domain, error))
+            self.checks['domain'] += len(missing)
+            for domain, error in domain_results.items():
+                if error:
+                    for email in domains[domain]:
+                        results[email] = error
+
+        if fresh:
+            self._store(fresh)
+        return results
+
+    @staticmethod
+    def _check_domain(domain: str):
+        try:
+            ascii_domain = domain if domain.isascii() else domain.encode('idna').decode()
+            validate_email_deliverability(ascii_domain, domain)
+            return None
+        except EmailNotValidError as e:
+            return str(e)
+        except UnicodeError as e:
+            return f"The domain name {domain} is not valid: {e}"
+
+    def _lookup(self, kind: str, values: list) -> dict:
+        now = time.time()
+        found, missing = {}, []
+        with self._lock:
+            for value in values:
+                cached = self._memory.get((kind, value))
+                if cached and now - cached[1] < self.ttl:
+                    self._memory.move_to_end((kind, value))
+                    found[value] = cached[0]
+                else:
+                    missing.append(value)
+        for i in range(0, len(missing), 500):
+            part = missing[i:i + 500]
+            with get_db(readonly=True) as conn:
+                rows = conn.execute(
+                    f"SELECT value, error, checked_at FROM email_validation_cache WHERE kind=? AND checked_at>=? "
+                    f"AND value IN ({','.join('?' * len(part))})", (kind, now - self.ttl, *part)
+                ).fetchall()
+            with self._lock:
+                for value, error, checked_at in rows:
+                    found[value] = error
+                    self._remember((kind, value), error, checked_at)
+        self.hits += len(found)
+        return found
+
+    def _remember(self, key, error, checked_at):
+        self._memory[key] = (error, checked_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _store(self, fresh: list):
+        now = time.time()
+        with self._lock:
+            for kind, value, error in fresh:
+                self._remember((kind, value), error, now)
+        with get_db() as conn:
+            conn.executemany("INSERT OR REPLACE INTO email_validation_cache(kind, value, error, checked_at) "
+                             "VALUES(?,?,?,?)", [(kind, value, error, now) for kind, value, error in fresh])
+            # 每小时清理一次过期记录
+            if now - self._last_purge > 3600:
+                self._last_purge = now
+                conn.execute("DELETE FROM email_validation_cache WHERE checked_at<?", (now - self.ttl,))
+            conn.commit()
 
-        for row in rows:
-            email = str(row.get('email', '')).strip().lower()
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._memory)
+        return {"memory_size": size, "hits": self.hits, "address_checks": self.checks['address'],
+                "domain_checks": self.checks['domain']}
+
+email_checks = EmailValidationCache(VALIDATION_CACHE_DAYS * 86400, VALIDATION_WORKERS, VALIDATION_MEMORY_SIZE)
+
+# ============================================
+# 全局禁发名单
+# ============================================
+
+SUPPRESSION_CHANGES_SQL = "SELECT value, removed, version FROM suppression WHERE version > ? ORDER BY version"
+# 首次加载按主键顺序整表读取，比按 version 索引回表快；之后的修改 version 都更大，由增量同步读取
+SUPPRESSION_LOAD_SQL = "SELECT value, removed, ? FROM suppression WHERE +version <= ?"
+SUPPRESSION_PAGE_SQL = """
+    SELECT value, kind, reason, updated_at FROM suppression WHERE removed=0 AND value > ? ORDER BY value LIMIT ?
+"""
+SUPPRESSION_FIELDS = ["value", "kind", "reason", "updated_at"]
+
+def normalize_suppression(value) -> Optional[tuple]:
+    """'A@x.com ' -> ('a@x.com', 'email')；'@x.com' 或 'x.com' -> ('@x.com', 'domain')；无法识别时返回 None"""
+    value = str(value or '').strip().lower()
+    if value.startswith('@'):
+        value = value[1:]
+    elif '@' in value:
+        local, _, domain = value.rpartition('@')
+        return (value, 'email') if local and '.' in domain else None
+    if '.' not in value or '@' in value or value.startswith('.'):
+        return None
+    return '@' + value, 'domain'
+
+class SuppressionList:
+    """全局禁发名单，常驻内存
+
+    第一次 refresh() 时把整张表读入两个集合（完整地址、域名），之后每隔 refresh_seconds 秒
+    只读取 version 更大的修改（其他进程的添加/移除）；本进程的修改写入数据库后直接更新集合。
+    match() 只查内存，检查一个地址是一次集合查找加上按域名层级的几次查找，导入和发送前可以逐个检查。
+    """
+
+    def __init__(self, refresh_seconds: float):
+        self.refresh_seconds = refresh_seconds
+        self._emails, self._domains = set(), set()
+        self.version = 0
+        self._refreshed_at = None
+        self._lock = threading.Lock()          # 保护集合
+        self._refresh_lock = threading.Lock()  # 同一时间只有一个线程读取修改
+        self.checks = self.hits = 0
+
+    def _due(self) -> bool:
+        return self._refreshed_at is None or time.monotonic() - self._refreshed_at >= self.refresh_seconds
+
+    def refresh(self, force: bool = False):
+        """同步数据库中的修改（间隔内重复调用直接返回）"""
+        if not force and not self._due():
+            return
+        with self._refresh_lock:
+            if not force and not self._due():
+                return
+            with get_db(readonly=True) as conn:
+                cursor = conn.cursor()
+                cursor.row_factory = None  # 百万行时 sqlite3.Row 的开销明显
+                if self._refreshed_at is None:
+                    latest = conn.execute("SELECT COALESCE(MAX(version), 0) FROM suppression").fetchone()[0]
+                    cursor.execute(SUPPRESSION_LOAD_SQL, (latest, latest))
+                else:
+                    cursor.execute(SUPPRESSION_CHANGES_SQL, (self.version,))
+                while True:
+                    rows = cursor.fetchmany(10000)
+                    if not rows:
+                        break
+                    with self._lock:
+                        for value, removed, _ in rows:
+                            self._apply(value, removed)
+                    self.version = max(self.version, rows[-1][2])
+            self._refreshed_at = time.monotonic()
+
+    def _apply(self, value: str, removed: bool):
+        target, key = (self._domains, value[1:]) if value.startswith('@') else (self._emails, value)
+        if removed:
+            target.discard(key)
+        else:
+            target.add(key)
+
+    def match(self, email: str) -> Optional[str]:
+        """返回命中的名单条目（地址或 "@域名"），不在名单中返回 None"""
+        email = email.strip().lower()
+        with self._lock:
+            self.checks += 1
+            if email in self._emails:
+                self.hits += 1
+                return email
+            domain = email.rpartition('@')[2]
+            while '.' in domain:
+                if domain in self._domains:
+                    self.hits += 1
+                    return '@' + domain
+                domain = domain.partition('.')[2]
+        return None
+
+    def match_many(self, emails) -> dict:
+        """返回 {地址: 命中的条目}，只包含在名单中的地址"""
+        return {email: entry for email in emails if (entry := self.match(email))}
+
+    def _write(self, sql: str, entries: list, params) -> int:
+        """在一个写事务中批量修改，本批所有条目使用同一个新 version"""
+        now = time.time()
+        with get_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            version = conn.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM suppression").fetchone()[0]
+            changed = conn.executemany(sql, [params(value, kind, version, now) for value, kind in entries]).rowcount
+            conn.commit()
+        with self._lock:
+            for value, _ in entries:
+                self._apply(value, sql.startswith("UPDATE"))
+        # 之前的修改都已同步时才前移 version，否则其他进程更早提交的修改还要在下次 refresh 时读取
+        with self._refresh_lock:
+            if self._refreshed_at is not None and self.version == version - 1:
+                self.version = version
+        return changed
+
+    def add(self, values, reason: Optional[str] = None) -> dict:
+        entries, invalid = self._normalize(values)
+        added = self._write(
+            "INSERT INTO suppression(value, kind, reason, removed, version, updated_at) VALUES(?,?,?,0,?,?) "
+            "ON CONFLICT(value) DO UPDATE SET removed=0, reason=excluded.reason, version=excluded.version, "
+            "updated_at=excluded.updated_at WHERE removed=1",
+            entries, lambda value, kind, version, now: (value, kind, reason, version, now)) if entries else 0
+        return {"added": added, "unchanged": len(entries) - added, "invalid": invalid[:20], "invalid_count": len(invalid)}
+
+    def remove(self, values) -> dict:
+        entries, invalid = self._normalize(values)
+        removed = self._write(
+            "UPDATE suppression SET removed=1, version=?, updated_at=? WHERE value=? AND removed=0",
+            entries, lambda value, kind, version, now: (version, now, value)) if entries else 0
+        return {"removed": removed, "not_found": len(entries) - removed, "invalid": invalid[:20],
+                "invalid_count": len(invalid)}
+
+    @staticmethod
+    def _normalize(values):
+        entries, invalid = {}, []
+        for value in values:
+            entry = normalize_suppression(value)
+            if entry:
+                entries[entry[0]] = entry[1]
+            else:
+                invalid.append(str(value))
+        return list(entries.items()), invalid
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"emails": len(self._emails), "domains": len(self._domains), "version": self.version,
+                    "checks": self.checks, "hits": self.hits}
+
+suppression = SuppressionList(SUPPRESSION_REFRESH_SECONDS)
+
+EXISTING_LEAD_EMAILS_SQL = "SELECT email FROM leads WHERE campaign_id=? AND email IN ({placeholders})"
+
+def import_leads(cid: int, rows, defaults: dict = None, check_deliverability: bool = False,
+                 progress=None, should_stop=None) -> dict:
+    """按 IMPORT_CHUNK_SIZE 分批验证并用 executemany 写入leads，每批一个事务
+
+    progress(processed, added, skipped, chunk_errors) 在每批提交后调用；should_stop() 返回 True 时
+    在下一批开始前停止（已提交的批次保留）。
+    """
+    defaults = defaults or {}
+    processed, added, skipped = 0, 0, 0
+    errors, seen = [], set()
+
+    suppression.refresh()
+
+    for chunk in chunked(rows, IMPORT_CHUNK_SIZE):
+        if should_stop and should_stop():
+            break
+        candidates, chunk_errors = [], []
+        emails = [str(row.get('email') or '').strip().lower() for row in chunk]
+        # 本批地址去重后统一验证（带缓存）
+        verdicts = email_checks.validate_many([e for e in emails if e], check_deliverability)
+        for email, row in zip(emails, chunk):
+            if not email:
+                chunk_errors.append("空邮箱")
+                continue
+            if verdicts[email]:
+                chunk_errors.append(f"{email}: {verdicts[email]}")
+                continue
+            if suppression.match(email):
+                chunk_errors.append(f"{email}: 在禁发名单中")
+                continue
+            if email in seen:
+                chunk_errors.append(f"{email}: 已存在")
+                continue
+            seen.add(email)
+            candidates.append((email, row))
+
+        # 只查询本批邮箱是否已在campaign中
+        existing = set()
+        emails = [email for email, _ in candidates]
+        with get_db(readonly=True) as conn:
+            for i in range(0, len(emails), 500):
+                part = emails[i:i + 500]
+                existing.update(r[0] for r in conn.execute(
+                    EXISTING_LEAD_EMAILS_SQL.format(placeholders=','.join('?' * len(part))), (cid, *part)).fetchall())
+
+        inserts = []
+        for email, row in candidates:
+            if email in existing:
+                chunk_errors.append(f"{email}: 已存在")
+                continue
+            # 合并默认值和行数据
+            data = {**defaults, **{k: v for k, v in row.items() if k != 'email'}}
+            inserts.append((cid, email, json.dumps(data, default=str)))
+        # 唯一索引兜底：并发导入同一邮箱时忽略后到的一条；只在写入时占用写连接
+        inserted = 0
+        if inserts:
+            with get_db() as conn:
+                inserted = conn.executemany("INSERT OR IGNORE INTO leads(campaign_id, email, data) VALUES(?,?,?)",
+                                            inserts).rowcount
+                conn.commit()
+
+        processed += len(chunk)
+        added += inserted
+        skipped += len(chunk) - inserted
+        if progress:
+            progress(processed, added, skipped, chunk_errors)
+        errors.extend(chunk_errors[:5 - len(errors)])  # 只保留前几条错误信息
+
+    return {"added": added, "skipped": skipped, "errors": errors[:5]}
+
+class ImportJob:
+    """后台导入任务：在 import_executor 中执行，进度保存在内存中供查询"""
+
+    def __init__(self, cid: int, source: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.campaign_id, self.source = cid, source
+        self.status = 'queued'  # queued / running / done / failed / cancelled
+        self.processed = self.added = self.skipped = self.error_count = 0
+        self.errors, self.error = [], None
+        self.created_at, self.finished_at = datetime.now().isoformat(), None
+        self.cancel_event = threading.Event()
+
+    def update(self, processed, added, skipped, errors):
+        self.processed, self.added, self.skipped = processed, added, skipped
+        self.error_count += len(errors)
+        self.errors = (self.errors + errors)[:5]
+
+    def run(self, fn, *args):
+        if self.cancel_event.is_set():
+            self.status = 'cancelled'
+        else:
+            self.status = 'running'
             try:
-                validate_email(email)
-                if email in blacklist or email in existing:
-                    skipped += 1; continue
-                # 合并默认值和行数据
-                data = {**default_values, **{k: v for k, v in row.items() if k != 'email'}}
-                conn.execute("INSERT INTO leads(campaign_id, email, data) VALUES(?,?,?)",
-                            (cid, email, json.dumps(data, default=str)))
-                added += 1
-            except EmailNotValidError:
-                skipped += 1
-        conn.commit()
-    return {"added": added, "skipped": skipped}
+                fn(*args, progress=self.update, should_stop=self.cancel_event.is_set)
+                self.status = 'cancelled' if self.cancel_event.is_set() else 'done'
+            except Exception as e:
+                self.status, self.error = 'failed', str(e)
+                jobs_log.error("Import job %s failed: %s", self.id, e, extra={"campaign": self.campaign_id})
+        self.finished_at = datetime.now().isoformat()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id, "campaign_id": self.campaign_id, "source": self.source, "status": self.status,
+            "processed": self.processed, "added": self.added, "skipped": self.skipped,
+            "error_count": self.error_count, "errors": self.errors, "error": self.error,
+            "created_at": self.created_at, "finished_at": self.finished_at,
+        }
+
+import_executor = ThreadPoolExecutor(max_workers=IMPORT_WORKERS, thread_name_prefix="import")
+import_jobs = OrderedDict()
+import_jobs_lock = threading.Lock()
+
+def submit_import(job: ImportJob, fn, *args) -> dict:
+    with import_jobs_lock:
+        import_jobs[job.id] = job
+        # 只保留最近200个任务的状态
+        while len(import_jobs) > 200:
+            oldest = next(iter(import_jobs.values()))
+            if oldest.finished_at is None:
+                break
+            import_jobs.popitem(last=False)
+    import_executor.submit(job.run, fn, *args)
+    return {"job_id": job.id, "status": job.status}
+
+def import_leads_file(cid: int, path: str, filename: str, defaults: dict = None, **kwargs) -> dict:
+    try:
+        with open(path, 'rb') as f:
+            headers, rows = iter_upload_rows(f, filename)
+            if 'email' not in headers:
+                raise ValueError("文件必须包含email列")
+            return import_leads(cid, rows, defaults, check_deliverability=True, **kwargs)
+    finally:
+        os.unlink(path)
+
+def save_upload(fileobj, suffix: str) -> str:
+    """把上传内容复制到独立的临时文件（请求结束后 UploadFile 会被关闭）"""
+    with tempfile.NamedTemporaryFile(prefix="leads_", suffix=suffix, delete=False) as tmp:
+        shutil.copyfileobj(fileobj, tmp, 1 << 20)
+    return tmp.name
+
+@app.post("/api/campaigns/{cid}/leads")
+async def upload_leads(cid: int, file: UploadFile = File(...), defaults: str = Form("{}")):
+    """上传CSV/Excel，立即返回导入任务ID，解析和写入在后台线程池中执行"""
+    path = await run_in_threadpool(save_upload, file.file, Path(file.filename).suffix)
+    job = ImportJob(cid, file.filename)
+    return submit_import(job, import_leads_file, cid, path, file.filename, json.loads(defaults))
+
+@app.get("/api/imports/{job_id}")
+def get_import(job_id: str):
+    job = import_jobs.get(job_id)
+    if not job: raise HTTPException(404)
+    return job.to_dict()
+
+@app.post("/api/imports/{job_id}/cancel")
+def cancel_import(job_id: str):
+    job = import_jobs.get(job_id)
+    if not job: raise HTTPException(404)
+    job.cancel_event.set()
+    return job.to_dict()
+
+# 收件人列表可返回的列；data 是导入的原始JSON，体积大，需要时通过 fields 显式请求
+LEAD_FIELDS = ("id", "campaign_id", "email", "data", "status", "current_step", "last_sent_at",
+               "opened", "clicked", "replied")
+LEAD_LIST_FIELDS = ("id", "email", "status", "current_step", "last_sent_at", "opened", "clicked", "replied")
+
+def lead_fields(fields: Optional[str]) -> list:
+    """解析逗号分隔的 fields 参数，id 总是包含（用于分页）"""
+    if not fields:
+        return list(LEAD_LIST_FIELDS)
+    names = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in names if f not in LEAD_FIELDS]
+    if unknown:
+        raise HTTPException(400, f"未知字段: {', '.join(unknown)}")
+    return ["id"] + [f for f in dict.fromkeys(names) if f != "id"]
+
+def lead_filters(status: Optional[str] = None, step: Optional[int] = None, opened: Optional[bool] = None,
+                 clicked: Optional[bool] = None, replied: Optional[bool] = None) -> list:
+    """返回 [(条件SQL, 参数)]，列名固定，值全部走参数绑定"""
+    filters = []
+    if status:
+        filters.append(("status=?", status))
+    if step is not None:
+        filters.append(("current_step=?", step))
+    for column, value in (("opened", opened), ("clicked", clicked), ("replied", replied)):
+        if value is not None:
+            filters.append((f"{column}{'>0' if value else '=0'}", None))
+    return filters
+
+def leads_page_query(cid: int, fields: list, filters: list, after_id: int, limit: int):
+    """按 id 做 keyset 分页：WHERE id>? ORDER BY id LIMIT ?，翻页成本不随页码增长"""
+    where = ["campaign_id=?", "id>?"] + [sql for sql, _ in filters]
+    params = [cid, after_id] + [value for _, value in filters if value is not None] + [limit]
+    sql = f"SELECT {', '.join(fields)} FROM leads WHERE {' AND '.join(where)} ORDER BY id LIMIT ?"
+    return sql, params
 
 @app.get("/api/campaigns/{cid}/leads")
-def get_leads(cid: int):
-    with get_db() as conn:
-        rows = conn.execute("SELECT * FROM leads WHERE campaign_id=?", (cid,)).fetchall()
-        return [dict(r) for r in rows]
+def get_leads(cid: int, after_id: int = 0, limit: int = 100, fields: Optional[str] = None,
+              status: Optional[str] = None, step: Optional[int] = None, opened: Optional[bool] = None,
+              clicked: Optional[bool] = None, replied: Optional[bool] = None, with_total: bool = False):
+    """分页返回收件人，下一页用返回的 next_after_id 作为 after_id；with_total=true 时额外返回筛选后的总数"""
+    limit = max(1, min(limit, LEADS_PAGE_MAX))
+    columns = lead_fields(fields)
+    filters = lead_filters(status, step, opened, clicked, replied)
+    sql, params = leads_page_query(cid, columns, filters, after_id, limit)
+    with get_db(readonly=True) as conn:
+        items = [dict(r) for r in conn.execute(sql, params).fetchall()]
+        result = {"items": items, "next_after_id": items[-1]["id"] if len(items) == limit else None}
+        if with_total:
+            where = " AND ".join(["campaign_id=?"] + [f for f, _ in filters])
+            count_params = [cid] + [v for _, v in filters if v is not None]
+            result["total"] = conn.execute(f"SELECT COUNT(*) FROM leads WHERE {where}", count_params).fetchone()[0]
+    return result
+
+def iter_leads(cid: int, fields: list, filters: list):
+    """逐页读取收件人；每页单独借用只读连接，不在导出期间长时间占用连接或读事务"""
+    after_id = 0
+    while True:
+        sql, params = leads_page_query(cid, fields, filters, after_id, EXPORT_CHUNK_SIZE)
+        with get_db(readonly=True) as conn:
+            rows = conn.execute(sql, params).fetchall()
+        yield from rows
+        if len(rows) < EXPORT_CHUNK_SIZE:
+            return
+        after_id = rows[-1]["id"]
+
+def export_ndjson(rows):
+    for row in rows:
+        yield json.dumps(dict(row), ensure_ascii=False) + "\n"
+
+def export_csv(rows, fields: list):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(fields)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(tuple(row))
+        if i % 200 == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+@app.get("/api/campaigns/{cid}/leads/export")
+def export_leads(cid: int, format: str = "ndjson", fields: Optional[str] = None,
+                 status: Optional[str] = None, step: Optional[int] = None, opened: Optional[bool] = None,
+                 clicked: Optional[bool] = None, replied: Optional[bool] = None):
+    """流式导出收件人（ndjson 或 csv），筛选和字段参数与列表接口相同，边读边写不在内存中拼装完整结果"""
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(400, "format 只支持 ndjson 或 csv")
+    columns = lead_fields(fields)
+    rows = iter_leads(cid, columns, lead_filters(status, step, opened, clicked, replied))
+    if format == "csv":
+        return StreamingResponse(export_csv(rows, columns), media_type="text/csv; charset=utf-8",
+                                 headers={"Content-Disposition": f'attachment; filename="campaign_{cid}_leads.csv"'})
+    return StreamingResponse(export_ndjson(rows), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="campaign_{cid}_leads.ndjson"'})
 
 @app.post("/api/campaigns/{cid}/leads/json")
 async def add_leads_json(cid: int, request: Request):
     """支持JSON格式批量导入leads"""
     rows = await request.json()
+    # 使用宽松模式验证邮箱，在后台任务中执行
+    return submit_import(ImportJob(cid, "json"), import_leads, cid, rows)
+
+# 全局禁发名单：条目为完整地址或 "@域名"（也可以不带@），域名条目同时匹配子域名
+
+def suppression_payload(payload, key: str) -> list:
+    """请求体可以是列表，或 {key: [...]} 对象"""
+    values = payload.get(key) if isinstance(payload, dict) else payload
+    if not isinstance(values, list):
+        raise HTTPException(400, f"{key} must be a list")
+    return values
+
+@app.get("/api/suppression")
+def list_suppression(after: str = "", limit: int = 100):
+    """按条目排序分页，after 为上一页最后一个条目"""
+    limit = max(1, min(limit, LEADS_PAGE_MAX))
+    with get_db(readonly=True) as conn:
+        rows = conn.execute(SUPPRESSION_PAGE_SQL, (after, limit)).fetchall()
+    return {"items": [dict(r) for r in rows], "next_after": rows[-1]["value"] if len(rows) == limit else None,
+            **suppression.stats()}
+
+@app.post("/api/suppression")
+async def add_suppression(request: Request):
+    """批量添加：{"entries": ["a@x.com", "@x.com"], "reason": "unsubscribed"}"""
+    payload = await request.json()
+    values = suppression_payload(payload, "entries")
+    reason = payload.get("reason") if isinstance(payload, dict) else None
+    return await run_in_threadpool(suppression.add, values, reason)
+
+def import_suppression_file(path: str, filename: str, reason: Optional[str]) -> dict:
+    try:
+        with open(path, 'rb') as f:
+            headers, rows = iter_upload_rows(f, filename)
+            column = next((h for h in ('email', 'domain', 'value') if h in headers), None)
+            if not column:
+                raise HTTPException(400, "文件必须包含 email / domain / value 列")
+            return suppression.add([row.get(column) for row in rows], reason)
+    finally:
+        os.unlink(path)
+
+@app.post("/api/suppression/upload")
+async def upload_suppression(file: UploadFile = File(...), reason: str = Form("")):
+    """从CSV/Excel批量导入（email / domain / value 列）"""
+    path = await run_in_threadpool(save_upload, file.file, Path(file.filename).suffix)
+    return await run_in_threadpool(import_suppression_file, path, file.filename, reason or None)
+
+@app.post("/api/suppression/remove")
+async def remove_suppression(request: Request):
+    """批量移除：{"entries": [...]}"""
+    values = suppression_payload(await request.json(), "entries")
+    return await run_in_threadpool(suppression.remove, values)
+
+@app.post("/api/suppression/check")
+async def check_suppression(request: Request):
+    """批量检查：{"emails": [...]}，返回在名单中的地址及命中的条目"""
+    emails = suppression_payload(await request.json(), "emails")
+    await run_in_threadpool(suppression.refresh)
+    return {"suppressed": suppression.match_many(str(e) for e in emails)}
+
+def iter_suppression():
+    after = ""
+    while True:
+        with get_db(readonly=True) as conn:
+            rows = conn.execute(SUPPRESSION_PAGE_SQL, (after, EXPORT_CHUNK_SIZE)).fetchall()
+        yield from rows
+        if len(rows) < EXPORT_CHUNK_SIZE:
+            return
+        after = rows[-1]["value"]
 
-    added, skipped = 0, 0
-    errors = []
-    with get_db() as conn:
-        blacklist = {r[0] for r in conn.execute("SELECT email FROM blacklist").fetchall()}
-        existing = {r[0] for r in conn.execute("SELECT email FROM leads WHERE campaign_id=?", (cid,)).fetchall()}
+@app.get("/api/suppression/export")
+def export_suppression(format: str = "csv"):
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(400, "format 只支持 ndjson 或 csv")
+    if format == "csv":
+        return StreamingResponse(export_csv(iter_suppression(), SUPPRESSION_FIELDS), media_type="text/csv; charset=utf-8",
+                                 headers={"Content-Disposition": 'attachment; filename="suppression.csv"'})
+    return StreamingResponse(export_ndjson(iter_suppression()), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": 'attachment; filename="suppression.ndjson"'})
 
-        for row in rows:
-            email = str(row.get('email', '')).strip().lower()
-            if not email:
-                errors.append("空邮箱")
-                skipped += 1
-                continue
-            try:
-                # 使用宽松模式验证邮箱
-                validate_email(email, check_deliverability=False)
-                if email in blacklist:
-                    errors.append(f"{email}: 在黑名单中")
-                    skipped += 1
-                    continue
-                if email in existing:
-                    errors.append(f"{email}: 已存在")
-                    skipped += 1
-                    continue
-                data = {k: v for k, v in row.items() if k != 'email'}
-                conn.execute("INSERT INTO leads(campaign_id, email, data) VALUES(?,?,?)",
-                            (cid, email, json.dumps(data, default=str)))
-                existing.add(email)
-                added += 1
-            except EmailNotValidError as e:
-                errors.append(f"{email}: {str(e)}")
-                skipped += 1
-        conn.commit()
-    return {"added": added, "skipped": skipped, "errors": errors[:5]}
+TEMPLATE_BY_STEP_SQL = "SELECT * FROM templates WHERE campaign_id=? AND step=?"
 
 @app.get("/api/campaigns/{cid}/preview")
 def preview_email(cid: int, lead_id: int, step: int = 1):
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         lead = conn.execute("SELECT * FROM leads WHERE id=?", (lead_id,)).fetchone()
-        tpl = conn.execute("SELECT * FROM templates WHERE campaign_id=? AND step=?", (cid, step)).fetchone()
+        tpl = conn.execute(TEMPLATE_BY_STEP_SQL, (cid, step)).fetchone()
         if not lead or not tpl: raise HTTPException(404)
-        data = json.loads(lead['data'])
-        data['email'] = lead['email']
-        return {
-            "subject": Template(tpl['subject']).render(**data),
-            "body": Template(tpl['body']).render(**data)
-        }
+        _, subject, body = next(render_bulk(tpl, [lead]))
+        return {"subject": subject, "body": body}
+
+LEADS_PAGE_SQL = "SELECT id, email, data FROM leads WHERE campaign_id=? AND id>? ORDER BY id LIMIT ?"
+
+@app.get("/api/campaigns/{cid}/preview/bulk")
+def preview_bulk(cid: int, step: int = 1, after_id: int = 0, limit: int = 100):
+    """批量预览：用同一步模板渲染多个lead（按id分页）"""
+    limit = max(1, min(limit, 5000))
+    with get_db(readonly=True) as conn:
+        tpl = conn.execute(TEMPLATE_BY_STEP_SQL, (cid, step)).fetchone()
+        if not tpl: raise HTTPException(404)
+        leads = conn.execute(LEADS_PAGE_SQL, (cid, after_id, limit)).fetchall()
+    items = [{"lead_id": lead['id'], "email": lead['email'], "subject": subject, "body": body}
+             for lead, subject, body in render_bulk(tpl, leads)]
+    return {"items": items, "next_after_id": items[-1]['lead_id'] if len(items) == limit else None}
 
 @app.post("/api/campaigns/{cid}/launch")
-def launch_campaign(cid: int, account_email: str = Form(...), interval_minutes: int = Form(5)):
-    with get_db() as conn:
-        conn.execute("UPDATE campaigns SET status='running', account_email=?, interval_minutes=? WHERE id=?",
-                    (account_email, interval_minutes, cid))
-        conn.commit()
+async def launch_campaign(cid: int, account_email: str = Form(...), interval_minutes: int = Form(5),
+                          batch_size: int = Form(SEND_BATCH_SIZE), daily_limit: int = Form(0)):
+    batch_size = max(1, batch_size)
 
-    # 立即发送第一封邮件
-    process_campaign(cid, account_email)
+    def save():
+        with get_db() as conn:
+            changed = conn.execute(
+                "UPDATE campaigns SET status='running', account_email=?, interval_minutes=?, batch_size=?, daily_limit=? "
+                f"WHERE id=? AND status NOT IN {CAMPAIGN_LOCKED_STATUSES}",
+                (account_email, interval_minutes, batch_size, max(0, daily_limit), cid)).rowcount
+            conn.commit()
+        return changed
+    if not await run_in_threadpool(save):
+        raise HTTPException(409, "Campaign 不存在或已归档/删除")
 
-    # 添加定时任务继续发送后续邮件
-    scheduler.add_job(process_campaign, 'interval', minutes=interval_minutes,
-                      args=[cid, account_email], id=f"campaign_{cid}", replace_existing=True)
-    return {"ok": True, "msg": f"已启动，立即发送第一封，之后每{interval_minutes}分钟发送一封"}
+    # 交给发送引擎立即开始第一批，请求不等待发送
+    send_engine.launch(cid, account_email)
+    return {"ok": True, "msg": f"已启动，立即发送第一批，之后每{interval_minutes}分钟最多发送{batch_size}封（同时受账号速率和每日上限限制）"}
 
 @app.get("/api/campaigns/{cid}")
 def get_campaign(cid: int):
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         row = conn.execute("SELECT * FROM campaigns WHERE id=?", (cid,)).fetchone()
         if not row: raise HTTPException(404)
         return dict(row)
 
 @app.post("/api/campaigns/{cid}/stop")
-def stop_campaign(cid: int):
-    with get_db() as conn:
-        conn.execute("UPDATE campaigns SET status='paused' WHERE id=?", (cid,))
-        conn.commit()
-    try: scheduler.remove_job(f"campaign_{cid}")
-    except: pass
+async def stop_campaign(cid: int):
+    def save():
+        with get_db() as conn:
+            conn.execute(f"UPDATE campaigns SET status='paused' WHERE id=? AND status NOT IN {CAMPAIGN_LOCKED_STATUSES}", (cid,))
+            conn.commit()
+    await run_in_threadpool(save)
+    send_engine.cancel(cid)
     return {"ok": True}
 
-@app.delete("/api/campaigns/{cid}")
-def delete_campaign(cid: int):
-    """删除 campaign 及其所有相关数据"""
-    # 停止 scheduler job
-    try:
-        scheduler.remove_job(f"campaign_{cid}")
-    except:
-        pass
+# ============================================
+# Campaign 删除和归档：后台分批执行，每批一个短事务
+# ============================================
 
-    # 删除数据库记录
+# 这些状态的campaign正在（或已经）移出热数据，不能再启动或暂停
+CAMPAIGN_LOCKED_STATUSES = ('archiving', 'archived', 'deleting')
+# 按 campaign 分批读取/删除，均走 campaign_id 开头的索引
+CAMPAIGN_CHUNK_SQL = {
+    "leads": "SELECT * FROM leads WHERE campaign_id=? ORDER BY id LIMIT ?",
+    "events": "SELECT * FROM events WHERE campaign_id=? ORDER BY id LIMIT ?",
+}
+# 其他 worker 仍持有租约的发送任务不删除，等它发送完成或租约过期
+CAMPAIGN_QUEUE_CHUNK_SQL = """
+    DELETE FROM send_queue WHERE id IN (SELECT id FROM send_queue WHERE campaign_id=?
+        AND NOT (status='in_flight' AND due_at>?) LIMIT ?)
+"""
+CAMPAIGN_QUEUE_LEASED_SQL = "SELECT MIN(due_at) FROM send_queue WHERE campaign_id=? AND status='in_flight' AND due_at>?"
+
+# 只有已经没有待发送收件人的campaign可以归档，还有pending的lead不能移到归档库
+START_ARCHIVE_SQL = """
+    UPDATE campaigns SET status='archiving' WHERE id=? AND status IN ('draft', 'paused', 'running')
+        AND IFNULL((SELECT pending FROM campaign_counters WHERE campaign_id=campaigns.id), 0) = 0
+"""
+
+def set_campaign_status(cid: int, sql: str, params: tuple) -> bool:
     with get_db() as conn:
-        conn.execute("DELETE FROM leads WHERE campaign_id=?", (cid,))
-        conn.execute("DELETE FROM templates WHERE campaign_id=?", (cid,))
-        conn.execute("DELETE FROM campaigns WHERE id=?", (cid,))
+        changed = conn.execute(sql, params).rowcount
         conn.commit()
+    return bool(changed)
+
+def open_archive():
+    """归档库：每个块是一批行（leads 或 events）的 zlib 压缩 JSON，columns 为列名"""
+    conn = sqlite3.connect(ARCHIVE_DB_PATH, timeout=30.0)
+    conn.execute("PRAGMA busy_timeout=30000")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS archived_chunks (
+            campaign_id INTEGER NOT NULL, kind TEXT NOT NULL, first_id INTEGER NOT NULL, rows INTEGER NOT NULL,
+            columns TEXT NOT NULL, data BLOB NOT NULL, archived_at REAL NOT NULL,
+            PRIMARY KEY(campaign_id, kind, first_id)
+        ) WITHOUT ROWID
+    """)
+    return conn
 
-    return {"ok": True, "msg": "Campaign 已删除"}
+class CampaignJob:
+    """后台删除/归档一个campaign，进度保存在内存中供查询
 
-def send_gmail(account_email: str, to: str, subject: str, body: str) -> bool:
-    if TEST_MODE:
-        print(f"[TEST MODE] Would send email:")
-        print(f"  From: {account_email}")
-        print(f"  To: {to}")
-        print(f"  Subject: {subject}")
-        print(f"  Body: {body[:200]}...")
-        return True
+    多个进程通过 job:campaign:<id> 租约保证同一campaign只有一个进程在处理；每批处理后续租，
+    进程中途退出时由其他进程的 resume_campaign_jobs 从剩余数据继续（已处理的批次不会重复）。
+    """
 
-    with get_db() as conn:
-        row = conn.execute("SELECT token FROM accounts WHERE email=?", (account_email,)).fetchone()
-        if not row: return False
-    creds = Credentials.from_authorized_user_info(json.loads(row['token']))
-    service = build('gmail', 'v1', credentials=creds)
+    def __init__(self, cid: int, kind: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.campaign_id, self.kind = cid, kind  # kind: delete / archive
+        self.status = 'queued'  # queued / running / done / failed / skipped（其他进程正在处理）
+        self.processed = {}
+        self.error = None
+        self.created_at, self.finished_at = datetime.now().isoformat(), None
+        self.lease = f"job:campaign:{cid}"
+
+    def run(self):
+        if not acquire_lease(self.lease, 300):
+            self.status, self.finished_at = 'skipped', datetime.now().isoformat()
+            return
+        self.status = 'running'
+        try:
+            if self.kind == 'archive':
+                self.archive()
+            else:
+                self.delete()
+            self.status = 'done'
+            jobs_log.info("%s campaign %s: %s", self.kind, self.campaign_id, self.processed, extra={"campaign": self.campaign_id})
+        except Exception as e:
+            self.status, self.error = 'failed', str(e)
+            jobs_log.error("%s campaign %s failed: %s", self.kind, self.campaign_id, e, extra={"campaign": self.campaign_id})
+        finally:
+            release_lease(self.lease)
+            self.finished_at = datetime.now().isoformat()
+
+    def _next_batch(self, table: str, n: int):
+        """记录进度、续租，并暂停一下让其他写入拿到写连接"""
+        self.processed[table] = self.processed.get(table, 0) + n
+        acquire_lease(self.lease, 300)
+        time.sleep(MAINTENANCE_PAUSE_MS / 1000)
+
+    def _delete_queue(self):
+        """删除发送队列；正在发送的任务等到发送完成或租约过期后再删除，避免删掉其他 worker 正在发送的邮件"""
+        while True:
+            now = time.time()
+            with get_db() as conn:
+                n = conn.execute(CAMPAIGN_QUEUE_CHUNK_SQL, (self.campaign_id, now, MAINTENANCE_CHUNK_SIZE)).rowcount
+                conn.commit()
+            self._next_batch("send_queue", n)
+            if n == MAINTENANCE_CHUNK_SIZE:
+                continue
+            with get_db(readonly=True) as conn:
+                leased_until = conn.execute(CAMPAIGN_QUEUE_LEASED_SQL, (self.campaign_id, now)).fetchone()[0]
+            if leased_until is None:
+                return
+            time.sleep(min(max(leased_until - time.time(), 0), 5))
+
+    def delete(self):
+        cid = self.campaign_id
+        self._delete_queue()
+        for table in CAMPAIGN_CHUNK_SQL:
+            while True:
+                with get_db() as conn:
+                    n = conn.execute(f"DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE campaign_id=? LIMIT ?)",
+                                     (cid, MAINTENANCE_CHUNK_SIZE)).rowcount
+                    conn.commit()
+                self._next_batch(table, n)
+                if n < MAINTENANCE_CHUNK_SIZE:
+                    break
+        # 剩下的表每个campaign只有少量行
+        with get_db() as conn:
+            for table in ("event_counts_hourly", "event_counts_daily", "templates", "campaign_counters", "links"):
+                conn.execute(f"DELETE FROM {table} WHERE campaign_id=?", (cid,))
+            conn.execute("DELETE FROM campaigns WHERE id=?", (cid,))
+            conn.commit()
+        links_cache.evict_campaign(cid)
+        if os.path.exists(ARCHIVE_DB_PATH):
+            archive = open_archive()
+            try:
+                archive.execute("DELETE FROM archived_chunks WHERE campaign_id=?", (cid,))
+                archive.commit()
+            finally:
+                archive.close()
+
+    def archive(self):
+        """leads 和 events 按批压缩写入归档库后从热表删除；计数器和按小时/天的汇总保留，统计照常可查
+
+        先提交归档块再删除热数据：中途退出时同一批会以相同的 first_id 重新写入（覆盖），不会重复。
+        """
+        cid = self.campaign_id
+        self._delete_queue()
+        archive = open_archive()
+        try:
+            for table, select_sql in CAMPAIGN_CHUNK_SQL.items():
+                while True:
+                    with get_db(readonly=True) as conn:
+                        cursor = conn.execute(select_sql, (cid, MAINTENANCE_CHUNK_SIZE))
+                        columns = [d[0] for d in cursor.description]
+                        rows = [tuple(r) for r in cursor.fetchall()]
+                    if not rows:
+                        break
+                    data = zlib.compress(json.dumps(rows, ensure_ascii=False, default=str).encode(), 6)
+                    archive.execute("INSERT OR REPLACE INTO archived_chunks(campaign_id, kind, first_id, rows, columns, "
+                                    "data, archived_at) VALUES(?,?,?,?,?,?,?)",
+                                    (cid, table, rows[0][0], len(rows), json.dumps(columns), data, time.time()))
+                    archive.commit()
+                    with get_db() as conn:
+                        conn.executemany(f"DELETE FROM {table} WHERE id=?", [(r[0],) for r in rows])
+                        conn.commit()
+                    self._next_batch(table, len(rows))
+                    if len(rows) < MAINTENANCE_CHUNK_SIZE:
+                        break
+        finally:
+            archive.close()
+        set_campaign_status(cid, "UPDATE campaigns SET status='archived' WHERE id=? AND status='archiving'", (cid,))
+
+    def to_dict(self) -> dict:
+        return {"id": self.id, "campaign_id": self.campaign_id, "kind": self.kind, "status": self.status,
+                "processed": self.processed, "error": self.error,
+                "created_at": self.created_at, "finished_at": self.finished_at}
+
+# 同一时间只处理一个campaign，避免多个大批量删除一起抢写连接
+maintenance_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="maintenance")
+campaign_jobs = OrderedDict()
+
+def submit_campaign_job(cid: int, kind: str) -> CampaignJob:
+    job = CampaignJob(cid, kind)
+    with import_jobs_lock:
+        campaign_jobs[job.id] = job
+        while len(campaign_jobs) > 200 and next(iter(campaign_jobs.values())).finished_at:
+            campaign_jobs.popitem(last=False)
+    maintenance_executor.submit(job.run)
+    return job
+
+def resume_campaign_jobs():
+    """继续处理状态停留在 archiving / deleting 的campaign（处理它们的进程已退出）"""
+    with get_db(readonly=True) as conn:
+        rows = conn.execute("SELECT id, status FROM campaigns WHERE status IN ('archiving', 'deleting')").fetchall()
+    active = {(job.campaign_id, job.kind) for job in campaign_jobs.values() if job.finished_at is None}
+    for row in rows:
+        kind = 'archive' if row['status'] == 'archiving' else 'delete'
+        if (row['id'], kind) not in active:
+            submit_campaign_job(row['id'], kind)
+
+@app.delete("/api/campaigns/{cid}")
+async def delete_campaign(cid: int):
+    """删除 campaign 及其所有相关数据：标记为 deleting 后在后台分批删除，请求立即返回"""
+    if not await run_in_threadpool(set_campaign_status, cid,
+                                   "UPDATE campaigns SET status='deleting' WHERE id=? AND status!='deleting'", (cid,)):
+        raise HTTPException(404, "Campaign 不存在或正在删除")
+    # 停止发送
+    send_engine.cancel(cid)
+    job = submit_campaign_job(cid, 'delete')
+    return {"ok": True, "msg": "Campaign 正在后台删除", "job": job.to_dict()}
+
+@app.post("/api/campaigns/{cid}/archive")
+async def archive_campaign(cid: int):
+    """把已发送完的campaign的 leads 和 events 移到归档库，统计数字保留；还有待发送收件人时返回 409"""
+    if not await run_in_threadpool(set_campaign_status, cid, START_ARCHIVE_SQL, (cid,)):
+        raise HTTPException(409, "只能归档没有待发送收件人的 Campaign")
+    send_engine.cancel(cid)
+    job = submit_campaign_job(cid, 'archive')
+    return {"ok": True, "msg": "Campaign 正在后台归档", "job": job.to_dict()}
+
+@app.get("/api/campaign-jobs/{job_id}")
+def get_campaign_job(job_id: str):
+    job = campaign_jobs.get(job_id)
+    if not job: raise HTTPException(404)
+    return job.to_dict()
+
+def iter_archived(cid: int, kind: str):
+    """逐块读取归档；StreamingResponse 每次 next() 可能在不同的线程池线程中执行，每块单独打开连接"""
+    first_id = -1
+    while True:
+        archive = open_archive()
+        try:
+            chunk = archive.execute("SELECT first_id, columns, data FROM archived_chunks WHERE campaign_id=? AND kind=? "
+                                    "AND first_id>? ORDER BY first_id LIMIT 1", (cid, kind, first_id)).fetchone()
+        finally:
+            archive.close()
+        if not chunk:
+            return
+        first_id = chunk[0]
+        columns = json.loads(chunk[1])
+        for row in json.loads(zlib.decompress(chunk[2])):
+            yield dict(zip(columns, row))
+
+@app.get("/api/campaigns/{cid}/archive/export")
+def export_archived(cid: int, kind: str = "leads"):
+    """流式导出归档的 leads 或 events（ndjson），每次只解压一个块"""
+    if kind not in CAMPAIGN_CHUNK_SQL:
+        raise HTTPException(400, "kind 只支持 leads 或 events")
+    return StreamingResponse(export_ndjson(iter_archived(cid, kind)), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="campaign_{cid}_{kind}.ndjson"'})
+
+# ============================================
+# Gmail service 缓存
+# ============================================
+
+class GmailServiceCache:
+    """按账号缓存 Credentials 和 Gmail service，TTL + LRU 淘汰，可跨线程共享
+
+    service 通过 requestBuilder 为每个请求创建独立的 http 对象（httplib2 不是线程安全的），
+    token 刷新后写回 accounts.token，下次冷启动不需要再刷新一次。
+    """
+
+    class _Entry:
+        __slots__ = ('service', 'creds', 'created_at', 'saved_token', 'lock')
+
+        def __init__(self, service, creds, saved_token):
+            self.service, self.creds, self.saved_token = service, creds, saved_token
+            self.created_at = time.monotonic()
+            self.lock = threading.Lock()
+
+    def __init__(self, ttl: int, maxsize: int):
+        self.ttl, self.maxsize = ttl, maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.refreshes = 0
+        self.build_seconds = 0.0
+
+    def get(self, account_email: str):
+        """返回账号的 Gmail service，账号不存在时返回 None"""
+        entry = self._entry(account_email)
+        return entry.service if entry else None
+
+    def credentials(self, account_email: str):
+        """返回账号已刷新的 Credentials（异步发送直接使用 access token），账号不存在时返回 None"""
+        entry = self._entry(account_email)
+        return entry.creds if entry else None
+
+    def _entry(self, account_email: str):
+        with self._lock:
+            entry = self._entries.get(account_email)
+            if entry and time.monotonic() - entry.created_at < self.ttl:
+                self._entries.move_to_end(account_email)
+                self.hits += 1
+            else:
+                if entry:
+                    del self._entries[account_email]
+                    self.evictions += 1
+                entry = None
+                self.misses += 1
+
+        if entry is None:
+            entry = self._build(account_email)
+            if entry is None:
+                return None
+            with self._lock:
+                self._entries[account_email] = entry
+                self._entries.move_to_end(account_email)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+
+        self._ensure_fresh(account_email, entry)
+        return entry
+
+    def invalidate(self, account_email: str):
+        with self._lock:
+            self._entries.pop(account_email, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._entries)
+        lookups = self.hits + self.misses
+        return {
+            "size": size, "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "refreshes": self.refreshes, "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+            # 平均构建耗时 × 命中次数 ≈ 缓存节省的时间
+            "avg_build_seconds": round(self.build_seconds / self.misses, 4) if self.misses else 0,
+        }
+
+    def _build(self, account_email: str):
+        with get_db(readonly=True) as conn:
+            row = conn.execute("SELECT token FROM accounts WHERE email=?", (account_email,)).fetchone()
+        if not row:
+            return None
+        started = time.monotonic()
+        creds = Credentials.from_authorized_user_info(json.loads(row['token']))
+
+        def request_builder(http, *args, **kwargs):
+            return TimedHttpRequest(AuthorizedHttp(creds, http=httplib2.Http()), *args, **kwargs)
+
+        client_options = {"api_endpoint": GMAIL_API_ENDPOINT.rstrip('/') + '/'} if GMAIL_API_ENDPOINT else None
+        service = build('gmail', 'v1', http=AuthorizedHttp(creds, http=httplib2.Http()),
+                        requestBuilder=request_builder, cache_discovery=False, client_options=client_options)
+        self.build_seconds += time.monotonic() - started
+        return self._Entry(service, creds, creds.token)
+
+    def _ensure_fresh(self, account_email: str, entry):
+        """token 过期时主动刷新；token 有变化（包括请求中自动刷新的）就写回数据库"""
+        with entry.lock:
+            creds = entry.creds
+            if not creds.valid and creds.refresh_token:
+                creds.refresh(GoogleAuthRequest())
+                self.refreshes += 1
+            if creds.token != entry.saved_token:
+                with get_db() as conn:
+                    conn.execute("UPDATE accounts SET token=? WHERE email=?", (creds.to_json(), account_email))
+                    conn.commit()
+                entry.saved_token = creds.token
+
+gmail_services = GmailServiceCache(GMAIL_CACHE_TTL, GMAIL_CACHE_SIZE)
+
+class TimedHttpRequest(HttpRequest):
+    """googleapiclient 请求，执行时记录耗时（pitch_gmail_api_seconds，api 为去掉 gmail.users. 前缀的方法名）"""
+
+    def execute(self, *args, **kwargs):
+        api = (self.methodId or "unknown").removeprefix("gmail.users.")
+        started, status = time.perf_counter(), "error"
+        try:
+            result = super().execute(*args, **kwargs)
+            status = 200
+            return result
+        except HttpError as e:
+            status = e.resp.status
+            raise
+        finally:
+            gmail_api_seconds.observe(time.perf_counter() - started, api=api, status=status)
+
+def new_gmail_batch(service, callback):
+    if GMAIL_API_ENDPOINT:
+        return BatchHttpRequest(callback=callback, batch_uri=f"{GMAIL_API_ENDPOINT.rstrip('/')}/batch/gmail/v1")
+    return service.new_batch_http_request(callback=callback)
+
+def list_message_ids(service, query: str, limit: int) -> list:
+    """分页列出匹配查询的邮件ID，最多 limit 个"""
+    ids, page_token = [], None
+    while len(ids) < limit:
+        resp = service.users().messages().list(
+            userId='me', q=query, maxResults=min(500, limit - len(ids)), pageToken=page_token
+        ).execute()
+        ids.extend(m['id'] for m in resp.get('messages', []))
+        page_token = resp.get('nextPageToken')
+        if not page_token:
+            break
+    return ids[:limit]
+
+def fetch_message_headers(service, message_ids, names=('From', 'Date')):
+    """用 Gmail batch 请求分块获取邮件头，返回 ({message_id: {header_name: value}}, 获取失败的ID列表)
+
+    每块 GMAIL_BATCH_SIZE 个子请求只需一次 HTTP 往返；被限流的子请求等待后重试一次。
+    已被删除（404）的邮件不算失败，也不出现在结果中。
+    """
+    results, failed = {}, []
+
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            if not (isinstance(exception, HttpError) and exception.resp.status == 404):
+                failed.append(request_id)
+            return
+        headers = response.get('payload', {}).get('headers', [])
+        results[request_id] = {h['name']: h['value'] for h in headers}
+
+    pending = list(dict.fromkeys(message_ids))
+    for attempt in range(2):
+        for i in range(0, len(pending), GMAIL_BATCH_SIZE):
+            batch = new_gmail_batch(service, on_response)
+            for mid in pending[i:i + GMAIL_BATCH_SIZE]:
+                batch.add(service.users().messages().get(userId='me', id=mid, format='metadata',
+                                                         metadataHeaders=list(names)), request_id=mid)
+            started = time.perf_counter()
+            batch.execute()
+            gmail_api_seconds.observe(time.perf_counter() - started, api="batch", status=200)
+        if not failed or attempt:
+            break
+        pending = failed[:]
+        failed.clear()
+        time.sleep(1)
+    if failed:
+        replies_log.warning("Gmail batch: %d message(s) failed to load", len(failed))
+    return results, failed
+
+def build_raw_message(to: str, subject: str, body: str, message_id: Optional[str] = None) -> str:
     msg = MIMEMultipart('alternative')
     msg['To'], msg['Subject'] = to, subject
+    if message_id:
+        msg['Message-ID'] = message_id
     msg.attach(MIMEText(body, 'html'))
-    raw = base64.urlsafe_b64encode(msg.as_bytes()).decode()
-    service.users().messages().send(userId='me', body={'raw': raw}).execute()
-    return True
+    return base64.urlsafe_b64encode(msg.as_bytes()).decode()
+
+def send_message_id(account_email: str, idempotency_key: str) -> str:
+    """由发送任务的 idempotency_key 生成固定的 Message-ID，重试时可以在 Gmail 中查到上次是否已经发出"""
+    return f"<pitch.{idempotency_key.replace(':', '.')}@{account_email.rsplit('@', 1)[-1]}>"
 
-def check_replies(cid: int, account_email: str):
-    """检查收件箱，标记已回复的leads"""
+def log_test_send(account_email: str, to: str, subject: str, body: str):
+    send_log.info("[TEST MODE] Would send email from %s to %s: %s", account_email, to, subject,
+                  extra={"account": account_email, "body": body[:200]})
+
+async def gmail_request(client: httpx.AsyncClient, account_email: str, method: str, url: str, api: str,
+                        **kwargs) -> httpx.Response:
+    """带账号凭据的 Gmail REST 请求；token 失效（401）时重新加载账号凭据重试一次，其他错误抛出异常
+
+    api 为指标中的接口名（pitch_gmail_api_seconds 的 api 标签）。
+    """
+    for attempt in range(2):
+        creds = await asyncio.to_thread(gmail_services.credentials, account_email)
+        if not creds:
+            raise RuntimeError(f"No credentials for {account_email}")
+        started = time.perf_counter()
+        try:
+            resp = await client.request(method, url, headers={"Authorization": f"Bearer {creds.token}"}, **kwargs)
+        except Exception:
+            gmail_api_seconds.observe(time.perf_counter() - started, api=api, status="error")
+            raise
+        gmail_api_seconds.observe(time.perf_counter() - started, api=api, status=resp.status_code)
+        if resp.status_code == 401 and attempt == 0:
+            gmail_services.invalidate(account_email)
+            continue
+        resp.raise_for_status()
+        return resp
+
+async def send_gmail_async(client: httpx.AsyncClient, account_email: str, to: str, subject: str, body: str,
+                           message_id: Optional[str] = None) -> str:
+    """通过 Gmail REST 接口异步发送，返回 Gmail 邮件ID"""
     if TEST_MODE:
-        print(f"[TEST MODE] Skipping reply check for campaign {cid}")
+        log_test_send(account_email, to, subject, body)
+        return "test"
+    resp = await gmail_request(client, account_email, "POST", "gmail/v1/users/me/messages/send", "messages.send",
+                               json={"raw": build_raw_message(to, subject, body, message_id)})
+    return resp.json().get("id", "")
+
+async def find_sent_message(client: httpx.AsyncClient, account_email: str, message_id: str) -> Optional[str]:
+    """按 Message-ID 查找账号中已有的邮件（rfc822msgid 搜索），返回 Gmail 邮件ID"""
+    if TEST_MODE:
+        return None
+    resp = await gmail_request(client, account_email, "GET", "gmail/v1/users/me/messages", "messages.list",
+                               params={"q": f"rfc822msgid:{message_id}", "maxResults": 1})
+    messages = resp.json().get("messages") or []
+    return messages[0]["id"] if messages else None
+
+def fetch_new_inbox_ids(service, history_id: Optional[str]):
+    """返回 (新收件邮件ID列表, 最新historyId)
+
+    有 historyId 时只通过 history.list 拉取之后新增的收件邮件；首次运行或 historyId
+    已过期（404）时退回到扫描最近7天的收件箱。
+    """
+    if history_id:
+        try:
+            ids, page_token, latest = [], None, history_id
+            while True:
+                resp = service.users().history().list(
+                    userId='me', startHistoryId=history_id, historyTypes=['messageAdded'],
+                    labelId='INBOX', maxResults=500, pageToken=page_token
+                ).execute()
+                for record in resp.get('history', []):
+                    for added in record.get('messagesAdded', []):
+                        ids.append(added['message']['id'])
+                latest = resp.get('historyId', latest)
+                page_token = resp.get('nextPageToken')
+                if not page_token:
+                    return list(dict.fromkeys(ids)), latest
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            replies_log.info("historyId %s expired, rescanning inbox", history_id)
+
+    # 先取当前historyId再扫描，保证扫描期间新到的邮件下次不会漏掉
+    latest = service.users().getProfile(userId='me').execute()['historyId']
+    return list_message_ids(service, 'in:inbox newer_than:7d', REPLY_SCAN_LIMIT), latest
+
+def parse_sender(from_header: str) -> str:
+    match = re.search(r'<(.+?)>', from_header)
+    return (match.group(1) if match else from_header).lower().strip()
+
+def is_reply_after(date_header: str, last_sent_at: str) -> bool:
+    """邮件是在我们发送之后收到的，才算作回复"""
+    from email.utils import parsedate_to_datetime
+    from dateutil import parser as dateparser
+    received_time = parsedate_to_datetime(date_header)
+    sent_time = dateparser.parse(last_sent_at)
+    # 统一转换为 naive datetime（移除时区信息）以便比较
+    if received_time.tzinfo is not None:
+        received_time = received_time.replace(tzinfo=None)
+    if sent_time.tzinfo is not None:
+        sent_time = sent_time.replace(tzinfo=None)
+    return received_time > sent_time
+
+REPLY_CANDIDATES_SQL = """
+    SELECT l.id, l.email, l.last_sent_at FROM leads l JOIN campaigns c ON c.id = l.campaign_id
+    WHERE c.account_email=? AND l.replied=0 AND l.last_sent_at IS NOT NULL AND l.email IN ({placeholders})
+"""
+
+def check_replies(account_email: str):
+    """增量检查账号收件箱，一次匹配该账号下所有campaign的leads并标记已回复"""
+    if TEST_MODE:
+        replies_log.info("[TEST MODE] Skipping reply check for %s", account_email)
         return
 
     try:
-        # 首先获取认证信息和leads列表（快速查询，避免长时间持有连接）
+        service = gmail_services.get(account_email)
+        if not service:
+            return
+
+        with get_db(readonly=True) as conn:
+            row = conn.execute("SELECT history_id FROM gmail_sync_state WHERE account_email=?",
+                               (account_email,)).fetchone()
+
+        # 释放数据库连接后再进行Gmail API调用（耗时操作）
+        message_ids, latest_history_id = fetch_new_inbox_ids(service, row['history_id'] if row else None)
+        headers_by_id, failed = fetch_message_headers(service, message_ids)
+        senders = {}
+        for headers in headers_by_id.values():
+            senders.setdefault(parse_sender(headers.get('From', '')), []).append(headers.get('Date', ''))
+
+        # 只查询新邮件发件人对应的leads（只检查已经发送过邮件的leads）
+        replied_lead_ids = []
+        emails = list(senders)
+        with get_db(readonly=True) as conn:
+            for i in range(0, len(emails), 500):
+                chunk = emails[i:i + 500]
+                leads = conn.execute(REPLY_CANDIDATES_SQL.format(placeholders=','.join('?' * len(chunk))),
+                                     (account_email, *chunk)).fetchall()
+                for lead in leads:
+                    try:
+                        if any(is_reply_after(date, lead['last_sent_at']) for date in senders[lead['email'].lower()]):
+                            replied_lead_ids.append((lead['id'], lead['email']))
+                    except Exception as e:
+                        replies_log.warning("Date parse error, skipping lead %s: %s", lead['id'], e)
+
+        # 批量更新数据库并记录同步位置（一次性提交，减少锁定时间）
         with get_db() as conn:
-            row = conn.execute("SELECT token FROM accounts WHERE email=?", (account_email,)).fetchone()
-            if not row:
-                return
+            now = datetime.now().isoformat()
+            record_events(conn, [(lead_id, 'reply', now) for lead_id, _ in replied_lead_ids])
+            for lead_id, sender in replied_lead_ids:
+                conn.execute("UPDATE leads SET replied=1, status='replied' WHERE id=?", (lead_id,))
+                replies_log.info("Lead %s (%s) replied", lead_id, sender, extra={"account": account_email})
+            # 有邮件没取到（如被限流）时保留原来的同步位置，下次重新检查这些邮件；已标记回复的lead不会重复计入
+            if not failed:
+                conn.execute("INSERT OR REPLACE INTO gmail_sync_state(account_email, history_id, updated_at) "
+                             "VALUES(?, ?, CURRENT_TIMESTAMP)", (account_email, str(latest_history_id)))
+            conn.commit()
 
-            token_json = row['token']
+    except Exception as e:
+        replies_log.error("Check failed for %s: %s", account_email, e, extra={"account": account_email})
 
-            # 获取该campaign所有未回复的lead邮箱
-            # 重要：只检查已经发送过邮件的leads (last_sent_at IS NOT NULL)
-            leads = conn.execute(
-                "SELECT id, email, last_sent_at FROM leads WHERE campaign_id=? AND replied=0 AND last_sent_at IS NOT NULL", (cid,)
-            ).fetchall()
-            if not leads:
-                return
+def tracking_pixel(lead_id: int) -> str:
+    # 支持两种追踪服务：
+    # 1. 使用Render上的tracker.py: TRACKER_URL=https://your-tracker.onrender.com
+    # 2. 使用本地追踪服务: BASE_URL=http://your-vps-ip
+    tracker_url = os.environ.get("TRACKER_URL", "")
+    if tracker_url:
+        # 使用外部追踪服务（如Render上的tracker.py）
+        return f'<img src="{tracker_url}/open?uid={lead_id}" width="1" height="1" style="display:none">'
+    # 使用本地追踪服务
+    base_url = os.environ.get("BASE_URL", "http://localhost:8000")
+    return f'<img src="{base_url}/track/open/{lead_id}" width="1" height="1" style="display:none">'
+
+SENT_TODAY_SQL = "SELECT COUNT(*) FROM leads WHERE campaign_id=? AND last_sent_at >= ?"
+
+def sent_today(conn, cid: int) -> int:
+    """今天已发送数量（用于每日预算）"""
+    today = datetime.now().date().isoformat()
+    return conn.execute(SENT_TODAY_SQL, (cid, today)).fetchone()[0]
+
+def render_due_leads(leads):
+    """逐个渲染待发送的lead，生成 (lead, subject, body)；缺少模板的lead返回 (lead, None, None)"""
+    compiled = {}
+    for lead in leads:
+        if lead['subject'] is None:
+            yield lead, None, None
+            continue
+        if lead['template_id'] not in compiled:
+            compiled[lead['template_id']] = templates_cache.get(
+                {"id": lead['template_id'], "subject": lead['subject'], "body": lead['body']})
+        subject_tpl, body_tpl = compiled[lead['template_id']]
+        started = time.perf_counter()
+        data = lead_context(lead)
+        subject, body = subject_tpl.render(data), body_tpl.render(data) + tracking_pixel(lead['id'])
+        render_seconds.observe(time.perf_counter() - started)
+        yield lead, subject, body
 
-        # 释放数据库连接后再进行Gmail API调用（耗时操作）
-        # 存储 {email: (lead_id, last_sent_at)}
-        lead_emails = {l['email'].lower(): (l['id'], l['last_sent_at']) for l in leads}
+# ============================================
+# 点击追踪短链
+# ============================================
 
-        creds = Credentials.from_authorized_user_info(json.loads(token_json))
-        service = build('gmail', 'v1', credentials=creds)
+LINK_BY_ID_SQL = "SELECT campaign_id, url FROM links WHERE id=?"
+LINK_IDS_SQL = "SELECT id, url FROM links WHERE campaign_id=? AND url IN ({placeholders})"
+LEAD_LINK_SQL = "SELECT 1 FROM links k JOIN leads l ON l.campaign_id=k.campaign_id WHERE l.id=? AND k.url=?"
 
-        # 查询最近7天的收件邮件
-        results = service.users().messages().list(
-            userId='me', q='in:inbox newer_than:7d', maxResults=100
-        ).execute()
+class LinkCache:
+    """短链 link_id -> 目标地址 的 LRU 缓存，同时记住 (campaign_id, 地址) -> link_id
 
-        messages = results.get('messages', [])
-        replied_lead_ids = []
+    跳转时先查内存，未命中再按主键读 links 表；改写链接时已知的地址不访问数据库，
+    新地址在一个事务里批量写入。links 表只追加，只有删除campaign时需要清掉对应的缓存。
+    """
 
-        for msg in messages:
-            msg_detail = service.users().messages().get(
-                userId='me', id=msg['id'], format='metadata',
-                metadataHeaders=['From', 'Date']
-            ).execute()
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._urls = OrderedDict()  # link_id -> (campaign_id, url)
+        self._ids = OrderedDict()   # (campaign_id, url) -> link_id
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.created = 0
+
+    def _remember(self, link_id: int, cid: int, url: str):
+        self._urls[link_id] = (cid, url)
+        self._urls.move_to_end(link_id)
+        self._ids[(cid, url)] = link_id
+        self._ids.move_to_end((cid, url))
+        while len(self._urls) > self.maxsize:
+            self._urls.popitem(last=False)
+        while len(self._ids) > self.maxsize:
+            self._ids.popitem(last=False)
+
+    def cached(self, link_id: int) -> Optional[str]:
+        """只查内存，未命中返回 None（异步接口中先调用，避免进入线程池）"""
+        with self._lock:
+            entry = self._urls.get(link_id)
+            if entry is None:
+                return None
+            self._urls.move_to_end(link_id)
+            self.hits += 1
+            return entry[1]
+
+    def resolve(self, link_id: int) -> Optional[str]:
+        url = self.cached(link_id)
+        if url is not None:
+            return url
+        with get_db(readonly=True) as conn:
+            row = conn.execute(LINK_BY_ID_SQL, (link_id,)).fetchone()
+        with self._lock:
+            self.misses += 1
+            if row:
+                self._remember(link_id, row['campaign_id'], row['url'])
+        return row['url'] if row else None
+
+    def ids_for(self, cid: int, urls) -> dict:
+        """返回 {地址: link_id}，links 表中还没有的地址批量写入"""
+        result, missing = {}, []
+        with self._lock:
+            for url in urls:
+                link_id = self._ids.get((cid, url))
+                if link_id is None:
+                    missing.append(url)
+                else:
+                    self._ids.move_to_end((cid, url))
+                    result[url] = link_id
+        if not missing:
+            return result
+        found = {}
+        with get_db() as conn:
+            cursor = conn.executemany("INSERT OR IGNORE INTO links(campaign_id, url) VALUES(?, ?)",
+                                      [(cid, url) for url in missing])
+            created = cursor.rowcount
+            for part in chunked(missing, 500):
+                found.update((url, link_id) for link_id, url in conn.execute(
+                    LINK_IDS_SQL.format(placeholders=",".join("?" * len(part))), [cid, *part]))
+            conn.commit()
+        with self._lock:
+            self.created += created
+            for url, link_id in found.items():
+                self._remember(link_id, cid, url)
+        result.update(found)
+        return result
+
+    def evict_campaign(self, cid: int):
+        """删除campaign后清掉它的短链缓存"""
+        with self._lock:
+            for key in [k for k in self._ids if k[0] == cid]:
+                del self._ids[key]
+            for link_id in [k for k, (c, _) in self._urls.items() if c == cid]:
+                del self._urls[link_id]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._urls), "hits": self.hits, "misses": self.misses, "created": self.created}
+
+links_cache = LinkCache(LINK_CACHE_SIZE)
+
+def load_link_key() -> bytes:
+    if LINK_SECRET:
+        return LINK_SECRET.encode()
+    with get_db(readonly=True) as conn:
+        return conn.execute("SELECT value FROM app_secrets WHERE name='link_signing'").fetchone()[0].encode()
+
+LINK_KEY = load_link_key()
+
+def link_signature(payload: str) -> str:
+    # 48位 HMAC 截断，足以防止猜测或篡改 lead/link id
+    return base64.urlsafe_b64encode(hmac.new(LINK_KEY, payload.encode(), hashlib.sha256).digest()[:6]).decode()
+
+def link_token(lead_id: int, link_id: int) -> str:
+    """短链为 <lead_id十六进制>.<link_id十六进制>.<签名>"""
+    payload = f"{lead_id:x}.{link_id:x}"
+    return f"{payload}.{link_signature(payload)}"
+
+def parse_link_token(token: str) -> Optional[tuple]:
+    """签名正确时返回 (lead_id, link_id)"""
+    parts = token.split(".")
+    if len(parts) != 3:
+        return None
+    payload = f"{parts[0]}.{parts[1]}"
+    if not hmac.compare_digest(link_signature(payload), parts[2]):
+        return None
+    try:
+        return int(parts[0], 16), int(parts[1], 16)
+    except ValueError:
+        return None
+
+# <a ... href="http(s)://..."> 中的链接；追踪像素等其他标签、mailto: 和页内锚点不改写
+LINK_HREF_RE = re.compile(r"""(<a\s[^>]*?\bhref\s*=\s*)(["'])(https?://[^"']*)\2""", re.IGNORECASE)
+
+def rewrite_links(cid: int, rendered: list) -> list:
+    """把渲染后正文中的链接替换为签名短链，rendered 为 [(lead, subject, body)]
+
+    每封正文只切分一次，整批正文中没见过的地址一次性写入 links 表，再拼回正文。
+    """
+    if not CLICK_TRACKING:
+        return rendered
+    prefix = f"{BASE_URL}/l/"
+    split, urls = [], set()
+    for lead, subject, body in rendered:
+        parts = LINK_HREF_RE.split(body) if body else None
+        if parts and len(parts) > 1:
+            # parts 为 [正文, href前缀, 引号, 地址, 正文, ...]，正文中的 &amp; 还原后才是真实地址
+            for i in range(3, len(parts), 4):
+                parts[i] = html.unescape(parts[i])
+                if not parts[i].startswith(prefix):
+                    urls.add(parts[i])
+        split.append(parts)
+    if not urls:
+        return rendered
+    ids = links_cache.ids_for(cid, urls)
+    result = []
+    for (lead, subject, body), parts in zip(rendered, split):
+        if parts and len(parts) > 1:
+            for i in range(3, len(parts), 4):
+                url = prefix + link_token(lead['id'], ids[parts[i]]) if parts[i] in ids else html.escape(parts[i])
+                parts[i] = url + parts[i - 1]  # 补回结束引号
+            body = "".join(parts)
+        result.append((lead, subject, body))
+    return result
+
+# 选出到期且还没有进入发送队列的leads（强制走 idx_leads_pending 部分索引：只含待发送的lead且按id有序，
+# 没有统计信息时规划器会选 idx_leads_campaign_status，要扫过已回复的lead并额外排序）
+DUE_LEADS_SQL = """
+    SELECT l.id, l.current_step FROM leads l INDEXED BY idx_leads_pending
+    LEFT JOIN templates t ON t.campaign_id=l.campaign_id AND t.step=l.current_step
+    WHERE l.campaign_id=? AND l.status='pending' AND l.replied=0
+    AND (l.last_sent_at IS NULL OR datetime(l.last_sent_at, '+' || t.delay_days || ' days') <= datetime('now'))
+    AND NOT EXISTS (SELECT 1 FROM send_queue q WHERE q.idempotency_key = l.campaign_id || ':' || l.id || ':' || l.current_step)
+    ORDER BY l.id LIMIT ?
+"""
+# 排队中和租约已过期的发送任务（走 idx_send_queue_due 部分索引）
+SEND_QUEUE_OUTSTANDING_SQL = "SELECT COUNT(*) FROM send_queue WHERE campaign_id=? AND status IN ('queued', 'in_flight')"
+CLAIM_SENDS_SQL = """
+    UPDATE send_queue SET status='in_flight', lease_owner=?, due_at=?, attempts=attempts+1
+    WHERE id IN (SELECT id FROM send_queue WHERE campaign_id=? AND status IN ('queued', 'in_flight') AND due_at<=?
+                 ORDER BY due_at LIMIT ?)
+    RETURNING id, lead_id, step, idempotency_key, attempts, due_at
+"""
+CLAIMED_LEADS_SQL = """
+    SELECT l.id, l.email, l.data, l.current_step, l.status, l.replied, t.id AS template_id, t.subject, t.body
+    FROM leads l LEFT JOIN templates t ON t.campaign_id=l.campaign_id AND t.step=l.current_step
+    WHERE l.id IN ({placeholders})
+"""
+
+def enqueue_due_leads(conn, cid: int, limit: int, daily_limit: int, now: float) -> int:
+    """把到期的leads加入发送队列，idempotency_key 唯一，同一lead的同一步骤只会入队一次"""
+    if daily_limit:
+        outstanding = conn.execute(SEND_QUEUE_OUTSTANDING_SQL, (cid,)).fetchone()[0]
+        limit = min(limit, daily_limit - sent_today(conn, cid) - outstanding)
+        if limit <= 0:
+            return 0
+    rows = [(cid, lead_id, step, f"{cid}:{lead_id}:{step}", now)
+            for lead_id, step in conn.execute(DUE_LEADS_SQL, (cid, limit)).fetchall()]
+    conn.executemany("INSERT OR IGNORE INTO send_queue(campaign_id, lead_id, step, idempotency_key, status, due_at) "
+                     "VALUES(?, ?, ?, ?, 'queued', ?)", rows)
+    return len(rows)
+
+def claim_sends(cid: int, limit: int, owner: str):
+    """领取campaign的发送任务并渲染，返回 ([(claim, lead, subject, body)], 模板步骤集合)
+
+    入队和领取在同一个写事务中完成，领取是一条 UPDATE ... RETURNING：排队中的任务和租约过期的任务
+    （上次领取的进程崩溃或超时）都会被领取，并设置新的租约。多个进程同时领取也不会拿到同一条。
+    lead 已回复、已被其他方式推进到下一步时，队列中的旧任务直接删除；缺少模板的lead标记为完成；
+    在禁发名单中的lead标记为 suppressed，不再发送。
+    """
+    now = time.time()
+    suppression.refresh()
+    with get_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        # campaign 可能已在其他进程中停止，不再领取
+        campaign = conn.execute("SELECT daily_limit, account_email FROM campaigns WHERE id=? AND status='running'",
+                                (cid,)).fetchone()
+        if not campaign:
+            conn.commit()
+            return [], set()
+        enqueue_due_leads(conn, cid, limit, campaign['daily_limit'], now)
+        claims = [dict(r) for r in conn.execute(CLAIM_SENDS_SQL, (owner, now + SEND_LEASE_SECONDS, cid, now, limit)).fetchall()]
+        if not claims:
+            conn.commit()
+            return [], set()
+        leads = {lead['id']: lead for lead in conn.execute(
+            CLAIMED_LEADS_SQL.format(placeholders=",".join("?" * len(claims))), [c['lead_id'] for c in claims]).fetchall()}
+        stale, completed, suppressed, due = [], [], [], []
+        for claim in sorted(claims, key=lambda c: c['id']):
+            lead = leads.get(claim['lead_id'])
+            if not lead or lead['status'] != 'pending' or lead['replied'] or lead['current_step'] != claim['step']:
+                stale.append((claim['id'],))
+            elif lead['subject'] is None:
+                completed.append((lead['id'],))
+                stale.append((claim['id'],))
+            elif suppression.match(lead['email']):
+                suppressed.append((claim['id'], lead['id']))
+            else:
+                due.append((claim, lead))
+        conn.executemany("DELETE FROM send_queue WHERE id=?", stale)
+        conn.executemany("UPDATE leads SET status='completed' WHERE id=?", completed)
+        mark_suppressed(conn, suppressed)
+        conn.commit()
+        if suppressed:
+            sends_total.inc(len(suppressed), campaign=cid, account=campaign['account_email'], result="suppressed")
+        steps = {r[0] for r in conn.execute("SELECT step FROM templates WHERE campaign_id=?", (cid,)).fetchall()}
+    rendered = rewrite_links(cid, list(render_due_leads(lead for _, lead in due)))
+    return [(claim, lead, subject, body) for (claim, _), (lead, subject, body) in zip(due, rendered)], steps
+
+def release_sends(claim_ids: list, owner: str):
+    """把已领取但还没发送的任务放回队列（campaign停止、进程退出时）"""
+    with get_db() as conn:
+        conn.executemany("UPDATE send_queue SET status='queued', lease_owner=NULL, due_at=?, attempts=attempts-1 "
+                         "WHERE id=? AND status='in_flight' AND lease_owner=?",
+                         [(time.time(), qid, owner) for qid in claim_ids])
+        conn.commit()
 
-            headers = msg_detail.get('payload', {}).get('headers', [])
-            from_header = next((h['value'] for h in headers if h['name'] == 'From'), '')
-            date_header = next((h['value'] for h in headers if h['name'] == 'Date'), '')
+def mark_suppressed(conn, items: list):
+    """items 为 [(queue_id, lead_id)]：队列任务和lead都标记为 suppressed"""
+    if items:
+        conn.executemany("UPDATE send_queue SET status='suppressed', lease_owner=NULL WHERE id=?", [(qid,) for qid, _ in items])
+        conn.executemany("UPDATE leads SET status='suppressed' WHERE id=?", [(lead_id,) for _, lead_id in items])
 
-            # 提取发件人邮箱
-            import re
-            match = re.search(r'<(.+?)>', from_header)
-            sender = (match.group(1) if match else from_header).lower().strip()
+def save_send_results(cid: int, sent: list, failed: list, suppressed: list = ()):
+    """发送结果一次性提交：队列任务标记为已发送和lead推进到下一步在同一个事务中
 
-            # 如果发件人在我们的leads列表中
-            if sender in lead_emails:
-                lead_id, last_sent_at = lead_emails[sender]
+    sent: [(queue_id, lead_id, sent_at, new_status, gmail_id)]；failed: [(queue_id, lead_id, attempts, error)]；
+    suppressed: [(queue_id, lead_id)]，领取之后才加入禁发名单、发送前被拦下的任务。
+    失败的任务按指数退避重新排队，超过 SEND_MAX_ATTEMPTS 次后标记为失败，lead 状态改为 failed。
+    """
+    now = time.time()
+    retries = [(now + SEND_RETRY_SECONDS * 2 ** (attempts - 1), error[:500], qid)
+               for qid, _, attempts, error in failed if attempts < SEND_MAX_ATTEMPTS]
+    given_up = [(qid, lead_id, error) for qid, lead_id, attempts, error in failed if attempts >= SEND_MAX_ATTEMPTS]
+    with get_db() as conn:
+        if sent:
+            record_events(conn, [(lead_id, 'sent', sent_at) for _, lead_id, sent_at, _, _ in sent])
+            conn.executemany("UPDATE leads SET current_step=current_step+1, last_sent_at=?, status=? WHERE id=?",
+                             [(sent_at, status, lead_id) for _, lead_id, sent_at, status, _ in sent])
+            conn.executemany("UPDATE send_queue SET status='sent', sent_at=?, gmail_id=?, lease_owner=NULL WHERE id=?",
+                             [(sent_at, gmail_id, qid) for qid, _, sent_at, _, gmail_id in sent])
+        conn.executemany("UPDATE send_queue SET status='queued', due_at=?, error=?, lease_owner=NULL WHERE id=?", retries)
+        if given_up:
+            conn.executemany("UPDATE send_queue SET status='failed', error=?, lease_owner=NULL WHERE id=?",
+                             [(error[:500], qid) for qid, _, error in given_up])
+            conn.executemany("UPDATE leads SET status='failed' WHERE id=?", [(lead_id,) for _, lead_id, _ in given_up])
+        mark_suppressed(conn, suppressed)
+        conn.commit()
+    if sent:
+        send_log.info("Campaign %s: sent %d", cid, len(sent), extra={"campaign": cid})
+    if failed:
+        send_log.warning("Campaign %s: %d send(s) requeued, %d failed", cid, len(retries), len(given_up),
+                         extra={"campaign": cid})
+    if suppressed:
+        send_log.info("Campaign %s: skipped %d suppressed address(es)", cid, len(suppressed), extra={"campaign": cid})
+
+def purge_send_queue():
+    """删除 SEND_QUEUE_KEEP_DAYS 天前已发送的任务（lead 已推进到下一步，idempotency_key 不会再用到）"""
+    if not acquire_lease("job:purge_send_queue", 23 * 3600):
+        return
+    cutoff = (datetime.now() - timedelta(days=SEND_QUEUE_KEEP_DAYS)).isoformat()
+    with get_db() as conn:
+        deleted = conn.execute("DELETE FROM send_queue WHERE status='sent' AND sent_at < ?", (cutoff,)).rowcount
+        conn.commit()
+    if deleted:
+        db_log.info("Purged %d sent send_queue item(s)", deleted)
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积累 capacity 个"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def configure(self, rate: float, capacity: float):
+        self._refill()
+        self.rate, self.capacity = rate, capacity
+        self.tokens = min(self.tokens, capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+    def wait_time(self) -> float:
+        """距离有一个令牌还需要的秒数"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float('inf')
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+ACCOUNT_LIMITS_SQL = "SELECT rate_per_minute, daily_cap, work_start, work_end FROM accounts WHERE email=?"
+ACCOUNT_CAMPAIGNS_SQL = """
+    SELECT id, interval_minutes, batch_size, daily_limit FROM campaigns
+    WHERE account_email=? AND status='running' ORDER BY id
+"""
+ACCOUNT_SENT_TODAY_SQL = """
+    SELECT COALESCE(SUM(d.events), 0) FROM campaigns c
+    JOIN event_counts_daily d ON d.campaign_id = c.id AND d.bucket = ? AND d.type = 'sent'
+    WHERE c.account_email = ?
+"""
+
+def account_limits(conn, account_email: str) -> dict:
+    """账号发送限制：每分钟速率、每日上限（0为不限）、工作时间窗口（小时，未设置为全天）"""
+    row = conn.execute(ACCOUNT_LIMITS_SQL, (account_email,)).fetchone()
+    limits = {"rate_per_minute": ACCOUNT_RATE_PER_MINUTE, "daily_cap": ACCOUNT_DAILY_CAP,
+              "work_start": None, "work_end": None}
+    if row:
+        limits.update({k: row[k] for k in limits if row[k] is not None})
+    return limits
+
+def seconds_until_window(limits: dict, now: datetime = None) -> float:
+    """当前不在工作时间窗口内时，返回距离窗口开始的秒数；在窗口内返回0。支持跨午夜的窗口（如22-6）"""
+    start, end = limits['work_start'], limits['work_end']
+    if start is None or end is None or start == end:
+        return 0
+    now = now or datetime.now()
+    hour = now.hour
+    inside = start <= hour < end if start < end else (hour >= start or hour < end)
+    if inside:
+        return 0
+    opens = now.replace(hour=start, minute=0, second=0, microsecond=0)
+    if opens <= now:
+        opens += timedelta(days=1)
+    return (opens - now).total_seconds()
+
+def work_minutes_per_day(limits: dict) -> int:
+    start, end = limits['work_start'], limits['work_end']
+    if start is None or end is None or start == end:
+        return 24 * 60
+    return ((end - start) % 24) * 60
+
+class AccountSender:
+    """一个发件账号的发送调度
+
+    账号的令牌桶（rate_per_minute）限制该账号所有campaign合计的发送速率，另有每日上限和工作时间窗口；
+    每个campaign还有自己的令牌桶（每 interval_minutes 分钟 batch_size 封）。
+    到期的leads在各campaign之间轮流取用，一个campaign积压很多也不会饿死其他campaign。
+    要发送的邮件先从 send_queue 领取（见 claim_sends），每次只领取令牌允许的数量，
+    campaign 停止、窗口外/已达上限或进程退出时，领取了还没发送的任务放回队列。
+    """
 
-                # 获取邮件接收时间
+    def __init__(self, engine, account_email: str):
+        self.engine, self.account_email = engine, account_email
+        self.bucket = TokenBucket(ACCOUNT_RATE_PER_MINUTE / 60, max(1, ACCOUNT_RATE_PER_MINUTE))
+        self.limits = {}
+        self.campaigns = {}        # cid -> campaign row
+        self.campaign_buckets = {}
+        self.buffers = {}          # cid -> deque[(claim, lead, subject, body)]
+        self.steps = {}
+        self.idle_until = {}       # cid -> 没有到期lead时，下次检查的时间
+        self.in_flight = {}        # cid -> {queue_id}
+        self.results = {}          # cid -> ([sent], [failed], [suppressed])，每秒最多写入一次
+        self.flushed_at = 0.0
+        self.sent_today, self.day = 0, None
+        self.rr = 0                # 轮转位置
+        self.wake = asyncio.Event()
+        self.stopping = False
+        self.plan_loaded = 0.0
+        self.plan_stale = True     # 加载过程中再次被通知时保持 True，下一步重新加载
+
+    def notify(self):
+        """campaign启动/停止或账号限制变化后调用：重新加载发送计划"""
+        self.plan_stale = True
+        self.idle_until.clear()
+        self.wake.set()
+
+    async def run(self):
+        try:
+            while not self.stopping:
                 try:
-                    from email.utils import parsedate_to_datetime
-                    received_time = parsedate_to_datetime(date_header)
-
-                    # 解析发送时间
-                    from dateutil import parser as dateparser
-                    sent_time = dateparser.parse(last_sent_at)
-
-                    # 统一转换为 naive datetime（移除时区信息）以便比较
-                    if received_time.tzinfo is not None:
-                        received_time = received_time.replace(tzinfo=None)
-                    if sent_time.tzinfo is not None:
-                        sent_time = sent_time.replace(tzinfo=None)
-
-                    # 只有邮件是在我们发送之后收到的，才算作回复
-                    if received_time > sent_time:
-                        replied_lead_ids.append((lead_id, sender))
-                        print(f"[Reply] {sender} replied (sent: {sent_time}, received: {received_time})")
-                    else:
-                        print(f"[Skip] {sender} email too old (sent: {sent_time}, received: {received_time})")
+                    await self.step()
                 except Exception as e:
-                    print(f"[Date parse error] {e}, skipping message")
+                    send_log.exception("Sender for %s failed: %s", self.account_email, e, extra={"account": self.account_email})
+                    await self.sleep(60)
+        finally:
+            await self.release()
+            await self.engine.drain(self)
+            await self.flush()
+
+    async def step(self):
+        """开始一封邮件的发送，或者等待到下一封可以发送的时间"""
+        if self.plan_stale or time.monotonic() - self.plan_loaded > ACCOUNT_PLAN_SECONDS:
+            await self.load_plan()
+        if not self.campaigns:
+            await self.flush()
+            return await self.sleep(ACCOUNT_PLAN_SECONDS)
+        wait = self.blocked_for()
+        if wait:
+            await self.release()
+            await self.flush()
+            return await self.sleep(min(wait, ACCOUNT_PLAN_SECONDS))
+        cid, item, wait = await self.next_item()
+        if item is None:
+            await self.flush()
+            return await self.sleep(wait)
+        if suppression.match(item[1]['email']):
+            # 领取之后才加入禁发名单的地址，不占用令牌
+            self.results.setdefault(cid, ([], [], []))[2].append((item[0]['id'], item[1]['id']))
+            sends_total.inc(campaign=cid, account=self.account_email, result="suppressed")
+            return
+        while not self.stopping and self.bucket.wait_time() and cid in self.campaigns:
+            await self.flush()
+            await self.sleep(self.bucket.wait_time())
+        if self.stopping or cid not in self.campaigns:
+            self.buffers.setdefault(cid, deque()).appendleft(item)
+            return
+        if time.time() > item[0]['due_at'] - SEND_LEASE_SECONDS / 10:
+            # 在缓冲中等待太久、租约即将过期的任务不再发送，以免和重新领取它的 worker 重复发送；
+            # 还没被其他 worker 领取时放回队列（release_sends 只放回自己持有的任务）
+            await asyncio.to_thread(release_sends, [item[0]['id']], self.engine.worker_id)
+            return
+        self.bucket.take()
+        self.campaign_buckets[cid].take()
+        self.sent_today += 1
+        self.in_flight.setdefault(cid, set()).add(item[0]['id'])
+        self.engine.spawn(self, self.send(cid, *item))
+        if time.monotonic() - self.flushed_at > 1:
+            await self.flush()
+
+    async def load_plan(self):
+        self.plan_stale = False
+
+        def load():
+            with get_db(readonly=True) as conn:
+                limits = account_limits(conn, self.account_email)
+                campaigns = conn.execute(ACCOUNT_CAMPAIGNS_SQL, (self.account_email,)).fetchall()
+                today = datetime.now().date().isoformat()
+                sent = conn.execute(ACCOUNT_SENT_TODAY_SQL, (today, self.account_email)).fetchone()[0]
+            return limits, campaigns, today, sent
+        await self.flush()
+        limits, campaigns, today, sent = await asyncio.to_thread(load)
+        in_flight = sum(len(ids) for ids in self.in_flight.values())
+        if today != self.day or self.sent_today < sent + in_flight:
+            self.day, self.sent_today = today, sent + in_flight
+        self.limits = limits
+        # 账号桶最多积累一分钟的令牌
+        rate_per_minute = max(limits['rate_per_minute'], 0.001)
+        self.bucket.configure(rate_per_minute / 60, max(1.0, rate_per_minute))
+        self.campaigns = {row['id']: row for row in campaigns}
+        for cid, row in self.campaigns.items():
+            batch = max(1, row['batch_size'] or SEND_BATCH_SIZE)
+            rate = batch / ((row['interval_minutes'] or 5) * 60)
+            if cid in self.campaign_buckets:
+                self.campaign_buckets[cid].configure(rate, batch)
+            else:
+                self.campaign_buckets[cid] = TokenBucket(rate, batch)
+        await self.release([cid for cid in self.buffers if cid not in self.campaigns])
+        self.plan_loaded = time.monotonic()
+
+    def blocked_for(self) -> float:
+        """工作时间窗口外或已达每日上限时返回需要等待的秒数"""
+        wait = seconds_until_window(self.limits)
+        if wait:
+            return wait
+        if datetime.now().date().isoformat() != self.day:
+            self.plan_stale = True
+            return 0.01
+        if self.limits['daily_cap'] and self.sent_today >= self.limits['daily_cap']:
+            midnight = datetime.combine(datetime.now().date() + timedelta(days=1), datetime.min.time())
+            return max((midnight - datetime.now()).total_seconds(), 1)
+        return 0
+
+    async def next_item(self):
+        """轮流从各campaign取下一个要发送的lead，返回 (cid, item, 0)；都没有时返回 (None, None, 需要等待的秒数)"""
+        cids = sorted(self.campaigns)
+        now = time.monotonic()
+        wait = ACCOUNT_PLAN_SECONDS
+        for offset in range(len(cids)):
+            cid = cids[(self.rr + offset) % len(cids)]
+            bucket_wait = self.campaign_buckets[cid].wait_time()
+            if bucket_wait:
+                wait = min(wait, bucket_wait)
+                continue
+            buffer = self.buffers.get(cid)
+            if not buffer:
+                if self.idle_until.get(cid, 0) > now:
+                    wait = min(wait, self.idle_until[cid] - now)
+                    continue
+                buffer = await self.refill(cid)
+                if not buffer:
+                    self.idle_until[cid] = now + ACCOUNT_PLAN_SECONDS
                     continue
+            self.rr = (self.rr + offset + 1) % len(cids)
+            return cid, buffer.popleft(), 0
+        return None, None, max(wait, 0.01)
+
+    async def refill(self, cid: int):
+        """从发送队列领取campaign的任务，数量为campaign桶和账号桶中可用的令牌数（至少1个），
+        且不超过账号速率在半个租约内能发完的数量（账号桶由所有campaign分享），领取的任务在租约内发出"""
+        await self.flush(cid)
+        drainable = int(self.bucket.rate * SEND_LEASE_SECONDS / 2 / len(self.campaigns))
+        want = max(1, min(int(self.campaign_buckets[cid].available()), int(self.bucket.available()), drainable, 100))
+        items, steps = await asyncio.to_thread(claim_sends, cid, want, self.engine.worker_id)
+        if steps:
+            self.steps[cid] = steps
+        self.buffers[cid] = deque(items)
+        return self.buffers[cid]
+
+    async def release(self, cids=None):
+        """把领取了还没发送的任务放回队列"""
+        claim_ids = [item[0]['id'] for cid in (list(self.buffers) if cids is None else cids)
+                     for item in self.buffers.pop(cid, ())]
+        if claim_ids:
+            await asyncio.to_thread(release_sends, claim_ids, self.engine.worker_id)
+
+    async def send(self, cid: int, claim: dict, lead, subject: str, body: str):
+        # 重试的任务（包括上次领取的租约已过期），上次可能已经发出（发送成功但结果没来得及写入），先按 Message-ID 查一下
+        check_sent = claim['attempts'] > 1
+        message_id = send_message_id(self.account_email, claim['idempotency_key'])
+        try:
+            gmail_id = await self.engine.send(self.account_email, lead, subject, body, message_id, check_sent)
+        except Exception as e:
+            self.sent_today -= 1
+            self.results.setdefault(cid, ([], [], []))[1].append((claim['id'], lead['id'], claim['attempts'], str(e)))
+            sends_total.inc(campaign=cid, account=self.account_email, result="failed")
+        else:
+            sends_total.inc(campaign=cid, account=self.account_email, result="sent")
+            new_status = 'pending' if lead['current_step'] + 1 in self.steps.get(cid, ()) else 'completed'
+            self.results.setdefault(cid, ([], [], []))[0].append(
+                (claim['id'], lead['id'], datetime.now().isoformat(), new_status, gmail_id))
+        finally:
+            self.in_flight[cid].discard(claim['id'])
+        self.wake.set()  # 账号协程可能正在长时间等待（窗口外/已达上限），让它先写入结果
+
+    async def flush(self, cid: Optional[int] = None):
+        """把已完成的发送结果写入数据库"""
+        self.flushed_at = time.monotonic()
+        for key in ([cid] if cid is not None else list(self.results)):
+            sent, failed, suppressed = self.results.pop(key, ([], [], []))
+            if sent or failed or suppressed:
+                await asyncio.to_thread(save_send_results, key, sent, failed, suppressed)
+
+    async def sleep(self, seconds: float):
+        """等待指定秒数，有新的campaign启动/停止或限制变化时提前醒来"""
+        if seconds <= 0 or self.plan_stale or self.stopping:
+            return
+        self.wake.clear()
+        try:
+            await asyncio.wait_for(self.wake.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
 
-        # 批量更新数据库（一次性提交，减少锁定时间）
-        if replied_lead_ids:
-            with get_db() as conn:
-                for lead_id, sender in replied_lead_ids:
-                    conn.execute("UPDATE leads SET replied=1, status='replied' WHERE id=?", (lead_id,))
-                    print(f"[Reply detected] Lead {lead_id} ({sender}) replied")
-                conn.commit()
+    def stats(self) -> dict:
+        return {
+            "campaigns": sorted(self.campaigns), "sent_today": self.sent_today, **self.limits,
+            "tokens": round(self.bucket.available(), 2), "in_flight": sum(len(s) for s in self.in_flight.values()),
+            "waiting_for_window": seconds_until_window(self.limits) > 0 if self.limits else False,
+        }
 
-    except Exception as e:
-        print(f"[Check replies error] {e}")
+class SendEngine:
+    """asyncio 发送引擎，在 FastAPI lifespan（all 模式）或 worker 进程中启动
 
-def process_campaign(cid: int, account_email: str):
-    # 先检查回复
-    check_replies(cid, account_email)
+    每个有运行中campaign的发件账号一个 AccountSender 协程（速率、每日上限、工作时间和campaign间轮转见 AccountSender）。
+    发件账号通过 worker_leases 租约分配（见 assign_accounts），多个 worker 进程同时运行时每个账号只由一个 worker 发送。
+    发送请求通过 httpx 异步调用 Gmail，同时进行的请求数受全局和每个账号的信号量限制，
+    Gmail 响应慢时只会排队，不占用线程。数据库读写和模板渲染放在线程池中执行。
+    每个账号使用独立的 httpx 客户端（连接数 = 账号并发数）：httpcore 分配连接的开销随连接池大小增长，
+    一个大连接池在高并发下反而更慢。停止campaign不会打断正在进行的发送，只是不再开始新的发送。
+    """
 
-    with get_db() as conn:
-        lead = conn.execute("""
-            SELECT l.* FROM leads l WHERE l.campaign_id=? AND l.status='pending' AND l.replied=0
-            AND (l.last_sent_at IS NULL OR datetime(l.last_sent_at, '+' ||
-                (SELECT delay_days FROM templates WHERE campaign_id=? AND step=l.current_step) || ' days') <= datetime('now'))
-            LIMIT 1
-        """, (cid, cid)).fetchone()
-        if not lead: return
-
-        tpl = conn.execute("SELECT * FROM templates WHERE campaign_id=? AND step=?",
-                          (cid, lead['current_step'])).fetchone()
-        if not tpl:
-            conn.execute("UPDATE leads SET status='completed' WHERE id=?", (lead['id'],))
-            conn.commit(); return
-
-        data = json.loads(lead['data'])
-        data['email'] = lead['email']
-        subject = Template(tpl['subject']).render(**data)
-        body = Template(tpl['body']).render(**data)
-
-        # 添加追踪像素
-        # 支持两种追踪服务：
-        # 1. 使用Render上的tracker.py: TRACKER_URL=https://your-tracker.onrender.com
-        # 2. 使用本地追踪服务: BASE_URL=http://your-vps-ip
-        tracker_url = os.environ.get("TRACKER_URL", "")
-        if tracker_url:
-            # 使用外部追踪服务（如Render上的tracker.py）
-            track_pixel = f'<img src="{tracker_url}/open?uid={lead["id"]}" width="1" height="1" style="display:none">'
+    def __init__(self, concurrency: int, account_concurrency: int):
+        self.concurrency, self.account_concurrency = concurrency, account_concurrency
+        self._senders = {}       # account_email -> (AccountSender, Task)
+        self._accounts = {}      # account_email -> (Semaphore, AsyncClient)
+        self._sends = {}         # AccountSender -> {Task}
+        self._limit = None
+        self._assigner = None
+        self.worker_id = WORKER_ID
+        self.sent = self.failed = self.deduplicated = self.in_flight = 0
+        self._latencies = deque(maxlen=1000)
+
+    async def start(self):
+        self._limit = asyncio.Semaphore(self.concurrency)
+        self._assigner = asyncio.get_running_loop().create_task(self._assign_loop(), name="send_assign")
+
+    async def _assign_loop(self):
+        while True:
+            # 发送前只查内存中的禁发名单，这里定期同步 web 进程等其他进程的修改
+            try:
+                await asyncio.to_thread(suppression.refresh)
+            except Exception as e:
+                send_log.warning("Suppression refresh failed: %s", e)
+            await self.assign()
+            await asyncio.sleep(WORKER_POLL_SECONDS)
+
+    async def assign(self):
+        """续租自己的发件账号、领取没有 worker 负责的账号，放掉超出份额或租约已被接手的账号"""
+        busy = {email for email, (sender, _) in self._senders.items() if sender.stopping}
+        try:
+            take, drop = await asyncio.to_thread(assign_accounts, self.worker_id, set(self._senders) - busy, busy)
+        except Exception as e:
+            send_log.warning("Account assignment failed: %s", e)
+            return
+        for email in drop:
+            self.stop_account(email)
+        for email in take:
+            self.wake_account(email)
+            send_log.info("Sending for %s on %s", email, self.worker_id, extra={"account": email})
+
+    async def stop(self, timeout: float = 30):
+        if self._assigner:
+            self._assigner.cancel()
+        for email in list(self._senders):
+            self.stop_account(email)
+        tasks = [task for _, task in self._senders.values()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        for _, client in self._accounts.values():
+            await client.aclose()
+        self._accounts.clear()
+        await asyncio.to_thread(release_lease, f"worker:{self.worker_id}", self.worker_id)
+
+    def wake_account(self, account_email: str):
+        """启动账号的发送协程（已在运行则让它重新加载campaign和限制）；调用前需已取得账号的租约"""
+        entry = self._senders.get(account_email)
+        if entry and not entry[1].done():
+            entry[0].notify()
+            return
+        sender = AccountSender(self, account_email)
+        task = asyncio.get_running_loop().create_task(self._run_sender(sender), name=f"sender_{account_email}")
+        self._senders[account_email] = (sender, task)
+
+    def stop_account(self, account_email: str):
+        entry = self._senders.get(account_email)
+        if entry:
+            entry[0].stopping = True
+            entry[0].notify()
+
+    async def _run_sender(self, sender: AccountSender):
+        try:
+            await sender.run()
+        except Exception as e:
+            send_log.exception("Sender for %s failed: %s", sender.account_email, e, extra={"account": sender.account_email})
+        finally:
+            if self._senders.get(sender.account_email, (None,))[0] is sender:
+                del self._senders[sender.account_email]
+            await asyncio.to_thread(release_lease, f"send:{sender.account_email}", self.worker_id)
+
+    def launch(self, cid: int, account_email: str):
+        """campaign 已在数据库中标记为 running：账号由本进程发送时立即开始，否则立即尝试领取该账号；
+        web 模式下引擎不运行，由 worker 在下一轮分配时接手"""
+        if self._limit is None:
+            return
+        self.cancel(cid)
+        if account_email in self._senders:
+            self.wake_account(account_email)
         else:
-            # 使用本地追踪服务
-            base_url = os.environ.get("BASE_URL", "http://localhost:8000")
-            track_pixel = f'<img src="{base_url}/track/open/{lead["id"]}" width="1" height="1" style="display:none">'
-        body += track_pixel
-
-        if send_gmail(account_email, lead['email'], subject, body):
-            next_tpl = conn.execute("SELECT * FROM templates WHERE campaign_id=? AND step=?",
-                                   (cid, lead['current_step'] + 1)).fetchone()
-            new_status = 'pending' if next_tpl else 'completed'
-            conn.execute("UPDATE leads SET current_step=current_step+1, last_sent_at=?, status=? WHERE id=?",
-                        (datetime.now().isoformat(), new_status, lead['id']))
-            conn.commit()
+            asyncio.get_running_loop().create_task(self.assign())
+
+    def cancel(self, cid: int):
+        """停止本进程中campaign的发送；其他 worker 在重新加载发送计划时停止，领取时也会检查campaign状态"""
+        for sender, _ in self._senders.values():
+            if sender.campaigns.pop(cid, None):
+                sender.notify()
+
+    def refresh_account(self, account_email: str):
+        entry = self._senders.get(account_email)
+        if entry:
+            entry[0].notify()
+
+    def running(self) -> list:
+        return sorted(cid for sender, _ in self._senders.values() for cid in sender.campaigns)
+
+    def account_state(self, account_email: str) -> Optional[dict]:
+        entry = self._senders.get(account_email)
+        return entry[0].stats() if entry else None
+
+    def spawn(self, sender: AccountSender, coro):
+        """在事件循环中执行发送；记录在账号名下，账号协程退出前会等待它们完成"""
+        task = asyncio.get_running_loop().create_task(coro)
+        tasks = self._sends.setdefault(sender, set())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def drain(self, sender: AccountSender):
+        tasks = self._sends.pop(sender, set())
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def _account(self, account_email: str):
+        if account_email not in self._accounts:
+            client = httpx.AsyncClient(
+                base_url=(GMAIL_API_ENDPOINT or "https://gmail.googleapis.com").rstrip('/') + '/', timeout=60,
+                limits=httpx.Limits(max_connections=self.account_concurrency,
+                                    max_keepalive_connections=self.account_concurrency))
+            self._accounts[account_email] = (asyncio.Semaphore(self.account_concurrency), client)
+        return self._accounts[account_email]
+
+    async def send(self, account_email: str, lead, subject: str, body: str, message_id: str,
+                   check_sent: bool = False) -> str:
+        """发送一封邮件，返回 Gmail 邮件ID，失败时抛出异常；check_sent 时先查找同一 Message-ID 的邮件，已存在则不再发送"""
+        account_limit, client = self._account(account_email)
+        async with account_limit, self._limit:
+            started = time.perf_counter()
+            self.in_flight += 1
+            try:
+                gmail_id = await find_sent_message(client, account_email, message_id) if check_sent else None
+                if gmail_id:
+                    self.deduplicated += 1
+                    send_log.info("Lead %s: %s already sent, skipping", lead['id'], message_id, extra={"account": account_email})
+                else:
+                    gmail_id = await send_gmail_async(client, account_email, lead['email'], subject, body, message_id)
+            except Exception as e:
+                self.failed += 1
+                send_log.warning("Lead %s: send failed: %s", lead['id'], e, extra={"account": account_email})
+                raise
+            finally:
+                self.in_flight -= 1
+                self._latencies.append(time.perf_counter() - started)
+        self.sent += 1
+        return gmail_id
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        def pct(p):
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 1) if latencies else 0
+        return {"worker_id": self.worker_id,
+                "accounts": {email: sender.stats() for email, (sender, _) in self._senders.items()},
+                "running_campaigns": len(self.running()), "sent": self.sent, "failed": self.failed,
+                "deduplicated": self.deduplicated, "send_ms_p50": pct(0.5), "send_ms_p99": pct(0.99),
+                "in_flight": self.in_flight}
+
+send_engine = SendEngine(SEND_CONCURRENCY, SEND_ACCOUNT_CONCURRENCY)
 
-# 追踪
-@app.get("/track/open/{lead_id}")
-def track_open(lead_id: int, request: Request):
-    """追踪邮件打开"""
-    # 记录日志（包含IP和User-Agent）
-    client_ip = request.client.host if request.client else "unknown"
-    user_agent = request.headers.get("user-agent", "unknown")
-    print(f"[Open tracked] Lead {lead_id} | IP: {client_ip} | UA: {user_agent[:50]}...")
+# ============================================
+# 追踪事件：请求只入队，后台线程合并写入
+# ============================================
 
-    with get_db() as conn:
-        # 检查lead是否存在
-        lead = conn.execute("SELECT id, email FROM leads WHERE id=?", (lead_id,)).fetchone()
-        if lead:
-            conn.execute("UPDATE leads SET opened=1 WHERE id=?", (lead_id,))
+class TrackingEventWriter:
+    """打开/点击事件的合并写入器
+
+    追踪接口只把 (kind, lead_id) 放入内存队列，不访问 SQLite；后台线程攒够 flush_events 条
+    或等待 flush_ms 毫秒后，在一个事务里批量更新 leads，避免图片代理集中拉取像素时频繁抢占写连接。
+    进程退出前调用 stop() 写入剩余事件。
+    """
+
+    def __init__(self, flush_events: int, flush_ms: int, maxsize: int):
+        self.flush_events, self.flush_interval = flush_events, flush_ms / 1000
+        self._queue = queue.Queue(maxsize)
+        self._stopping = threading.Event()
+        self.received = self.written = self.dropped = self.batches = 0
+        self.flush_seconds = 0.0
+        # 计数器先初始化，后台线程启动后可能立刻写入
+        self._thread = threading.Thread(target=self._run, name="tracking-writer", daemon=True)
+        self._thread.start()
+
+    def record(self, kind: str, lead_id: int) -> bool:
+        """入队一个事件，队列满时丢弃并返回 False"""
+        try:
+            self._queue.put_nowait((lead_id, kind, datetime.now().isoformat()))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.received += 1
+        return True
+
+    def stop(self, timeout: float = 10):
+        self._stopping.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    tracking_log.error("Failed to write %d event(s): %s", len(batch), e)
+            elif self._stopping.is_set():
+                return
+
+    def _collect(self) -> list:
+        """等待第一个事件，然后继续收集到 flush_events 条或 flush_interval 到期"""
+        try:
+            batch = [self._queue.get(timeout=0.2)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + (0 if self._stopping.is_set() else self.flush_interval)
+        while len(batch) < self.flush_events:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: list):
+        started = time.perf_counter()
+        with get_db() as conn:
+            apply_tracking_events(conn, batch)
             conn.commit()
-            print(f"[Open tracked] ✓ Lead {lead_id} ({lead['email']}) marked as opened")
+        self.batches += 1
+        self.written += len(batch)
+        self.flush_seconds += time.perf_counter() - started
+
+    def stats(self) -> dict:
+        return {
+            "received": self.received, "written": self.written, "dropped": self.dropped,
+            "pending": self._queue.qsize(), "batches": self.batches,
+            "avg_batch": round(self.written / self.batches, 1) if self.batches else 0,
+            "avg_flush_ms": round(self.flush_seconds * 1000 / self.batches, 2) if self.batches else 0,
+        }
+
+EVENT_FLAGS = {"open": "opened", "click": "clicked", "reply": "replied"}
+
+def record_events(conn, events):
+    """写入事件日志并累加小时/天汇总，events 为 [(lead_id, type, ISO时间)]，type 为 sent/open/click/reply
+
+    需要在更新 leads 的 opened/clicked/replied、current_step 之前、同一个事务中调用：
+    用更新前的值判断是否首次发生（汇总中的 leads 列）以及事件属于哪一步。不存在的lead会被忽略。
+    """
+    lead_ids = list({e[0] for e in events})
+    leads = {}
+    for i in range(0, len(lead_ids), 500):
+        part = lead_ids[i:i + 500]
+        for row in conn.execute(f"SELECT l.id, l.campaign_id, l.current_step, l.last_sent_at, l.opened, l.clicked, "
+                                f"l.replied, c.account_email FROM leads l LEFT JOIN campaigns c ON c.id = l.campaign_id "
+                                f"WHERE l.id IN ({','.join('?' * len(part))})", part):
+            leads[row['id']] = row
+    rows, counts, seen, accounts = [], {}, set(), {}
+    for lead_id, event_type, created_at in events:
+        lead = leads.get(lead_id)
+        if lead is None:
+            continue
+        if event_type == 'sent':
+            # 发送事件属于正在发送的这一步，首次发送计入发送人数
+            step, first = lead['current_step'], lead['last_sent_at'] is None
         else:
-            print(f"[Open tracked] ✗ Lead {lead_id} not found")
+            # 打开/点击/回复归到最近一次发送的那一步
+            step, first = max(lead['current_step'] - 1, 1), not lead[EVENT_FLAGS[event_type]]
+        first = first and (lead_id, event_type) not in seen
+        seen.add((lead_id, event_type))
+        rows.append((lead_id, lead['campaign_id'], event_type, step, created_at))
+        accounts[lead['campaign_id']] = lead['account_email'] or ""
+        for bucket in (created_at[:13] + ":00", created_at[:10]):
+            key = (lead['campaign_id'], bucket, step, event_type)
+            total = counts.setdefault(key, [0, 0])
+            total[0] += 1
+            total[1] += first
+    if not rows:
+        return 0
+    conn.executemany("INSERT INTO events(lead_id, campaign_id, type, step, created_at) VALUES(?,?,?,?,?)", rows)
+    for table, width in (("event_counts_hourly", 16), ("event_counts_daily", 10)):
+        conn.executemany(
+            f"INSERT INTO {table}(campaign_id, bucket, step, type, events, leads) VALUES(?,?,?,?,?,?) "
+            f"ON CONFLICT DO UPDATE SET events=events+excluded.events, leads=leads+excluded.leads",
+            [(*key, n, first) for key, (n, first) in counts.items() if len(key[1]) == width])
+    for (cid, bucket, _, event_type), (n, _) in counts.items():
+        if len(bucket) == 10:
+            events_total.inc(n, campaign=cid, account=accounts[cid], type=event_type)
+    return len(rows)
+
+def apply_tracking_events(conn, events) -> int:
+    """记录打开/点击事件并设置 leads 标记，events 为 [(lead_id, 'open'|'click', ISO时间)]，返回新标记的lead数"""
+    record_events(conn, events)
+    ids = {"open": set(), "click": set()}
+    for lead_id, kind, _ in events:
+        ids[kind].add(lead_id)
+    updated = 0
+    for kind, lead_ids in ids.items():
+        if lead_ids:
+            column = EVENT_FLAGS[kind]
+            cursor = conn.executemany(f"UPDATE leads SET {column}=1 WHERE id=? AND {column}=0", [(i,) for i in lead_ids])
+            updated += cursor.rowcount
+    return updated
+
+def claim_tracker_events(conn, event_ids: list) -> set:
+    """记录追踪服务的事件ID，返回之前没有处理过的ID（需在写连接的同一事务中调用）"""
+    fresh = set(event_ids)
+    for i in range(0, len(event_ids), 500):
+        part = event_ids[i:i + 500]
+        fresh.difference_update(r[0] for r in conn.execute(
+            f"SELECT event_id FROM tracker_events_seen WHERE event_id IN ({','.join('?' * len(part))})", part))
+    now = time.time()
+    conn.executemany("INSERT OR IGNORE INTO tracker_events_seen(event_id, received_at) VALUES(?, ?)",
+                     [(event_id, now) for event_id in fresh])
+    return fresh
+
+tracking_events = TrackingEventWriter(TRACK_FLUSH_EVENTS, TRACK_FLUSH_MS, TRACK_QUEUE_SIZE)
+
+# 1x1透明GIF
+PIXEL_GIF = base64.b64decode("R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7")
+PIXEL_HEADERS = {"Cache-Control": "no-store, no-cache, must-revalidate", "Pragma": "no-cache"}
+
+@app.get("/track/open/{lead_id}")
+async def track_open(lead_id: int):
+    """追踪邮件打开（只入队，不访问数据库）"""
+    tracking_events.record("open", lead_id)
+    return Response(content=PIXEL_GIF, media_type="image/gif", headers=PIXEL_HEADERS)
+
+@app.get("/l/{token}")
+async def follow_link(token: str):
+    """点击追踪短链：校验签名后跳转，点击事件只入队；目标地址通常已在内存缓存中，不访问数据库"""
+    parsed = parse_link_token(token)
+    if not parsed:
+        raise HTTPException(404, "Link not found")
+    lead_id, link_id = parsed
+    url = links_cache.cached(link_id) or await run_in_threadpool(links_cache.resolve, link_id)
+    if not url:
+        raise HTTPException(404, "Link not found")
+    tracking_events.record("click", lead_id)
+    return RedirectResponse(url)
 
-    # 返回1x1透明GIF
-    gif = base64.b64decode("R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7")
-    return HTMLResponse(content=gif, media_type="image/gif")
+def is_lead_link(lead_id: int, url: str) -> bool:
+    with get_db(readonly=True) as conn:
+        return conn.execute(LEAD_LINK_SQL, (lead_id, url)).fetchone() is not None
 
 @app.get("/track/click/{lead_id}")
-def track_click(lead_id: int, url: str):
-    with get_db() as conn:
-        conn.execute("UPDATE leads SET clicked=1 WHERE id=?", (lead_id,))
-        conn.commit()
+async def track_click(lead_id: int, url: str):
+    """旧的点击追踪地址：只跳转到该lead所在campaign发出过的链接，不能被用来跳转到任意网站"""
+    if not await run_in_threadpool(is_lead_link, lead_id, url):
+        raise HTTPException(404, "Link not found")
+    tracking_events.record("click", lead_id)
     return RedirectResponse(url)
 
+ACCOUNTS_SQL = "SELECT id, email, created_at, rate_per_minute, daily_cap, work_start, work_end FROM accounts"
+
 @app.get("/api/accounts")
 def list_accounts():
     with get_db() as conn:
-        rows = conn.execute("SELECT id, email, created_at FROM accounts").fetchall()
-        accounts = [dict(r) for r in rows]
         # 测试模式下添加虚拟账号
-        if TEST_MODE and not accounts:
+        if TEST_MODE and not conn.execute("SELECT 1 FROM accounts LIMIT 1").fetchone():
             conn.execute("INSERT OR IGNORE INTO accounts(email, token) VALUES(?, ?)",
                         ("test@example.com", "{}"))
             conn.commit()
-            accounts = [{"id": 1, "email": "test@example.com", "created_at": "test"}]
-        return accounts
+        return [dict(r) for r in conn.execute(ACCOUNTS_SQL).fetchall()]
+
+def parse_hour(value: str) -> Optional[int]:
+    if value in (None, ""):
+        return None
+    hour = int(value)
+    if not 0 <= hour <= 23:
+        raise HTTPException(400, "工作时间需为 0-23 之间的小时")
+    return hour
+
+@app.put("/api/accounts/{email}/limits")
+def update_account_limits(email: str, rate_per_minute: float = Form(ACCOUNT_RATE_PER_MINUTE),
+                          daily_cap: int = Form(ACCOUNT_DAILY_CAP), work_start: str = Form(""), work_end: str = Form("")):
+    """设置账号的发送速率（每分钟）、每日上限（0为不限）和工作时间窗口（留空为全天）"""
+    if rate_per_minute <= 0:
+        raise HTTPException(400, "发送速率需大于0")
+    start, end = parse_hour(work_start), parse_hour(work_end)
+    if (start is None) != (end is None):
+        raise HTTPException(400, "工作时间需同时设置开始和结束")
+    with get_db() as conn:
+        updated = conn.execute("UPDATE accounts SET rate_per_minute=?, daily_cap=?, work_start=?, work_end=? WHERE email=?",
+                               (rate_per_minute, max(0, daily_cap), start, end, email)).rowcount
+        conn.commit()
+    if not updated:
+        raise HTTPException(404)
+    send_engine.refresh_account(email)
+    return {"ok": True}
+
+@app.get("/api/accounts/{email}/quota")
+def account_quota(email: str):
+    """账号今天的发送额度：已发送、剩余数量、是否在工作时间内"""
+    with get_db(readonly=True) as conn:
+        if not conn.execute("SELECT 1 FROM accounts WHERE email=?", (email,)).fetchone():
+            raise HTTPException(404)
+        limits = account_limits(conn, email)
+        sent = conn.execute(ACCOUNT_SENT_TODAY_SQL, (datetime.now().date().isoformat(), email)).fetchone()[0]
+        campaigns = [r['id'] for r in conn.execute(ACCOUNT_CAMPAIGNS_SQL, (email,)).fetchall()]
+    window_wait = seconds_until_window(limits)
+    return {
+        **limits, "sent_today": sent,
+        "remaining_today": max(0, limits['daily_cap'] - sent) if limits['daily_cap'] else None,
+        "in_window": window_wait == 0,
+        "window_opens_at": (datetime.now() + timedelta(seconds=window_wait)).isoformat(timespec='minutes')
+                           if window_wait else None,
+        "running_campaigns": campaigns, "sender": send_engine.account_state(email),
+    }
+
+# 每个步骤还剩多少lead要发送（强制走 idx_leads_pending 部分索引，原因同 DUE_LEADS_SQL）
+REMAINING_BY_STEP_SQL = """
+    SELECT current_step, COUNT(*) FROM leads INDEXED BY idx_leads_pending
+    WHERE campaign_id=? AND status='pending' AND replied=0
+    GROUP BY current_step
+"""
+
+def campaign_projection_data(conn, cid: int) -> dict:
+    campaign = conn.execute("SELECT * FROM campaigns WHERE id=?", (cid,)).fetchone()
+    if not campaign:
+        raise HTTPException(404)
+    steps = conn.execute("SELECT step, delay_days FROM templates WHERE campaign_id=? ORDER BY step", (cid,)).fetchall()
+    remaining = 0
+    first_step = None
+    for step, count in conn.execute(REMAINING_BY_STEP_SQL, (cid,)).fetchall():
+        remaining += count * sum(1 for s in steps if s['step'] >= step)
+        first_step = step if first_step is None else min(first_step, step)
+    result = {"campaign_id": cid, "status": campaign['status'], "remaining_sends": remaining}
+    if not remaining:
+        return {**result, "per_day": None, "days": 0, "finish_at": None}
+    if campaign['status'] != 'running' or not campaign['account_email']:
+        return {**result, "per_day": None, "days": None, "finish_at": None}
+
+    # 每天能发送的数量：campaign自己的速率、账号速率和每日上限（按运行中的campaign平分）、campaign每日上限中的最小值
+    limits = account_limits(conn, campaign['account_email'])
+    shares = max(1, len(conn.execute(ACCOUNT_CAMPAIGNS_SQL, (campaign['account_email'],)).fetchall()))
+    minutes = work_minutes_per_day(limits)
+    batch = max(1, campaign['batch_size'] or SEND_BATCH_SIZE)
+    bounds = {"campaign_rate": batch * minutes / (campaign['interval_minutes'] or 5),
+              "account_rate": limits['rate_per_minute'] * minutes / shares}
+    if limits['daily_cap']:
+        bounds["account_daily_cap"] = limits['daily_cap'] / shares
+    if campaign['daily_limit']:
+        bounds["campaign_daily_limit"] = campaign['daily_limit']
+    limited_by = min(bounds, key=bounds.get)
+    per_day = bounds[limited_by]
+    # 后续步骤之间至少间隔 delay_days，速率再高也不会早于这个时间完成
+    delay_days = sum(s['delay_days'] or 0 for s in steps if s['step'] > first_step)
+    days = max(remaining / per_day, delay_days)
+    return {**result, "per_day": round(per_day, 1), "limited_by": limited_by, "days": round(days, 2),
+            "finish_at": (datetime.now() + timedelta(days=days)).isoformat(timespec='minutes')}
+
+@app.get("/api/campaigns/{cid}/projection")
+def campaign_projection(cid: int):
+    """预计完成时间：剩余待发送数量（每个lead剩余的步骤数）除以每天可发送的数量"""
+    with get_db(readonly=True) as conn:
+        return campaign_projection_data(conn, cid)
+
+# 总数来自触发器维护的 campaign_counters；分步骤统计从按天汇总表读取，leads 列是首次发生该事件的人数
+STAT_NAMES = {"sent": "sent", "open": "opens", "click": "clicks", "reply": "replies"}
+CAMPAIGN_COUNTERS_SQL = "SELECT * FROM campaign_counters WHERE campaign_id=?"
+ALL_CAMPAIGN_COUNTERS_SQL = """
+    SELECT c.id AS campaign_id, c.status, cc.* FROM campaigns c
+    LEFT JOIN campaign_counters cc ON cc.campaign_id = c.id ORDER BY c.id DESC
+"""
+# 汇总表行数只和天数×步骤数有关，直接按主键顺序读出后在内存中合并，不需要临时排序
+CAMPAIGN_STEP_STATS_SQL = "SELECT step, type, leads FROM event_counts_daily WHERE campaign_id=?"
+CAMPAIGN_TIMELINE_SQL = """
+    SELECT bucket, type, events, leads FROM {table} WHERE campaign_id=? AND bucket>=? ORDER BY bucket
+"""
+
+def counter_stats(row) -> dict:
+    return {name: (row[name] or 0) if row else 0 for name in CAMPAIGN_COUNTER_TERMS}
+
+@app.get("/api/stats/campaigns")
+def all_campaign_stats():
+    """所有campaign的计数（列表页一次请求获取）"""
+    with get_db(readonly=True) as conn:
+        rows = conn.execute(ALL_CAMPAIGN_COUNTERS_SQL).fetchall()
+    return [{"campaign_id": row['campaign_id'], "status": row['status'], **counter_stats(row)} for row in rows]
 
 @app.get("/api/campaigns/{cid}/stats")
 def campaign_stats(cid: int):
-    with get_db() as conn:
-        stats = conn.execute("""
-            SELECT COUNT(*) as total, SUM(opened) as opens, SUM(clicked) as clicks, SUM(replied) as replies,
-            SUM(CASE WHEN status IN ('completed', 'replied') OR current_step > 1 THEN 1 ELSE 0 END) as sent
-            FROM leads WHERE campaign_id=?
-        """, (cid,)).fetchone()
-        return dict(stats)
+    """总数和各步骤的发送/打开/点击/回复人数"""
+    with get_db(readonly=True) as conn:
+        counters = conn.execute(CAMPAIGN_COUNTERS_SQL, (cid,)).fetchone()
+        rows = conn.execute(CAMPAIGN_STEP_STATS_SQL, (cid,)).fetchall()
+    stats = counter_stats(counters)
+    steps = {}
+    for row in rows:
+        name = STAT_NAMES.get(row['type'])
+        if name:
+            steps.setdefault(row['step'], {"step": row['step'], **{n: 0 for n in STAT_NAMES.values()}})[name] += row['leads']
+    stats["steps"] = [steps[k] for k in sorted(steps)]
+    return stats
+
+@app.get("/api/campaigns/{cid}/timeline")
+def campaign_timeline(cid: int, granularity: str = "day", days: int = 14):
+    """按小时或天的事件曲线，每个时间桶返回各类型的事件次数和首次发生人数"""
+    if granularity not in ("hour", "day"):
+        raise HTTPException(400, "granularity 只支持 hour 或 day")
+    table = "event_counts_hourly" if granularity == "hour" else "event_counts_daily"
+    since = (datetime.now() - timedelta(days=max(1, min(days, 366)))).isoformat()[:10]
+    with get_db(readonly=True) as conn:
+        rows = conn.execute(CAMPAIGN_TIMELINE_SQL.format(table=table), (cid, since)).fetchall()
+    buckets = {}
+    for row in rows:
+        bucket = buckets.setdefault(row['bucket'], {"bucket": row['bucket']})
+        counts = bucket.setdefault(STAT_NAMES.get(row['type'], row['type']), {"events": 0, "leads": 0})
+        counts["events"] += row['events']
+        counts["leads"] += row['leads']
+    return {"granularity": granularity, "buckets": list(buckets.values())}
 
 @app.post("/api/campaigns/{cid}/check-replies")
 def check_replies_now(cid: int):
     """手动触发检查回复"""
-    with get_db() as conn:
+    with get_db(readonly=True) as conn:
         campaign = conn.execute("SELECT account_email FROM campaigns WHERE id=?", (cid,)).fetchone()
         if not campaign or not campaign['account_email']:
             return {"msg": "请先启动campaign以设置发件账号"}
-    check_replies(cid, campaign['account_email'])
+    check_replies(campaign['account_email'])
     return {"msg": "检查完成"}
 
+@app.get("/api/system/stats")
+def system_stats():
+    """内部缓存等运行状态"""
+    return {"gmail_cache": gmail_services.stats(), "template_cache": templates_cache.stats(),
+            "email_validation": email_checks.stats(), "db_pool": db_pool.stats(), "send_engine": send_engine.stats(),
+            "tracking": tracking_events.stats(), "tracker_sync": {**tracker_sync.stats(), "poll_minutes": tracker_poll_minutes},
+            "tracker_push": tracker_push_stats, "workers": worker_status(), "links": links_cache.stats(),
+            "suppression": suppression.stats()}
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+metrics.register(Gauge("pitch_send_in_flight", "Gmail send requests in progress", lambda: send_engine.in_flight))
+metrics.register(Gauge("pitch_tracking_queue_events", "Tracking events waiting to be written",
+                       lambda: tracking_events.stats()["pending"]))
+metrics.register(Gauge("pitch_tracking_dropped_events_total", "Tracking events dropped because the queue was full",
+                       lambda: tracking_events.dropped, kind="counter"))
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Prometheus 文本格式的指标（本进程的；web 和 worker 分开运行时，worker 的指标见 METRICS_PORT）"""
+    return Response(metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+def start_metrics_server(port: int):
+    """worker 模式没有 HTTP 接口，在单独的端口上提供 GET /metrics"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                return self.send_error(404)
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    jobs_log.info("Metrics on port %d", port)
+    return server
+
 @app.post("/api/leads/{lead_id}/mark")
 def mark_lead(lead_id: int, field: str):
     """手动标记lead状态（用于测试）"""
     if field not in ('opened', 'clicked', 'replied'):
         raise HTTPException(400, "Invalid field")
+    event_type = {"opened": "open", "clicked": "click", "replied": "reply"}[field]
     with get_db() as conn:
+        record_events(conn, [(lead_id, event_type, datetime.now().isoformat())])
         if field == 'replied':
             conn.execute("UPDATE leads SET replied=1, status='replied' WHERE id=?", (lead_id,))
         else:
@@ -613,118 +3508,315 @@ def mark_lead(lead_id: int, field: str):
 # 自动同步追踪数据（从Render tracker拉取）
 # ============================================
 
+class TrackerSync:
+    """从外部追踪服务分页拉取打开/点击记录
+
+    复用一个带连接池的 requests.Session；每页记录在一个事务中批量写入，
+    然后分块通知追踪服务标记为已同步。lag_seconds 为最近一次同步时最早一条记录距今的时间。
+    """
+
+    KINDS = {"open": ("opens", "open_ids"), "click": ("clicks", "click_ids")}
+
+    def __init__(self, page_size: int, max_pages: int, ack_chunk: int):
+        self.page_size, self.max_pages, self.ack_chunk = page_size, max_pages, ack_chunk
+        self._session = None
+        self._lock = threading.Lock()
+        self.runs = self.pages = self.errors = 0
+        self.pulled = {"open": 0, "click": 0}
+        self.updated = 0
+        self.last_success = None
+        self.lag_seconds = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            session = requests.Session()
+            retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=frozenset({"GET", "POST"}))
+            session.mount("http://", HTTPAdapter(pool_maxsize=4, max_retries=retry))
+            session.mount("https://", HTTPAdapter(pool_maxsize=4, max_retries=retry))
+            self._session = session
+        return self._session
+
+    def run(self, tracker_url: str) -> Optional[int]:
+        """执行一次同步，返回新写入的记录数（不含推送接口已处理的）；出错或已有同步在运行时返回 None"""
+        # 调度任务和手动触发不并发执行，避免重复拉取同一页
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            self.runs += 1
+            oldest, pulled_before = None, sum(self.pulled.values())
+            for kind in self.KINDS:
+                kind_oldest = self._sync_kind(tracker_url, kind)
+                if kind_oldest and (oldest is None or kind_oldest < oldest):
+                    oldest = kind_oldest
+            self.lag_seconds = round((datetime.now() - oldest).total_seconds(), 1) if oldest else 0
+            self.last_success = datetime.now().isoformat()
+            pulled = sum(self.pulled.values()) - pulled_before
+            if pulled:
+                tracking_log.info("Applied %d tracker record(s), lag %ss", pulled, self.lag_seconds)
+            return pulled
+        except Exception as e:
+            self.errors += 1
+            tracking_log.error("Tracker sync failed: %s", e)
+        finally:
+            self._lock.release()
+
+    def _sync_kind(self, tracker_url: str, kind: str):
+        """同步一种记录，返回本次拉到的最早记录时间"""
+        key, ack_key = self.KINDS[kind]
+        after_id, oldest = 0, None
+        for _ in range(self.max_pages):
+            response = self.session.get(f"{tracker_url}/api/{key}",
+                                        params={"limit": self.page_size, "after_id": after_id}, timeout=10)
+            if response.status_code != 200:
+                tracking_log.warning("Tracker API returned %s", response.status_code)
+                break
+            records = [r for r in response.json().get(key, []) if r.get('id') is not None]
+            if not records:
+                break
+            self.pages += 1
+
+            now = datetime.now().isoformat()
+            events = {}
+            for record in records:
+                # 统一成本地时间的ISO字符串，按小时/天汇总时才能落到正确的桶；解析失败按同步时间记录
+                when = parse_event_time(record.get('timestamp'))
+                try:
+                    events[f"{kind}:{record['id']}"] = (int(record['uid']), kind, when.isoformat() if when else now)
+                except (KeyError, TypeError, ValueError):
+                    pass
+                if when and (oldest is None or when < oldest):
+                    oldest = when
+            with get_db() as conn:
+                # 已经通过推送接口处理过的记录只需要确认同步
+                fresh = claim_tracker_events(conn, list(events))
+                self.updated += apply_tracking_events(conn, [e for k, e in events.items() if k in fresh])
+                conn.commit()
+            # 只统计新记录：推送接口已处理、尚未确认的记录仍会被拉到，不能算作轮询拿到了新数据，否则轮询间隔不会退避
+            self.pulled[kind] += len(fresh)
+
+            ids = [r['id'] for r in records]
+            for i in range(0, len(ids), self.ack_chunk):
+                body = {"open_ids": [], "click_ids": []}
+                body[ack_key] = ids[i:i + self.ack_chunk]
+                self.session.post(f"{tracker_url}/api/mark_synced", json=body, timeout=10).raise_for_status()
+
+            # 旧版追踪服务不支持分页参数时会一次返回全部未同步记录
+            if len(records) < self.page_size or max(ids) <= after_id:
+                break
+            after_id = max(ids)
+        return oldest
+
+    def stats(self) -> dict:
+        return {"runs": self.runs, "pages": self.pages, "errors": self.errors, "pulled_opens": self.pulled["open"],
+                "pulled_clicks": self.pulled["click"], "updated_leads": self.updated,
+                "last_success": self.last_success, "lag_seconds": self.lag_seconds}
+
+def parse_event_time(value) -> Optional[datetime]:
+    """解析追踪服务记录的时间（ISO格式，带时区的转换为本地时间）"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return parsed.astimezone().replace(tzinfo=None) if parsed.tzinfo else parsed
+
+tracker_sync = TrackerSync(TRACKER_SYNC_PAGE_SIZE, TRACKER_SYNC_MAX_PAGES, TRACKER_ACK_CHUNK)
+tracker_poll_minutes = TRACKER_POLL_MINUTES
+
 def sync_tracker_data():
     """
-    从Render追踪服务同步数据到本地数据库
-    每10分钟自动运行一次
+    从Render追踪服务同步数据到本地数据库（推送接口的兜底）
+    拉到新记录时恢复 TRACKER_POLL_MINUTES 间隔，连续没有新记录（包括只拉到推送接口已处理的记录）时间隔翻倍，
+    最长 TRACKER_POLL_MAX_MINUTES
     """
-    import requests
-
+    global tracker_poll_minutes
     tracker_url = os.environ.get("TRACKER_URL", "")
 
     if not tracker_url or "your-tracker" in tracker_url:
         # 未配置追踪URL，跳过同步
         return
+    if not acquire_lease("job:sync_tracker", tracker_poll_minutes * 60 * 0.9):
+        return  # 本周期已由其他 worker 同步
 
-    try:
-        # 获取未同步的打开记录
-        response = requests.get(f"{tracker_url}/api/opens", timeout=10)
-        if response.status_code != 200:
-            print(f"[Sync Warning] Tracker API returned {response.status_code}")
-            return
-
-        data = response.json()
-        opens = data.get("opens", [])
-
-        if not opens:
-            return
-
-        # 更新本地数据库
-        with get_db() as conn:
-            updated = 0
-            synced_ids = []
-
-            for record in opens:
-                uid = record['uid']
-                record_id = record['id']
-
-                try:
-                    # 检查lead是否存在且未标记打开
-                    lead = conn.execute(
-                        "SELECT opened FROM leads WHERE id=?",
-                        (uid,)
-                    ).fetchone()
-
-                    if lead and lead[0] == 0:
-                        conn.execute("UPDATE leads SET opened=1 WHERE id=?", (uid,))
-                        updated += 1
-
-                    synced_ids.append(record_id)
+    pulled = tracker_sync.run(tracker_url.rstrip("/"))
+    purge_tracker_seen()
+    if pulled is None:
+        return
+    minutes = TRACKER_POLL_MINUTES if pulled else min(tracker_poll_minutes * 2, TRACKER_POLL_MAX_MINUTES)
+    if minutes != tracker_poll_minutes:
+        tracker_poll_minutes = minutes
+        try:
+            scheduler.reschedule_job('sync_tracker', trigger='interval', minutes=minutes)
+            jobs_log.info("Tracker sync interval -> %d minutes", minutes)
+        except Exception:
+            pass  # 手动调用时没有调度任务
+
+def purge_tracker_seen():
+    with get_db() as conn:
+        conn.execute("DELETE FROM tracker_events_seen WHERE received_at < ?", (time.time() - TRACKER_SEEN_DAYS * 86400,))
+        conn.commit()
 
-                except Exception as e:
-                    print(f"[Sync Error] Lead {uid}: {e}")
+# ============================================
+# 追踪服务推送（POST /api/tracker/events）
+# ============================================
 
-            conn.commit()
+tracker_push_stats = {"batches": 0, "applied": 0, "duplicates": 0, "rejected": 0}
 
-        # 标记远程记录为已同步
-        if synced_ids:
-            try:
-                requests.post(
-                    f"{tracker_url}/api/mark_synced",
-                    json={"open_ids": synced_ids, "click_ids": []},
-                    timeout=5
-                )
-                print(f"[Sync] Updated {updated} opens, marked {len(synced_ids)} as synced")
-            except:
-                pass  # 忽略标记失败
-
-        # 同步点击记录
-        response = requests.get(f"{tracker_url}/api/clicks", timeout=10)
-        if response.status_code == 200:
-            clicks = response.json().get("clicks", [])
-            if clicks:
-                with get_db() as conn:
-                    click_ids = []
-                    for record in clicks:
-                        try:
-                            conn.execute("UPDATE leads SET clicked=1 WHERE id=?", (record['uid'],))
-                            click_ids.append(record['id'])
-                        except:
-                            pass
-                    conn.commit()
+def verify_tracker_signature(body: bytes, timestamp: str, signature: str) -> bool:
+    """签名为 HMAC-SHA256(TRACKER_SECRET, "<timestamp>." + 原始请求体) 的十六进制，时间戳为Unix秒"""
+    if not TRACKER_SECRET or not timestamp or not signature:
+        return False
+    try:
+        if abs(time.time() - int(timestamp)) > TRACKER_SIGNATURE_TOLERANCE:
+            return False
+    except ValueError:
+        return False
+    expected = hmac.new(TRACKER_SECRET.encode(), timestamp.encode() + b"." + body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature.removeprefix("sha256="))
+
+def ingest_tracker_events(records: list) -> dict:
+    """写入一批推送的事件，按事件ID去重"""
+    events, invalid = {}, 0
+    now = datetime.now().isoformat()
+    for record in records:
+        try:
+            kind = record['type']
+            if kind not in ('open', 'click'):
+                raise ValueError(kind)
+            when = parse_event_time(record.get('timestamp'))
+            events[f"{kind}:{record['id']}"] = (int(record['uid']), kind, when.isoformat() if when else now)
+        except (KeyError, TypeError, ValueError):
+            invalid += 1
+    with get_db() as conn:
+        fresh = claim_tracker_events(conn, list(events))
+        apply_tracking_events(conn, [e for k, e in events.items() if k in fresh])
+        conn.commit()
+    tracker_push_stats["batches"] += 1
+    tracker_push_stats["applied"] += len(fresh)
+    tracker_push_stats["duplicates"] += len(events) - len(fresh)
+    return {"accepted": len(fresh), "duplicates": len(events) - len(fresh), "invalid": invalid}
+
+@app.post("/api/tracker/events")
+async def tracker_events_push(request: Request):
+    """追踪服务批量推送打开/点击事件
+
+    请求体 {"events": [{"id": 记录ID, "type": "open"|"click", "uid": lead_id, "timestamp": ISO时间}]}，
+    请求头 X-Tracker-Timestamp 和 X-Tracker-Signature（见 verify_tracker_signature）。
+    记录ID与 /api/opens、/api/clicks 返回的一致，重复推送或之后再被轮询到都只处理一次。
+    """
+    body = await request.body()
+    if not verify_tracker_signature(body, request.headers.get("x-tracker-timestamp", ""),
+                                    request.headers.get("x-tracker-signature", "")):
+        tracker_push_stats["rejected"] += 1
+        raise HTTPException(401, "invalid signature")
+    try:
+        records = json.loads(body).get("events", [])
+    except (ValueError, AttributeError):
+        raise HTTPException(400, "invalid body")
+    if not isinstance(records, list):
+        raise HTTPException(400, "events must be a list")
+    return await run_in_threadpool(ingest_tracker_events, records)
 
-                if click_ids:
-                    requests.post(
-                        f"{tracker_url}/api/mark_synced",
-                        json={"open_ids": [], "click_ids": click_ids},
-                        timeout=5
-                    )
+# ============================================
+# 热点查询的查询计划检查（python app.py check-plans）
+# ============================================
 
-    except requests.exceptions.RequestException as e:
-        print(f"[Sync Error] {e}")
-    except Exception as e:
-        print(f"[Sync Error] Unexpected: {e}")
-
-# 添加自动同步任务（每10分钟）
-if os.environ.get("TRACKER_URL"):
-    scheduler.add_job(
-        sync_tracker_data,
-        'interval',
-        minutes=10,
-        id='sync_tracker',
-        replace_existing=True
-    )
-    print("[Scheduler] Tracker sync enabled (every 10 minutes)")
+HOT_QUERIES = {
+    "due_leads": (DUE_LEADS_SQL, (1, 100)),
+    "send_queue_outstanding": (SEND_QUEUE_OUTSTANDING_SQL, (1,)),
+    "claim_sends": (CLAIM_SENDS_SQL, ("worker", 0, 1, 0, 10)),
+    "sent_today": (SENT_TODAY_SQL, (1, "2024-01-01")),
+    "account_sent_today": (ACCOUNT_SENT_TODAY_SQL, ("2024-01-01", "me@x.com")),
+    "campaign_leads": leads_page_query(1, list(LEAD_LIST_FIELDS), [], 0, 100),
+    "campaign_leads_by_status": leads_page_query(1, list(LEAD_LIST_FIELDS), lead_filters(status="completed", replied=False), 0, 100),
+    "leads_page": (LEADS_PAGE_SQL, (1, 0, 100)),
+    "template_by_step": (TEMPLATE_BY_STEP_SQL, (1, 1)),
+    "existing_lead_emails": (EXISTING_LEAD_EMAILS_SQL.format(placeholders="?,?"), (1, "a@x.com", "b@x.com")),
+    "reply_accounts": (REPLY_ACCOUNTS_SQL, ()),
+    "reply_candidates": (REPLY_CANDIDATES_SQL.format(placeholders="?,?"), ("me@x.com", "a@x.com", "b@x.com")),
+    "campaign_counters": (CAMPAIGN_COUNTERS_SQL, (1,)),
+    "all_campaign_counters": (ALL_CAMPAIGN_COUNTERS_SQL, ()),
+    "campaign_step_stats": (CAMPAIGN_STEP_STATS_SQL, (1,)),
+    "campaign_timeline": (CAMPAIGN_TIMELINE_SQL.format(table="event_counts_hourly"), (1, "2024-01-01")),
+    "link_by_id": (LINK_BY_ID_SQL, (1,)),
+    "link_ids": (LINK_IDS_SQL.format(placeholders="?,?"), (1, "https://a.com", "https://b.com")),
+    "lead_link": (LEAD_LINK_SQL, (1, "https://a.com")),
+    "suppression_changes": (SUPPRESSION_CHANGES_SQL, (0,)),
+    "suppression_page": (SUPPRESSION_PAGE_SQL, ("", 100)),
+    "campaign_leads_chunk": (CAMPAIGN_CHUNK_SQL["leads"], (1, 1000)),
+    "campaign_events_chunk": (CAMPAIGN_CHUNK_SQL["events"], (1, 1000)),
+    "campaign_queue_chunk": (CAMPAIGN_QUEUE_CHUNK_SQL, (1, 0, 1000)),
+    "campaign_queue_leased": (CAMPAIGN_QUEUE_LEASED_SQL, (1, 0)),
+}
+# 这些表会随leads/事件数量增长，不允许出现全表扫描
+LARGE_TABLES = {"leads", "l", "events", "event_counts_hourly", "event_counts_daily", "send_queue", "q", "links", "k", "suppression"}
+
+def audit_query_plans(conn) -> dict:
+    """返回 {查询名: {"plan": [...], "full_scans": [...]}}"""
+    report = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        full_scans = [p for p in plan if p.startswith("SCAN ") and p.split()[1] in LARGE_TABLES]
+        if any(p.split()[1] in LARGE_TABLES for p in plan if p.startswith("SEARCH ")):
+            # 分页查询在大表上排序也需要走索引
+            full_scans += [p for p in plan if p.startswith("USE TEMP B-TREE")]
+        report[name] = {"plan": plan, "full_scans": full_scans}
+    return report
+
+def check_plans() -> int:
+    with get_db(readonly=True) as conn:
+        report = audit_query_plans(conn)
+    failed = 0
+    for name, result in report.items():
+        ok = not result["full_scans"]
+        failed += not ok
+        print(f"[{'OK' if ok else 'FULL SCAN'}] {name}")
+        for line in result["plan"]:
+            print(f"    {line}")
+    return 1 if failed else 0
 
 # 前端页面
 @app.get("/", response_class=HTMLResponse)
 def index():
     return Path("index.html").read_text(encoding='utf-8')
 
-# 启动时恢复运行中的 campaigns（延迟执行，确保所有函数已定义）
-scheduler.add_job(restore_running_campaigns, 'date', id='restore_on_start')
+def run_worker():
+    """worker 模式：不提供 HTTP 接口，只运行发送引擎和定时任务，收到 SIGINT/SIGTERM 后等正在进行的发送完成再退出"""
+    import signal
+
+    async def main():
+        if METRICS_PORT:
+            start_metrics_server(METRICS_PORT)
+        start_background_jobs()
+        await send_engine.start()
+        jobs_log.info("Worker %s started", WORKER_ID)
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+        await stop_event.wait()
+        await send_engine.stop()
+        scheduler.shutdown(wait=False)
+        jobs_log.info("Worker %s stopped", WORKER_ID)
+
+    asyncio.run(main())
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["check-plans"]:
+        sys.exit(check_plans())
+    if sys.argv[1:2] == ["worker"]:
+        APP_ROLE = "worker"
+        run_worker()
+        sys.exit(0)
+    if sys.argv[1:2] == ["web"]:
+        APP_ROLE = "web"
+
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
     uvicorn.run(app, host="0.0.0.0", port=port)
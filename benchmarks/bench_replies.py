@@ -0,0 +1,109 @@
+"""回复检查压测：对比逐条获取邮件头、batch 全量扫描与 historyId 增量同步的每次检查耗时
+
+在临时目录中创建数据库，使用本地模拟 Gmail（见 fake_gmail.py），不会访问真实 Gmail。
+
+运行:  python benchmarks/bench_replies.py --sizes 100 500 2000 --latency 20
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_gmail import FakeGmail, start_server  # noqa: E402
+
+FAKE_TOKEN = {
+    "token": "fake-access-token", "refresh_token": "fake-refresh-token",
+    "client_id": "fake", "client_secret": "fake", "token_uri": "https://oauth2.googleapis.com/token",
+}
+
+
+def setup_app(endpoint: str):
+    """在临时目录中导入 app 并指向模拟 Gmail"""
+    os.environ["GMAIL_API_ENDPOINT"] = endpoint
+    os.environ["TEST_MODE"] = "false"
+    os.chdir(tempfile.mkdtemp(prefix="bench_replies_"))
+    import app
+    token = dict(FAKE_TOKEN, expiry=(datetime.utcnow() + timedelta(hours=6)).isoformat() + "Z")
+    with app.get_db() as conn:
+        conn.execute("INSERT OR REPLACE INTO accounts(email, token) VALUES(?, ?)", ("me@example.com", json.dumps(token)))
+        cid = conn.execute("INSERT INTO campaigns(name, account_email) VALUES('bench', 'me@example.com')").lastrowid
+        sent_at = (datetime.now() - timedelta(days=1)).isoformat()
+        conn.executemany("INSERT INTO leads(campaign_id, email, data, last_sent_at) VALUES(?,?,'{}',?)",
+                         [(cid, f"lead{i}@example.net", sent_at) for i in range(200)])
+        conn.commit()
+    return app, cid
+
+
+def check_sequential(app, size: int):
+    """旧实现：每封邮件一次 messages.get"""
+    service = app.gmail_services.get("me@example.com")
+    for mid in app.list_message_ids(service, "in:inbox newer_than:7d", size):
+        service.users().messages().get(userId="me", id=mid, format="metadata",
+                                       metadataHeaders=["From", "Date"]).execute()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 500, 2000])
+    parser.add_argument("--latency", type=float, default=20, help="模拟的每个HTTP请求延迟（毫秒）")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    gmail = FakeGmail(0, latency_ms=args.latency)
+    server, url = start_server(gmail)
+    app, cid = setup_app(url)
+
+    results = []
+    for size in args.sizes:
+        gmail.inbox.clear()
+        now = datetime.now().astimezone()
+        for i in range(size):
+            # 每10封邮件中有1封来自lead
+            sender = f"lead{i % 200}@example.net" if i % 10 == 0 else f"other{i}@example.org"
+            gmail.add_message(f"Someone <{sender}>", now - timedelta(minutes=i))
+        app.REPLY_SCAN_LIMIT = size
+
+        def full_scan():
+            # 清除同步位置，强制全量扫描
+            with app.get_db() as conn:
+                conn.execute("DELETE FROM gmail_sync_state")
+                conn.commit()
+            return lambda: app.check_replies("me@example.com")
+
+        def incremental():
+            # 先完成一次全量同步，之后只新到10封邮件
+            app.check_replies("me@example.com")
+            for i in range(10):
+                gmail.add_message(f"Someone <lead{i}@example.net>", datetime.now().astimezone())
+            return lambda: app.check_replies("me@example.com")
+
+        row = {"messages": size}
+        for mode, prepare in (("sequential", lambda: lambda: check_sequential(app, size)),
+                              ("batched", full_scan), ("incremental", incremental)):
+            timings, requests = [], 0
+            for _ in range(args.repeat):
+                with app.get_db() as conn:
+                    conn.execute("UPDATE leads SET replied=0, status='pending' WHERE campaign_id=?", (cid,))
+                    conn.commit()
+                fn = prepare()
+                requests_before = gmail.requests
+                started = time.perf_counter()
+                fn()
+                timings.append(time.perf_counter() - started)
+                requests += gmail.requests - requests_before
+            row[f"{mode}_seconds"] = round(min(timings), 4)
+            row[f"{mode}_http_requests"] = requests // args.repeat
+        results.append(row)
+        print(json.dumps(row), flush=True)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
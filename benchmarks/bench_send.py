@@ -0,0 +1,126 @@
+"""发送压测：对比旧的线程池逐个发送与 asyncio 发送引擎在不同并发设置下的吞吐量和单次发送延迟
+
+在临时目录中创建数据库，使用本地模拟 Gmail（见 fake_gmail.py），不会发送真实邮件。
+账号不设速率和每日上限，每个campaign的令牌桶容量等于lead数，所有到期的leads立即发送。
+
+运行:  python benchmarks/bench_send.py --accounts 4 --campaigns 20 --leads 50 --latency 100
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_gmail import FakeGmail, start_server  # noqa: E402
+from bench_replies import FAKE_TOKEN  # noqa: E402
+
+
+def setup_app(endpoint: str, accounts: int, campaigns: int, leads: int):
+    os.environ["GMAIL_API_ENDPOINT"] = endpoint
+    os.environ["TEST_MODE"] = "false"
+    os.chdir(tempfile.mkdtemp(prefix="bench_send_"))
+    import app
+    token = json.dumps(dict(FAKE_TOKEN, expiry=(datetime.utcnow() + timedelta(hours=6)).isoformat() + "Z"))
+    emails = [f"sender{i}@example.com" for i in range(accounts)]
+    with app.get_db() as conn:
+        conn.executemany("INSERT OR REPLACE INTO accounts(email, token, rate_per_minute, daily_cap) VALUES(?, ?, 1e9, 0)",
+                         [(e, token) for e in emails])
+        for c in range(campaigns):
+            cid = conn.execute("INSERT INTO campaigns(name, account_email, status, batch_size, interval_minutes) "
+                               "VALUES(?, ?, 'paused', ?, 60)", (f"bench{c}", emails[c % accounts], leads)).lastrowid
+            conn.execute("INSERT INTO templates(campaign_id, step, subject, body) VALUES(?, 1, 'Hi {{name}}', 'Hello')",
+                         (cid,))
+            conn.executemany("INSERT INTO leads(campaign_id, email, data) VALUES(?, ?, ?)",
+                             [(cid, f"lead{c}_{i}@example.net", json.dumps({"name": f"L{i}"})) for i in range(leads)])
+        conn.commit()
+    return app
+
+
+def reset(app):
+    with app.get_db() as conn:
+        conn.execute("UPDATE leads SET status='pending', current_step=1, last_sent_at=NULL")
+        conn.execute("DELETE FROM send_queue")
+        conn.commit()
+
+
+def run_threaded(app, gmail, total: int) -> dict:
+    """旧实现：APScheduler 默认10个线程，每个campaign一个任务，任务内用 googleapiclient 逐个同步发送"""
+    def process(cid, account_email):
+        items, _ = app.claim_sends(cid, total, "bench")
+        service = app.gmail_services.get(account_email)
+        for _, lead, subject, body in items:
+            started = time.perf_counter()
+            service.users().messages().send(userId="me", body={"raw": app.build_raw_message(lead['email'], subject, body)}).execute()
+            latencies.append(time.perf_counter() - started)
+
+    with app.get_db() as conn:
+        conn.execute("UPDATE campaigns SET status='running'")
+        conn.commit()
+        campaigns = conn.execute("SELECT id, account_email FROM campaigns").fetchall()
+    latencies = []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(10) as pool:
+        list(pool.map(lambda c: process(c['id'], c['account_email']), campaigns))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {"seconds": elapsed, "sent": len(gmail.sent), "p50": latencies[len(latencies) // 2],
+            "p99": latencies[int(len(latencies) * 0.99)]}
+
+
+async def run_engine(app, gmail, total: int, concurrency: int, per_account: int) -> dict:
+    with app.get_db() as conn:
+        conn.execute("UPDATE campaigns SET status='running'")
+        conn.commit()
+    engine = app.SendEngine(concurrency, per_account)
+    app.send_engine = engine
+    started = time.perf_counter()
+    await engine.start()
+    while engine.sent + engine.failed < total:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    await engine.stop()
+    stats = engine.stats()
+    return {"seconds": elapsed, "sent": len(gmail.sent), "p50": stats["send_ms_p50"] / 1000,
+            "p99": stats["send_ms_p99"] / 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--accounts", type=int, default=4)
+    parser.add_argument("--campaigns", type=int, default=20)
+    parser.add_argument("--leads", type=int, default=50, help="每个campaign的lead数")
+    parser.add_argument("--latency", type=float, default=100, help="模拟的每个HTTP请求延迟（毫秒）")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[8, 32, 64])
+    parser.add_argument("--per-account", type=int, nargs="+", default=[2, 8])
+    args = parser.parse_args()
+
+    gmail = FakeGmail(0, latency_ms=args.latency)
+    server, url = start_server(gmail)
+    app = setup_app(url, args.accounts, args.campaigns, args.leads)
+    total = args.campaigns * args.leads
+
+    runs = [("threaded", None, None)] + [("engine", c, a) for c in args.concurrency for a in args.per_account]
+    for mode, concurrency, per_account in runs:
+        reset(app)
+        gmail.sent.clear()
+        if mode == "threaded":
+            result = run_threaded(app, gmail, total)
+        else:
+            result = asyncio.run(run_engine(app, gmail, total, concurrency, per_account))
+        print(json.dumps({"mode": mode, "concurrency": concurrency, "per_account": per_account, "emails": total,
+                          "seconds": round(result["seconds"], 3), "emails_per_second": round(total / result["seconds"], 1),
+                          "send_ms_p50": round(result["p50"] * 1000, 1), "send_ms_p99": round(result["p99"] * 1000, 1),
+                          "delivered": result["sent"]}), flush=True)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""追踪数据同步压测：积压N条打开/点击记录时一次 sync_tracker_data 的耗时、HTTP请求数和连接数
+
+在临时目录中创建数据库，使用本地模拟追踪服务（见 fake_tracker.py）。
+
+运行:  python benchmarks/bench_tracker_sync.py --sizes 1000 10000 --latency 20
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_tracker import FakeTracker, start_server  # noqa: E402
+
+LEADS = 5000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--latency", type=float, default=20, help="模拟的每个HTTP请求延迟（毫秒）")
+    args = parser.parse_args()
+
+    tracker = FakeTracker(latency_ms=args.latency)
+    server, url = start_server(tracker)
+    os.environ["TRACKER_URL"] = url
+    os.environ["TEST_MODE"] = "true"
+    os.chdir(tempfile.mkdtemp(prefix="bench_tracker_"))
+    import app
+    with app.get_db() as conn:
+        cid = conn.execute("INSERT INTO campaigns(name) VALUES('bench')").lastrowid
+        conn.executemany("INSERT INTO leads(campaign_id, email, data) VALUES(?, ?, '{}')",
+                         [(cid, f"lead{i}@example.net") for i in range(LEADS)])
+        conn.commit()
+        lead_ids = [r[0] for r in conn.execute("SELECT id FROM leads WHERE campaign_id=?", (cid,))]
+
+    for size in args.sizes:
+        for i in range(size):
+            tracker.add("opens" if i % 5 else "clicks", lead_ids[i % len(lead_ids)])
+        requests_before, connections_before = tracker.requests, tracker.connections
+        started = time.perf_counter()
+        app.sync_tracker_data()
+        row = {"records": size, "seconds": round(time.perf_counter() - started, 4),
+               "http_requests": tracker.requests - requests_before,
+               "new_connections": tracker.connections - connections_before,
+               "left_unsynced": tracker.unsynced("opens") + tracker.unsynced("clicks"),
+               "lag_seconds": app.tracker_sync.lag_seconds}
+        print(json.dumps(row), flush=True)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
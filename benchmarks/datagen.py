@@ -0,0 +1,95 @@
+"""合成压测数据：N 个 campaign × M 个 lead × K 步模板，分配到若干发件账号
+
+数据由 seed 决定，同样的参数每次生成相同的内容，不同版本之间的压测结果可以直接比较。
+模板正文包含链接和变量，发送时会经过模板渲染和链接改写。
+
+单独运行（在指定目录生成 data.db）:
+    python benchmarks/datagen.py --dir /tmp/bench_data --campaigns 10 --leads 10000 --steps 3
+"""
+import os
+import sys
+import json
+import random
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_replies import FAKE_TOKEN  # noqa: E402
+
+FIRST_NAMES = ["Alice", "Bob", "Chen", "Dana", "Eve", "Farid", "Grace", "Hiro", "Ines", "Jun", "Kofi", "Lena"]
+COMPANIES = ["Acme", "Globex", "Initech", "Umbrella", "Hooli", "Stark", "Wayne", "Tyrell", "Cyberdyne", "Soylent"]
+CITIES = ["Berlin", "Shanghai", "Austin", "Lagos", "Lima", "Osaka", "Paris", "Toronto"]
+
+
+def lead_rows(cid: int, count: int, rng: random.Random, domain: str = "example.net"):
+    """生成 (campaign_id, email, data) 行"""
+    for i in range(count):
+        data = {"first_name": rng.choice(FIRST_NAMES), "company": rng.choice(COMPANIES),
+                "city": rng.choice(CITIES), "score": rng.randint(1, 100)}
+        yield cid, f"lead{cid}_{i}@{domain}", json.dumps(data)
+
+
+def template_rows(cid: int, steps: int):
+    """生成 (campaign_id, step, subject, body, delay_days) 行，delay_days 为0，所有步骤立即到期"""
+    for step in range(1, steps + 1):
+        subject = "Quick question, {{first_name}}" if step == 1 else f"Following up ({step})"
+        body = ("<p>Hi {{first_name}},</p><p>I noticed {{company}} is growing in {{city}}.</p>"
+                f'<p><a href="https://example.org/demo?step={step}">Book a demo</a> or '
+                '<a href="https://example.org/pricing">see pricing</a>.</p>')
+        yield cid, step, subject, body, 0
+
+
+def generate(app, campaigns: int, leads: int, steps: int, accounts: int = 1, seed: int = 0,
+             status: str = "paused", sent_days: float = 0) -> dict:
+    """写入账号、campaign、模板和leads，返回 {"accounts": [...], "campaigns": [...]}
+
+    campaign 的 batch_size 等于 lead 数 × 步骤数、账号不设速率和每日上限，压测时所有到期的邮件立即发送；
+    sent_days > 0 时把leads标记为这么多天前已发送第一步（用于回复检查和统计场景）。
+    """
+    rng = random.Random(seed)
+    token = json.dumps(dict(FAKE_TOKEN, expiry=(datetime.utcnow() + timedelta(hours=6)).isoformat() + "Z"))
+    emails = [f"sender{i}@example.com" for i in range(accounts)]
+    ids = []
+    with app.get_db() as conn:
+        conn.executemany("INSERT OR REPLACE INTO accounts(email, token, rate_per_minute, daily_cap) VALUES(?, ?, 1e9, 0)",
+                         [(e, token) for e in emails])
+        for c in range(campaigns):
+            cid = conn.execute("INSERT INTO campaigns(name, account_email, status, batch_size, interval_minutes) "
+                               "VALUES(?, ?, ?, ?, 60)", (f"bench{c}", emails[c % accounts], status, leads * steps)).lastrowid
+            ids.append(cid)
+            conn.executemany("INSERT INTO templates(campaign_id, step, subject, body, delay_days) VALUES(?,?,?,?,?)",
+                             template_rows(cid, steps))
+            conn.executemany("INSERT INTO leads(campaign_id, email, data) VALUES(?, ?, ?)", lead_rows(cid, leads, rng))
+            if sent_days:
+                sent_at = (datetime.now() - timedelta(days=sent_days)).isoformat()
+                lead_ids = [r[0] for r in conn.execute("SELECT id FROM leads WHERE campaign_id=?", (cid,))]
+                app.record_events(conn, [(lead_id, "sent", sent_at) for lead_id in lead_ids])
+                conn.execute("UPDATE leads SET last_sent_at=?, current_step=2, status=? WHERE campaign_id=?",
+                             (sent_at, "pending" if steps > 1 else "completed", cid))
+        conn.commit()
+    return {"accounts": emails, "campaigns": ids}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", required=True, help="数据目录（在其中创建 data.db）")
+    parser.add_argument("--campaigns", type=int, default=10)
+    parser.add_argument("--leads", type=int, default=1000, help="每个campaign的lead数")
+    parser.add_argument("--steps", type=int, default=3, help="每个campaign的模板步骤数")
+    parser.add_argument("--accounts", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sent-days", type=float, default=0, help="把第一步标记为N天前已发送")
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    os.chdir(args.dir)
+    import app
+    result = generate(app, args.campaigns, args.leads, args.steps, args.accounts, args.seed, sent_days=args.sent_days)
+    print(json.dumps({"dir": os.path.abspath(args.dir), "accounts": len(result["accounts"]),
+                      "campaigns": len(result["campaigns"]), "leads": args.campaigns * args.leads}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""本地模拟 Gmail API（仅用于压测）
+
+支持 app.py 用到的接口：messages.list（含 q=rfc822msgid: 查找已发送邮件）/ messages.get(format=metadata) /
+messages.send / getProfile / history.list，以及 /batch/gmail/v1 批量请求。每个 HTTP 请求按 --latency 模拟网络往返延迟，
+可以按 --rate-limit（每秒请求数）和 --error-rate（随机比例）返回 429，模拟 Gmail 的限流。
+
+单独运行:  python benchmarks/fake_gmail.py --port 8765 --messages 500 --latency 30 --rate-limit 50
+"""
+import json
+import time
+import base64
+import uuid
+import random
+import argparse
+import threading
+from email import message_from_bytes
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+API_PREFIX = "/gmail/v1/users/me"
+RATE_LIMITED = {"error": {"code": 429, "message": "Rate Limit Exceeded",
+                          "errors": [{"reason": "rateLimitExceeded", "domain": "usageLimits"}]}}
+
+
+class Throttle:
+    """模拟服务端限流：每秒最多 rate_limit 个请求（0 为不限），另外按 error_rate 的比例随机拒绝；seed 固定时结果可复现"""
+
+    def __init__(self, rate_limit: float = 0, error_rate: float = 0, seed: int = 0):
+        self.rate_limit, self.error_rate = rate_limit, error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens, self.updated = rate_limit, time.monotonic()
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        with self.lock:
+            ok = not self.error_rate or self.random.random() >= self.error_rate
+            if ok and self.rate_limit:
+                now = time.monotonic()
+                self.tokens = min(self.rate_limit, self.tokens + (now - self.updated) * self.rate_limit)
+                self.updated = now
+                ok = self.tokens >= 1
+                if ok:
+                    self.tokens -= 1
+            self.rejected += not ok
+            return ok
+
+
+class FakeGmail:
+    """内存中的邮箱状态"""
+
+    def __init__(self, messages: int = 100, senders=None, latency_ms: float = 0, throttle: Throttle = None):
+        self.latency = latency_ms / 1000
+        self.throttle = throttle or Throttle()
+        self.lock = threading.Lock()
+        self.requests = 0          # 收到的 HTTP 请求数（batch 算一次）
+        self.sent = []
+        self.inbox = []
+        senders = senders or []
+        now = datetime.now(timezone.utc)
+        for i in range(messages):
+            sender = senders[i % len(senders)] if senders else f"someone{i}@example.org"
+            self.add_message(f"Someone <{sender}>", now - timedelta(minutes=i))
+
+    def add_message(self, from_header: str, date: datetime):
+        with self.lock:
+            mid = f"m{len(self.inbox):08d}"
+            self.inbox.insert(0, {"id": mid, "threadId": mid, "historyId": len(self.inbox) + 1,
+                                  "from": from_header, "date": format_datetime(date)})
+            return mid
+
+    def history_id(self) -> int:
+        return self.inbox[0]["historyId"] if self.inbox else 1
+
+    # ---- 单个 API 调用，返回 (status, body) ----
+    def handle(self, method: str, target: str, body: bytes):
+        parts = urlsplit(target)
+        path, query = parts.path, parse_qs(parts.query)
+        if not path.startswith(API_PREFIX):
+            return 404, {"error": {"code": 404, "message": "not found"}}
+        path = path[len(API_PREFIX):]
+
+        if method == "GET" and path == "/profile":
+            return 200, {"emailAddress": "me@example.com", "historyId": str(self.history_id())}
+        if method == "GET" and path == "/history":
+            start = int(query["startHistoryId"][0])
+            with self.lock:
+                added = [m for m in reversed(self.inbox) if m["historyId"] > start]
+                latest = self.history_id()
+            return 200, {"historyId": str(latest), "history": [
+                {"id": str(m["historyId"]), "messagesAdded": [
+                    {"message": {"id": m["id"], "threadId": m["threadId"], "labelIds": ["INBOX"]}}]}
+                for m in added]}
+        if method == "GET" and path == "/messages" and query.get("q", [""])[0].startswith("rfc822msgid:"):
+            message_id = query["q"][0].split(":", 1)[1]
+            with self.lock:
+                found = [f"s{i + 1:08d}" for i, m in enumerate(self.sent) if m.get("message_id") == message_id]
+            return 200, {"messages": [{"id": mid, "threadId": mid} for mid in found[:1]], "resultSizeEstimate": len(found)}
+        if method == "GET" and path == "/messages":
+            offset = int(query.get("pageToken", ["0"])[0])
+            size = min(int(query.get("maxResults", ["100"])[0]), 500)
+            with self.lock:
+                page = self.inbox[offset:offset + size]
+                more = offset + size < len(self.inbox)
+            resp = {"messages": [{"id": m["id"], "threadId": m["threadId"]} for m in page],
+                    "resultSizeEstimate": len(page)}
+            if more:
+                resp["nextPageToken"] = str(offset + size)
+            return 200, resp
+        if method == "GET" and path.startswith("/messages/"):
+            mid = path.rsplit("/", 1)[1]
+            with self.lock:
+                msg = next((m for m in self.inbox if m["id"] == mid), None)
+            if not msg:
+                return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+            return 200, {"id": mid, "threadId": msg["threadId"], "payload": {"headers": [
+                {"name": "From", "value": msg["from"]}, {"name": "Date", "value": msg["date"]}]}}
+        if method == "POST" and path == "/messages/send":
+            message = json.loads(body or b"{}")
+            raw = message_from_bytes(base64.urlsafe_b64decode(message.get("raw", "")))
+            message["message_id"] = raw["Message-ID"]
+            with self.lock:
+                self.sent.append(message)
+                return 200, {"id": f"s{len(self.sent):08d}", "labelIds": ["SENT"]}
+        return 404, {"error": {"code": 404, "message": "not found"}}
+
+    # ---- multipart/mixed 批量请求 ----
+    def handle_batch(self, content_type: str, body: bytes):
+        envelope = message_from_bytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        boundary = uuid.uuid4().hex
+        out = []
+        for part in envelope.get_payload():
+            raw = part.get_payload(decode=False)
+            raw = raw if isinstance(raw, str) else raw[0].as_string()
+            head, _, sub_body = raw.replace("\r\n", "\n").partition("\n\n")
+            request_line = head.split("\n", 1)[0]
+            method, target, _ = request_line.split(" ", 2)
+            status, resp = self.handle(method, target, sub_body.encode())
+            content_id = part.get("Content-ID", "<0 + 0>").strip("<>")
+            out.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                f"Content-Type: application/json; charset=UTF-8\r\n\r\n{json.dumps(resp)}\r\n"
+            )
+        out.append(f"--{boundary}--\r\n")
+        return f"multipart/mixed; boundary={boundary}", "".join(out).encode()
+
+
+def make_handler(gmail: FakeGmail):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # 响应头和响应体分开写入，避免触发延迟确认（每个请求多约40ms）
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status: int, content_type: str, payload: bytes):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _dispatch(self, method: str):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            with gmail.lock:
+                gmail.requests += 1
+            if gmail.latency:
+                time.sleep(gmail.latency)
+            if not gmail.throttle.allow():
+                return self._reply(429, "application/json; charset=UTF-8", json.dumps(RATE_LIMITED).encode())
+            if method == "POST" and self.path.startswith("/batch/"):
+                content_type, payload = gmail.handle_batch(self.headers["Content-Type"], body)
+                return self._reply(200, content_type, payload)
+            status, resp = gmail.handle(method, self.path, body)
+            self._reply(status, "application/json; charset=UTF-8", json.dumps(resp).encode())
+
+        def do_GET(self):
+            self._dispatch("GET")
+
+        def do_POST(self):
+            self._dispatch("POST")
+
+    return Handler
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # 默认 listen 队列只有5，高并发建立连接时会被拒绝
+
+
+def start_server(gmail: FakeGmail, port: int = 0):
+    """在后台线程启动服务，返回 (server, base_url)"""
+    server = FakeServer(("127.0.0.1", port), make_handler(gmail))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0, help="每个HTTP请求的模拟延迟（毫秒）")
+    parser.add_argument("--rate-limit", type=float, default=0, help="每秒最多处理的请求数，超过返回429（0为不限）")
+    parser.add_argument("--error-rate", type=float, default=0, help="随机返回429的比例")
+    args = parser.parse_args()
+    throttle = Throttle(args.rate_limit, args.error_rate)
+    server, url = start_server(FakeGmail(args.messages, latency_ms=args.latency, throttle=throttle), args.port)
+    print(f"Fake Gmail listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,141 @@
+"""本地模拟追踪服务（仅用于测试/压测 sync_tracker_data）
+
+实现 app.py 用到的接口：GET /api/opens、GET /api/clicks（支持 limit / after_id 分页）、
+POST /api/mark_synced，以及记录打开的 GET /open?uid=。每个 HTTP 请求按 --latency 模拟网络往返延迟，
+按 --rate-limit / --error-rate 返回 429（同 fake_gmail.py）。
+
+单独运行:  python benchmarks/fake_tracker.py --port 8766 --opens 5000 --latency 30
+"""
+import json
+import time
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from fake_gmail import Throttle
+
+
+class FakeTracker:
+    """内存中的打开/点击记录"""
+
+    def __init__(self, opens: int = 0, clicks: int = 0, lead_ids=None, latency_ms: float = 0, paginate: bool = True,
+                 throttle: Throttle = None):
+        self.latency = latency_ms / 1000
+        self.throttle = throttle or Throttle()
+        self.paginate = paginate   # False 时忽略分页参数，模拟旧版追踪服务
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0       # 新建的TCP连接数（用于确认客户端复用连接）
+        self.records = {"opens": [], "clicks": []}
+        self.synced = {"opens": set(), "clicks": set()}
+        lead_ids = lead_ids or [1]
+        now = datetime.now(timezone.utc)
+        for i in range(opens):
+            self.add("opens", lead_ids[i % len(lead_ids)], now - timedelta(seconds=opens - i))
+        for i in range(clicks):
+            self.add("clicks", lead_ids[i % len(lead_ids)], now - timedelta(seconds=clicks - i))
+
+    def add(self, kind: str, uid: int, when: datetime = None):
+        with self.lock:
+            records = self.records[kind]
+            records.append({"id": len(records) + 1, "uid": uid,
+                            "timestamp": (when or datetime.now(timezone.utc)).isoformat()})
+
+    def unsynced(self, kind: str) -> int:
+        with self.lock:
+            return len(self.records[kind]) - len(self.synced[kind])
+
+    def handle(self, method: str, target: str, body: bytes):
+        parts = urlsplit(target)
+        path, query = parts.path, parse_qs(parts.query)
+        if method == "GET" and path in ("/api/opens", "/api/clicks"):
+            kind = path.rsplit("/", 1)[1]
+            with self.lock:
+                pending = [r for r in self.records[kind] if r["id"] not in self.synced[kind]]
+            if self.paginate:
+                after = int(query.get("after_id", ["0"])[0])
+                limit = int(query.get("limit", ["500"])[0])
+                pending = [r for r in pending if r["id"] > after][:limit]
+            return 200, {kind: pending}
+        if method == "POST" and path == "/api/mark_synced":
+            data = json.loads(body or b"{}")
+            with self.lock:
+                self.synced["opens"].update(data.get("open_ids", []))
+                self.synced["clicks"].update(data.get("click_ids", []))
+            return 200, {"ok": True}
+        if method == "GET" and path == "/open":
+            self.add("opens", int(query["uid"][0]))
+            return 200, {"ok": True}
+        return 404, {"error": "not found"}
+
+
+def make_handler(tracker: FakeTracker):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # 响应头和响应体分开写入，避免触发延迟确认（每个请求多约40ms）
+
+        def log_message(self, *args):
+            pass
+
+        def setup(self):
+            super().setup()
+            with tracker.lock:
+                tracker.connections += 1
+
+        def _dispatch(self, method: str):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            with tracker.lock:
+                tracker.requests += 1
+            if tracker.latency:
+                time.sleep(tracker.latency)
+            if tracker.throttle.allow():
+                status, resp = tracker.handle(method, self.path, body)
+            else:
+                status, resp = 429, {"error": "rate limited"}
+            payload = json.dumps(resp).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            self._dispatch("GET")
+
+        def do_POST(self):
+            self._dispatch("POST")
+
+    return Handler
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # 默认 listen 队列只有5，高并发建立连接时会被拒绝
+
+
+def start_server(tracker: FakeTracker, port: int = 0):
+    """在后台线程启动服务，返回 (server, base_url)"""
+    server = FakeServer(("127.0.0.1", port), make_handler(tracker))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--opens", type=int, default=0)
+    parser.add_argument("--clicks", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0, help="每个HTTP请求的模拟延迟（毫秒）")
+    parser.add_argument("--rate-limit", type=float, default=0, help="每秒最多处理的请求数，超过返回429（0为不限）")
+    parser.add_argument("--error-rate", type=float, default=0, help="随机返回429的比例")
+    args = parser.parse_args()
+    tracker = FakeTracker(args.opens, args.clicks, latency_ms=args.latency, throttle=Throttle(args.rate_limit, args.error_rate))
+    server, url = start_server(tracker, args.port)
+    print(f"Fake tracker listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,395 @@
+"""压测套件：合成数据 + 本地模拟 Gmail / 追踪服务，按场景输出吞吐量和 p50/p99 延迟（JSON）
+
+每个场景在独立的子进程和临时目录中运行（全新的数据库和 app 模块），场景之间互不影响。
+数据由 datagen.py 按 --seed 生成，模拟服务可以设置延迟（--latency）和 429 限流（--rate-limit / --error-rate），
+不会访问真实的 Gmail 或追踪服务。结果写入 --output，用 --compare 与另一次（例如上一个版本）的结果对比。
+
+场景:
+  send          发送引擎通过模拟 Gmail 发送所有到期邮件（N campaign × M lead × K 步，429 后重试）
+  replies       每个账号的回复检查：第一轮全量扫描收件箱，之后每轮增量同步
+  import        JSON 导入 leads（分批验证、禁发名单检查、写入）
+  pixels        打开追踪像素的并发突发请求，以及事件全部写入数据库的耗时
+  stats         多个客户端并发轮询统计接口
+  tracker_sync  从模拟追踪服务同步积压的打开/点击记录（429 由客户端重试）
+
+运行:
+    python benchmarks/suite.py --output results.json
+    python benchmarks/suite.py --scenarios send pixels --leads 2000 --latency 50 --error-rate 0.05
+    python benchmarks/suite.py --output new.json --compare results.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import socket
+import sqlite3
+import tempfile
+import subprocess
+import urllib.request
+from collections import deque
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+import datagen  # noqa: E402
+from fake_gmail import FakeGmail, Throttle, start_server as start_gmail  # noqa: E402
+from fake_tracker import FakeTracker, start_server as start_tracker  # noqa: E402
+
+SCENARIOS = ["send", "replies", "import", "pixels", "stats", "tracker_sync"]
+RESULT_PREFIX = "BENCH_RESULT "
+# --compare 时比较的指标：数值越大越好的和越小越好的
+HIGHER_IS_BETTER = ("throughput",)
+LOWER_IS_BETTER = ("seconds", "p50_ms", "p99_ms")
+
+
+def summarize(scenario: str, ops: int, seconds: float, samples, **extra) -> dict:
+    """统一的结果格式：操作数、总耗时、吞吐量（次/秒）、单次操作延迟的 p50/p99（毫秒）"""
+    samples = sorted(samples)
+    pick = (lambda q: round(samples[min(int(len(samples) * q), len(samples) - 1)] * 1000, 2)) if samples else (lambda q: None)
+    return dict({"scenario": scenario, "ops": ops, "seconds": round(seconds, 3),
+                 "throughput": round(ops / seconds, 1) if seconds else None,
+                 "p50_ms": pick(0.5), "p99_ms": pick(0.99)}, **extra)
+
+
+def import_app(test_mode: bool = True, **env):
+    """在当前（临时）目录导入 app，环境变量必须在导入前设置"""
+    os.environ["TEST_MODE"] = "true" if test_mode else "false"
+    os.environ.update(env)
+    import app
+    return app
+
+
+def throttle(args) -> Throttle:
+    return Throttle(args.rate_limit, args.error_rate, args.seed)
+
+
+class AppServer:
+    """在单独的进程中用 uvicorn 运行 app（使用当前目录的数据库，不执行 lifespan，不启动调度任务和发送引擎）
+
+    压测客户端和服务端不在同一个进程，互不争用 GIL。
+    """
+
+    def __init__(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.proc = None
+
+    def __enter__(self) -> str:
+        cmd = [sys.executable, "-m", "uvicorn", "app:app", "--app-dir", ROOT_DIR, "--host", "127.0.0.1",
+               "--port", str(self.port), "--lifespan", "off", "--log-level", "warning", "--no-access-log",
+               "--backlog", "4096"]
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                urllib.request.urlopen(self.url + "/api/system/stats", timeout=5).close()
+                return self.url
+            except OSError:
+                time.sleep(0.05)
+        self.proc.kill()
+        raise RuntimeError("app server did not start")
+
+    def get(self, path: str) -> dict:
+        with urllib.request.urlopen(self.url + path, timeout=30) as resp:
+            return json.load(resp)
+
+    def __exit__(self, *exc):
+        self.proc.terminate()
+        self.proc.wait(10)
+
+
+async def hammer(base_url: str, paths, concurrency: int) -> tuple:
+    """用 concurrency 个连接请求 paths 中的所有地址，返回 (每个请求的耗时列表, 非2xx/3xx 响应数)"""
+    import httpx
+    latencies, errors = [], 0
+    queue = deque(paths)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        async def worker():
+            nonlocal errors
+            while queue:
+                path = queue.popleft()
+                started = time.perf_counter()
+                resp = await client.get(path)
+                latencies.append(time.perf_counter() - started)
+                errors += resp.status_code >= 400
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors
+
+
+# ---- 场景（在子进程中运行） ----
+
+def bench_send(args) -> dict:
+    gmail = FakeGmail(0, latency_ms=args.latency, throttle=throttle(args))
+    server, url = start_gmail(gmail)
+    app = import_app(test_mode=False, GMAIL_API_ENDPOINT=url)
+    # 429 后尽快重试、尽快发现新的待发邮件，压测不等待默认的分钟级间隔
+    app.SEND_RETRY_SECONDS = 0.2
+    app.ACCOUNT_PLAN_SECONDS = 0.5
+    datagen.generate(app, args.campaigns, args.leads, args.steps, args.accounts, args.seed, status="running")
+    total = args.campaigns * args.leads * args.steps
+    with app.get_db() as conn:
+        # 失败的发送也消耗campaign令牌，给429重试留出余量，避免重试等待令牌桶补充
+        conn.execute("UPDATE campaigns SET batch_size = batch_size * 2")
+        conn.commit()
+
+    async def run():
+        engine = app.SendEngine(args.concurrency, args.per_account)
+        engine._latencies = deque()  # 保留全部样本，默认只保留最近1000个
+        app.send_engine = engine
+        started = time.perf_counter()
+        await engine.start()
+        while engine.sent < total and time.perf_counter() - started < args.timeout:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        await engine.stop()
+        return engine, elapsed
+
+    engine, elapsed = asyncio.run(run())
+    server.shutdown()
+    message_ids = [m["message_id"] for m in gmail.sent]
+    return summarize("send", engine.sent, elapsed, engine._latencies, expected=total, failed=engine.failed,
+                     delivered=len(message_ids), unique_message_ids=len(set(message_ids)),
+                     http_requests=gmail.requests, throttled=gmail.throttle.rejected)
+
+
+def bench_replies(args) -> dict:
+    gmail = FakeGmail(0, latency_ms=args.latency, throttle=throttle(args))
+    server, url = start_gmail(gmail)
+    app = import_app(test_mode=False, GMAIL_API_ENDPOINT=url)
+    app.REPLY_SCAN_LIMIT = args.inbox
+    data = datagen.generate(app, args.campaigns, args.leads, 1, args.accounts, args.seed, sent_days=1)
+    with app.get_db(readonly=True) as conn:
+        lead_emails = [r[0] for r in conn.execute("SELECT email FROM leads")]
+    rng = random.Random(args.seed)
+
+    def fill(count: int):
+        # 约十分之一是 lead 的回复，其余是无关邮件
+        for i in range(count):
+            sender = rng.choice(lead_emails) if rng.random() < 0.1 else f"someone{rng.randrange(10 ** 6)}@example.org"
+            gmail.add_message(f"Someone <{sender}>", datetime.now().astimezone())
+
+    fill(args.inbox)
+    samples, first_round = [], []
+    started = time.perf_counter()
+    for round_no in range(args.rounds):
+        for email in data["accounts"]:
+            t = time.perf_counter()
+            app.check_replies(email)
+            (first_round if round_no == 0 else samples).append(time.perf_counter() - t)
+        fill(args.inbox // 100 or 1)
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    with app.get_db(readonly=True) as conn:
+        replied = conn.execute("SELECT COUNT(*) FROM leads WHERE status='replied'").fetchone()[0]
+    full = sorted(first_round)
+    return summarize("replies", len(first_round) + len(samples), elapsed, samples or first_round,
+                     full_scan_ms_p50=round(full[len(full) // 2] * 1000, 2), inbox=args.inbox,
+                     replied=replied, http_requests=gmail.requests, throttled=gmail.throttle.rejected)
+
+
+def bench_import(args) -> dict:
+    app = import_app()
+    cid = datagen.generate(app, 1, 0, 1, seed=args.seed)["campaigns"][0]
+    rng = random.Random(args.seed)
+    rows = [dict(json.loads(data), email=email) for _, email, data in datagen.lead_rows(cid, args.import_rows, rng)]
+    # 混入约2%的重复和无效地址
+    for i in range(0, len(rows), 50):
+        rows[i] = dict(rows[i], email=rows[i - 1]["email"] if i % 100 else "not-an-email")
+
+    chunks, last = [], [time.perf_counter()]
+
+    def progress(*_):
+        now = time.perf_counter()
+        chunks.append(now - last[0])
+        last[0] = now
+
+    started = last[0] = time.perf_counter()
+    result = app.import_leads(cid, rows, progress=progress)
+    elapsed = time.perf_counter() - started
+    # p50/p99 为每批（IMPORT_CHUNK_SIZE 行）的耗时
+    return summarize("import", len(rows), elapsed, chunks, chunk_size=app.IMPORT_CHUNK_SIZE,
+                     added=result.get("added"), skipped=result.get("skipped"))
+
+
+def bench_pixels(args) -> dict:
+    app = import_app()
+    datagen.generate(app, 1, args.leads, 1, seed=args.seed, sent_days=1)
+    with app.get_db(readonly=True) as conn:
+        lead_ids = [r[0] for r in conn.execute("SELECT id FROM leads")]
+    rng = random.Random(args.seed)
+    paths = [f"/track/open/{rng.choice(lead_ids)}" for _ in range(args.pixels)]
+
+    server = AppServer()
+    with server as base_url:
+        started = time.perf_counter()
+        latencies, errors = asyncio.run(hammer(base_url, paths, args.concurrency))
+        burst = time.perf_counter() - started
+        # 像素请求只把事件放入队列，等服务端的写入线程把它们全部写入数据库
+        while time.perf_counter() - started < args.timeout:
+            writer = server.get("/api/system/stats")["tracking"]
+            if writer["written"] + writer["dropped"] >= args.pixels:
+                break
+            time.sleep(0.02)
+        drained = time.perf_counter() - started
+    return summarize("pixels", len(latencies), burst, latencies, errors=errors, written_seconds=round(drained, 3),
+                     written=writer["written"], dropped=writer["dropped"], avg_batch=writer["avg_batch"])
+
+
+def bench_stats(args) -> dict:
+    app = import_app()
+    data = datagen.generate(app, args.campaigns, args.leads, 2, args.accounts, args.seed, sent_days=3)
+    rng = random.Random(args.seed)
+    with app.get_db() as conn:
+        lead_ids = [r[0] for r in conn.execute("SELECT id FROM leads")]
+        opened_at = datetime.now().isoformat()
+        app.record_events(conn, [(lead_id, "open", opened_at) for lead_id in rng.sample(lead_ids, len(lead_ids) // 3)])
+        conn.commit()
+    cids = data["campaigns"]
+    paths = []
+    for i in range(args.stats_requests):
+        cid = cids[i % len(cids)]
+        paths.append(("/api/stats/campaigns", f"/api/campaigns/{cid}/stats", f"/api/campaigns/{cid}/timeline")[i % 3])
+
+    with AppServer() as base_url:
+        started = time.perf_counter()
+        latencies, errors = asyncio.run(hammer(base_url, paths, args.concurrency))
+        elapsed = time.perf_counter() - started
+    return summarize("stats", len(latencies), elapsed, latencies, errors=errors, leads=len(lead_ids))
+
+
+def bench_tracker_sync(args) -> dict:
+    tracker = FakeTracker(latency_ms=args.latency, throttle=throttle(args))
+    server, url = start_tracker(tracker)
+    app = import_app(TRACKER_URL=url)
+    datagen.generate(app, 1, args.leads, 1, seed=args.seed, sent_days=1)
+    with app.get_db(readonly=True) as conn:
+        lead_ids = [r[0] for r in conn.execute("SELECT id FROM leads")]
+    for i in range(args.tracker_records):
+        tracker.add("opens" if i % 5 else "clicks", lead_ids[i % len(lead_ids)])
+
+    # 直接调用同步器（不经过 sync_tracker_data 的周期租约），限流时可能需要多轮才能同步完
+    samples, pulled = [], 0
+    started = time.perf_counter()
+    while tracker.unsynced("opens") + tracker.unsynced("clicks") and time.perf_counter() - started < args.timeout:
+        t = time.perf_counter()
+        pulled += app.tracker_sync.run(url) or 0
+        samples.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    return summarize("tracker_sync", pulled, elapsed, samples, rounds=len(samples),
+                     left_unsynced=tracker.unsynced("opens") + tracker.unsynced("clicks"),
+                     http_requests=tracker.requests, throttled=tracker.throttle.rejected)
+
+
+RUNNERS = {"send": bench_send, "replies": bench_replies, "import": bench_import, "pixels": bench_pixels,
+           "stats": bench_stats, "tracker_sync": bench_tracker_sync}
+
+
+# ---- 父进程：逐个启动场景、汇总、对比 ----
+
+def run_scenario(name: str, args) -> dict:
+    """在子进程中运行一个场景，从输出中取出结果行；app 的日志转发到 stderr"""
+    workdir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", name, "--params", json.dumps(vars(args))]
+    proc = subprocess.run(cmd, cwd=workdir, capture_output=True, text=True, timeout=args.timeout * 2 + 60)
+    result = None
+    for line in proc.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            result = json.loads(line[len(RESULT_PREFIX):])
+        elif args.verbose:
+            print(line, file=sys.stderr)
+    if result is None:
+        sys.stderr.write(proc.stderr[-4000:])
+        return {"scenario": name, "error": f"exit code {proc.returncode}"}
+    return result
+
+
+def metadata(args) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    params = {k: v for k, v in vars(args).items() if k not in ("output", "compare", "child", "params", "verbose")}
+    return {"commit": commit, "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(), "cpus": os.cpu_count(), "params": params}
+
+
+def compare(results: list, baseline_path: str):
+    """打印与基准结果的对比：每个指标的基准值、当前值和变化百分比"""
+    with open(baseline_path) as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+    print(f"\n{'scenario':<14}{'metric':<12}{'baseline':>12}{'current':>12}{'change':>10}")
+    for result in results:
+        base = baseline.get(result["scenario"])
+        if not base or "error" in result or "error" in base:
+            continue
+        for metric in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = change < 0 if metric in HIGHER_IS_BETTER else change > 0
+            flag = "  (worse)" if worse and abs(change) >= 10 else ""
+            print(f"{result['scenario']:<14}{metric:<12}{old:>12}{new:>12}{change:>+9.1f}%{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--campaigns", type=int, default=4)
+    parser.add_argument("--leads", type=int, default=500, help="每个campaign的lead数")
+    parser.add_argument("--steps", type=int, default=2, help="每个campaign的模板步骤数")
+    parser.add_argument("--accounts", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=30, help="模拟服务每个HTTP请求的延迟（毫秒）")
+    parser.add_argument("--rate-limit", type=float, default=0, help="模拟服务每秒最多处理的请求数，超过返回429（0为不限）")
+    parser.add_argument("--error-rate", type=float, default=0, help="模拟服务随机返回429的比例")
+    parser.add_argument("--concurrency", type=int, default=32, help="发送引擎的并发数 / HTTP 客户端的连接数")
+    parser.add_argument("--per-account", type=int, default=8, help="发送引擎每个账号的并发数")
+    parser.add_argument("--inbox", type=int, default=500, help="replies: 收件箱邮件数")
+    parser.add_argument("--rounds", type=int, default=5, help="replies: 检查轮数（第一轮为全量扫描）")
+    parser.add_argument("--import-rows", type=int, default=20000, help="import: 导入的行数")
+    parser.add_argument("--pixels", type=int, default=5000, help="pixels: 像素请求数")
+    parser.add_argument("--stats-requests", type=int, default=600, help="stats: 统计接口请求数")
+    parser.add_argument("--tracker-records", type=int, default=5000, help="tracker_sync: 积压的记录数")
+    parser.add_argument("--timeout", type=float, default=300, help="每个场景的最长运行时间（秒）")
+    parser.add_argument("--output", help="把结果写入这个JSON文件")
+    parser.add_argument("--compare", help="与之前保存的结果JSON对比")
+    parser.add_argument("--verbose", action="store_true", help="输出 app 的日志")
+    parser.add_argument("--child", choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument("--params", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        params = argparse.Namespace(**json.loads(args.params))
+        print(RESULT_PREFIX + json.dumps(RUNNERS[args.child](params)), flush=True)
+        os._exit(0)  # 不等待 app 的后台线程
+
+    results = []
+    for name in args.scenarios:
+        result = run_scenario(name, args)
+        print(json.dumps(result), flush=True)
+        results.append(result)
+
+    report = {"meta": metadata(args), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
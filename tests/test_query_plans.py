@@ -0,0 +1,45 @@
+import importlib
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(scope="module")
+def migrated_db(tmp_path_factory):
+    # app 导入时会在当前目录建库并执行全部迁移，所以先切到临时目录
+    # 模块级 fixture 不能用函数级的 monkeypatch，用 MonkeyPatch.context() 在结束时恢复环境变量和目录
+    workdir = tmp_path_factory.mktemp("plans")
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("TEST_MODE", "true")
+        mp.chdir(workdir)
+        app = importlib.import_module("app")
+        app.init_db()
+        conn = sqlite3.connect(workdir / app.DB_PATH)
+        yield app, conn
+        conn.close()
+
+
+def test_migrations_applied(migrated_db):
+    app, conn = migrated_db
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(app.MIGRATIONS)
+
+
+def test_hot_queries_have_no_full_scans(migrated_db):
+    app, conn = migrated_db
+    report = app.audit_query_plans(conn)
+    assert set(report) == set(app.HOT_QUERIES)
+    failures = {name: r["plan"] for name, r in report.items() if r["full_scans"]}
+    assert not failures
+
+
+@pytest.mark.parametrize("sql_name", ["DUE_LEADS_SQL", "REMAINING_BY_STEP_SQL"])
+def test_pending_lead_queries_use_partial_index(migrated_db, sql_name):
+    app, conn = migrated_db
+    sql = getattr(app, sql_name)
+    params = (1, 100)[:sql.count("?")]
+    plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+    assert any("idx_leads_pending" in line for line in plan), plan